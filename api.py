@@ -0,0 +1,84 @@
+"""Helpers for the JSON REST API (/api/cafes...).
+
+Responses are encoded with orjson when it's installed (the stdlib json
+module otherwise), and gzipped for clients that accept it once they are
+bigger than API_GZIP_MIN_BYTES.
+"""
+
+import gzip
+import json
+
+from flask import current_app, request
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+class InvalidArgument(ValueError):
+    """A query string argument named something the API doesn't have."""
+
+
+def parse_fields(arg, allowed):
+    """Return list of fields asked for in a ?fields=a,b,c argument.
+
+    Defaults to all of allowed; "id" is always included, so clients can
+    tell resources apart.
+    """
+
+    if not arg:
+        return list(allowed)
+
+    fields = ['id']
+
+    for field in arg.split(','):
+        field = field.strip()
+
+        if not field or field in fields:
+            continue
+
+        if field not in allowed:
+            raise InvalidArgument(f"Unknown field: {field}")
+
+        fields.append(field)
+
+    return fields
+
+
+def parse_include(arg, allowed):
+    """Return set of related resources asked for in ?include=a,b."""
+
+    include = {name.strip() for name in (arg or '').split(',')} - {''}
+
+    for name in include - set(allowed):
+        raise InvalidArgument(f"Unknown include: {name}")
+
+    return include
+
+
+def dumps(payload):
+    """Return payload encoded as compact JSON bytes."""
+
+    if orjson is not None:
+        return orjson.dumps(payload)
+
+    return json.dumps(payload, separators=(',', ':')).encode('UTF-8')
+
+
+def api_response(payload, status=200):
+    """Return JSON response for payload, gzipped if the client accepts it."""
+
+    body = dumps(payload)
+    response = current_app.response_class(
+        body, status=status, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+
+    if (len(body) >= current_app.config.get('API_GZIP_MIN_BYTES', 1024)
+            # the quality, not `in`: "gzip;q=0" means the client refuses it
+            and request.accept_encodings['gzip'] > 0):
+        response.set_data(gzip.compress(
+            body, compresslevel=current_app.config.get('API_GZIP_LEVEL', 6)))
+        response.headers['Content-Encoding'] = 'gzip'
+
+    return response
@@ -2,19 +2,66 @@
 
 import os
 
-from flask import Flask, render_template, flash, redirect, url_for, session, g, request, jsonify
+from flask import Flask, render_template, flash, redirect, url_for, session, g, request, jsonify, abort, make_response, Response, stream_with_context
 from flask_debugtoolbar import DebugToolbarExtension
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import load_only
 
-from models import connect_db, Cafe, db, City, DEFAULT_PROF_IMG_URL, User, DEFAULT_CAFE_IMG_URL, Like
+from models import connect_db, Cafe, db, City, DEFAULT_PROF_IMG_URL, User, DEFAULT_CAFE_IMG_URL, Like, MapJob, city_registry
 from forms import AddEditCafeForm, SignUpForm, CSRFProtectForm, LoginForm, ProfileEditForm
+from pagination import keyset_page
+from fragment_cache import FragmentCache
+from conditional import conditional, get_templates_version
+from search import search_cafes
+from dbstats import DbStats, get_engine_options, get_pool_status, pool_stats
+from routing import ReplicaRouter, get_replica_binds
+from api import InvalidArgument, parse_fields, parse_include, api_response
+from throttle import LoginThrottle
+from loadtest import RequestRecorder
+from cli import (
+    jobs_cli, maps_cli, likes_cli, search_cli, passwords_cli, export_command,
+    import_cli, db_cli, seed_cli, loadtest_cli)
+import exports
+from auth import (
+    get_current_user, remember_user, forget_user, refresh_snapshot)
 
 
 app = Flask(__name__)
 
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
     "DATABASE_URL", 'postgresql:///flask_cafe')
+app.config['DB_POOL_SIZE'] = int(os.environ.get("DB_POOL_SIZE", 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+app.config['DB_POOL_TIMEOUT'] = int(os.environ.get("DB_POOL_TIMEOUT", 30))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+app.config['DB_POOL_PRE_PING'] = os.environ.get(
+    "DB_POOL_PRE_PING", "1") == "1"
+# 0 means no timeout
+app.config['DB_STATEMENT_TIMEOUT_MS'] = int(
+    os.environ.get("DB_STATEMENT_TIMEOUT_MS", 0))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = get_engine_options(app.config)
+# how long migration DDL waits for a lock before giving up (and retrying)
+app.config['MIGRATION_LOCK_TIMEOUT_MS'] = int(
+    os.environ.get("MIGRATION_LOCK_TIMEOUT_MS", 5000))
+
+# comma-separated URLs of read replicas, for GET requests' queries
+app.config['SQLALCHEMY_BINDS'] = get_replica_binds([
+    url for url in os.environ.get("DATABASE_REPLICA_URLS", "").split(",")
+    if url
+])
+app.config['REPLICA_HEALTH_INTERVAL'] = int(
+    os.environ.get("REPLICA_HEALTH_INTERVAL", 10))
+app.config['REPLICA_STICKY_SECONDS'] = int(
+    os.environ.get("REPLICA_STICKY_SECONDS", 5))
+
+app.config['DB_SERVER_TIMING'] = os.environ.get("DB_SERVER_TIMING") == "1"
+app.config['DB_QUERY_BUDGET'] = int(os.environ.get("DB_QUERY_BUDGET", 20))
+app.config['DB_REPEATED_QUERY_THRESHOLD'] = int(
+    os.environ.get("DB_REPEATED_QUERY_THRESHOLD", 5))
+app.config['DB_QUERY_SAMPLE_RATE'] = float(
+    os.environ.get("DB_QUERY_SAMPLE_RATE", 0.1))
+
 app.config['SECRET_KEY'] = os.environ.get("FLASK_SECRET_KEY", "shhhh")
 
 if app.debug:
@@ -22,26 +69,113 @@ if app.debug:
 
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
+app.config['ETAG_SALT'] = os.environ.get(
+    "ETAG_SALT", get_templates_version(app.template_folder))
+
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get("BCRYPT_LOG_ROUNDS", 12))
+app.config['BCRYPT_POOL_SIZE'] = int(os.environ.get("BCRYPT_POOL_SIZE", 0))
+
+app.config['LOGIN_THROTTLE_BACKEND'] = os.environ.get(
+    "LOGIN_THROTTLE_BACKEND", "memory")
+app.config['LOGIN_THROTTLE_REDIS_URL'] = os.environ.get(
+    "LOGIN_THROTTLE_REDIS_URL")
+app.config['LOGIN_THROTTLE_WINDOW'] = int(
+    os.environ.get("LOGIN_THROTTLE_WINDOW", 300))
+app.config['LOGIN_MAX_FAILURES_PER_USER'] = int(
+    os.environ.get("LOGIN_MAX_FAILURES_PER_USER", 5))
+app.config['LOGIN_MAX_FAILURES_PER_IP'] = int(
+    os.environ.get("LOGIN_MAX_FAILURES_PER_IP", 50))
+app.config['LOGIN_MISSING_USER_TTL'] = int(
+    os.environ.get("LOGIN_MISSING_USER_TTL", 60))
+
+app.config['CAFES_PER_PAGE'] = int(os.environ.get("CAFES_PER_PAGE", 24))
+app.config['MAX_LIKE_STATUS_IDS'] = 100
+app.config['LIKED_CAFES_PER_PAGE'] = 20
+app.config['MAX_NEARBY_RADIUS_KM'] = 50
+app.config['API_MAX_PAGE_SIZE'] = 100
+app.config['API_GZIP_MIN_BYTES'] = int(
+    os.environ.get("API_GZIP_MIN_BYTES", 1024))
+
+app.config['CITY_CACHE_TTL'] = int(os.environ.get("CITY_CACHE_TTL", 60))
+app.config['USER_SNAPSHOT_TTL'] = int(
+    os.environ.get("USER_SNAPSHOT_TTL", 30))
+
+app.config['FRAGMENT_CACHE_BACKEND'] = os.environ.get(
+    "FRAGMENT_CACHE_BACKEND", "memory")
+app.config['FRAGMENT_CACHE_MAX_BYTES'] = int(
+    os.environ.get("FRAGMENT_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+app.config['FRAGMENT_CACHE_DIR'] = os.environ.get(
+    "FRAGMENT_CACHE_DIR", "/tmp/flask_cafe_fragments")
+app.config['FRAGMENT_CACHE_DIR_MAX_BYTES'] = int(
+    os.environ.get("FRAGMENT_CACHE_DIR_MAX_BYTES", 256 * 1024 * 1024))
+
+app.config['MAP_JOB_MAX_ATTEMPTS'] = int(
+    os.environ.get("MAP_JOB_MAX_ATTEMPTS", 5))
+app.config['MAP_JOB_BACKOFF_SECONDS'] = int(
+    os.environ.get("MAP_JOB_BACKOFF_SECONDS", 30))
+
+app.config['MAP_CACHE_MAX_ORPHAN_BYTES'] = int(
+    os.environ.get("MAP_CACHE_MAX_ORPHAN_BYTES", 50 * 1024 * 1024))
+
+# file to record requests to, for `flask loadtest replay`
+app.config['REQUEST_LOG_PATH'] = os.environ.get("REQUEST_LOG_PATH")
+
 toolbar = DebugToolbarExtension(app)
+fragment_cache = FragmentCache(app)
+login_throttle = LoginThrottle(app)
+db_stats = DbStats(app)
+request_recorder = RequestRecorder(app)
 
 connect_db(app)
+replica_router = ReplicaRouter(db, app)
+
+app.cli.add_command(jobs_cli)
+app.cli.add_command(maps_cli)
+app.cli.add_command(likes_cli)
+app.cli.add_command(search_cli)
+app.cli.add_command(passwords_cli)
+app.cli.add_command(export_command)
+app.cli.add_command(import_cli)
+app.cli.add_command(db_cli)
+app.cli.add_command(seed_cli)
+app.cli.add_command(loadtest_cli)
 
 #######################################
 # auth & auth routes
 
-CURR_USER_KEY = "curr_user"
 NOT_LOGGED_IN_MSG = "You are not logged in."
 
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    g.user is a SessionUser built from the session cookie; it only loads
+    the user from the database if a view needs more than the basics.
+    """
+
+    g.user = get_current_user()
+
+
+@app.after_request
+def update_user_snapshot(response):
+    """Keep session's user snapshot in sync if the user was loaded."""
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    refresh_snapshot(g.get('user'))
+    return response
 
-    else:
-        g.user = None
+
+@app.teardown_request
+def clear_request_state(exc):
+    """Drop per-request values cached on g.
+
+    Tests push an app context for the whole run, so g can outlive a
+    request; don't let the next request see these.
+    """
+
+    g.pop('cafe_page', None)
+    g.pop('cafe_sort', None)
+    g.pop('liked_page', None)
 
 
 @app.before_request
@@ -54,14 +188,13 @@ def add_csrf_form_to_g():
 def do_login(user):
     """Log in user."""
 
-    session[CURR_USER_KEY] = user.id
+    remember_user(user)
 
 
 def do_logout():
     """Logout user."""
 
-    if CURR_USER_KEY in session:
-        del session[CURR_USER_KEY]
+    forget_user()
 
 
 @app.route('/signup', methods=["GET", "POST"])
@@ -97,6 +230,8 @@ def signup():
             flash('Username already taken', 'danger')
             return render_template('auth/signup-form.html', form=form)
 
+        login_throttle.forget_missing(user.username)
+
         do_login(user)
         flash('You are signed up and logged in.', 'success')
         return redirect('/cafes')
@@ -115,17 +250,39 @@ def login():
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(
-            form.username.data,
-            form.password.data
-        )
+        username = form.username.data
+        ip = request.remote_addr
+
+        # turn away repeated failures before any DB query or bcrypt work
+        retry_after = login_throttle.retry_after(username, ip)
+
+        if retry_after:
+            flash("Too many failed logins. "
+                  f"Try again in {retry_after} seconds.", 'danger')
+            resp = make_response(
+                render_template('/auth/login-form.html', form=form), 429)
+            resp.headers['Retry-After'] = str(retry_after)
+            return resp
+
+        if login_throttle.is_missing(username):
+            user = None
+        else:
+            user = User.authenticate(username, form.password.data)
+
+            if user is None:
+                login_throttle.remember_missing(username)
 
         if user:
+            # saves password rehashed at current cost, if it was
+            db.session.commit()
+
+            login_throttle.record_success(username)
             do_login(user)
             flash(f'Hello, {user.username}!', 'success')
 
             return redirect("/cafes")
 
+        login_throttle.record_failure(username, ip)
         flash("Invalid credentials", 'danger')
 
     return render_template('/auth/login-form.html', form=form)
@@ -162,23 +319,94 @@ def homepage():
 # cafes
 
 
+def get_cafe_page():
+    """Return the Page of cafes asked for by the request's query string.
+
+    Takes an optional ?after=CURSOR to continue from a previous page, and
+    ?sort=popular to order by number of likes (most liked first) instead
+    of by name. The page is kept on g, so it is only queried once per
+    request.
+    """
+
+    if 'cafe_page' not in g:
+        sort = request.args.get('sort')
+
+        if sort == 'popular':
+            columns, descending = [Cafe.like_count, Cafe.id], True
+        else:
+            sort, columns, descending = 'name', [Cafe.name, Cafe.id], False
+
+        g.cafe_sort = sort
+        g.cafe_page = keyset_page(
+            Cafe.query,
+            columns,
+            after=request.args.get('after'),
+            limit=app.config['CAFES_PER_PAGE'],
+            descending=descending,
+        )
+
+    return g.cafe_page
+
+
+def cafe_list_validators():
+    """ETag parts for cafe list: every cafe on page, and its version."""
+
+    if not g.user:
+        return None
+
+    page = get_cafe_page()
+
+    parts = [
+        [(cafe.id, cafe.version) for cafe in page.items],
+        page.next_cursor,
+        g.cafe_sort,
+        city_registry.version,
+    ]
+    last_modified = max(
+        (cafe.updated_at for cafe in page.items), default=None)
+
+    return parts, last_modified
+
+
 @app.get('/cafes')
+@conditional(cafe_list_validators)
 def cafe_list():
-    """Return list of all cafes."""
+    """Return one page of cafes, ordered by name.
+
+    See get_cafe_page for paging and sorting options.
+    """
 
     if not g.user:
         flash(NOT_LOGGED_IN_MSG, 'danger')
         return redirect('/login')
 
-    cafes = Cafe.query.order_by('name').all()
+    page = get_cafe_page()
 
     return render_template(
         'cafe/list.html',
-        cafes=cafes,
+        cafes=page.items,
+        next_cursor=page.next_cursor,
+        sort=g.cafe_sort,
     )
 
 
+def cafe_detail_validators(cafe_id):
+    """ETag parts for cafe detail: the cafe's version."""
+
+    if not g.user:
+        return None
+
+    cafe = db.session.get(Cafe, cafe_id)
+
+    if cafe is None:
+        return None
+
+    parts = [cafe.id, cafe.version, cafe.updated_at, city_registry.version]
+    return parts, cafe.updated_at
+
+
 @app.get('/cafes/<int:cafe_id>')
+@conditional(cafe_detail_validators)
 def cafe_detail(cafe_id):
     """Show detail for cafe."""
 
@@ -194,6 +422,186 @@ def cafe_detail(cafe_id):
     )
 
 
+@app.get('/cafes/search')
+def cafe_search():
+    """Show cafes matching ?q=, best matches first (?page=N for more)."""
+
+    if not g.user:
+        flash(NOT_LOGGED_IN_MSG, 'danger')
+        return redirect('/login')
+
+    q = request.args.get('q', '')
+    results = search_cafes(
+        q,
+        page=request.args.get('page', 1, type=int),
+        per_page=app.config['CAFES_PER_PAGE'],
+    )
+
+    return render_template('cafe/search.html', q=q, results=results)
+
+
+@app.get('/api/cafes/search')
+def cafe_search_api():
+    """
+    Search cafes. Given ?q=words&page=N, return JSON like
+    {"cafes": [{"id": 1, "name": ...}, ...], "total": 12, "page": 1}
+    """
+
+    if not g.user:
+        return jsonify({"error": "Not logged in"}), 401
+
+    results = search_cafes(
+        request.args.get('q', ''),
+        page=request.args.get('page', 1, type=int),
+        per_page=app.config['CAFES_PER_PAGE'],
+    )
+
+    return jsonify(
+        cafes=[cafe.to_dict() for cafe in results.cafes],
+        total=results.total,
+        page=results.page,
+    )
+
+
+@app.get('/api/cafes/nearby')
+def cafes_nearby():
+    """
+    Find cafes near a point. Given ?lat=37.79&lng=-122.40&radius=2 (km),
+    return JSON like {"cafes": [{"id": 1, ..., "distance_km": 0.4}, ...]},
+    nearest first.
+    """
+
+    if not g.user:
+        return jsonify({"error": "Not logged in"}), 401
+
+    lat = request.args.get('lat', type=float)
+    lng = request.args.get('lng', type=float)
+    radius = request.args.get('radius', 2.0, type=float)
+
+    if lat is None or lng is None or not (-90 <= lat <= 90
+                                          and -180 <= lng <= 180):
+        return jsonify({"error": "Invalid lat/lng"}), 400
+
+    if not 0 < radius <= app.config['MAX_NEARBY_RADIUS_KM']:
+        return jsonify({"error": "Invalid radius"}), 400
+
+    nearby = Cafe.find_nearby(lat, lng, radius)
+
+    return jsonify(cafes=[
+        {**cafe.to_dict(), "distance_km": round(distance, 3)}
+        for cafe, distance in nearby
+    ])
+
+
+def parse_cafe_api_args():
+    """Return (fields, include) asked for by ?fields= & ?include=."""
+
+    fields = parse_fields(request.args.get('fields'), Cafe.API_FIELDS)
+    include = parse_include(request.args.get('include'), ['city'])
+
+    return fields, include
+
+
+def cafe_api_query(fields, include):
+    """Return query for cafes loading only the columns the response needs."""
+
+    columns = set(fields)
+
+    if 'city' in include:
+        columns.add('city_code')
+
+    return Cafe.query.options(
+        load_only(*[getattr(Cafe, column) for column in columns]))
+
+
+def get_included(cafes, include):
+    """Return {"cities": [...]} for the cities of these cafes.
+
+    Cities come from the city registry, so side-loading them costs at most
+    one query however many cafes there are.
+    """
+
+    included = {}
+
+    if 'city' in include:
+        cities = city_registry.get_cities()
+        codes = sorted({cafe.city_code for cafe in cafes})
+        included['cities'] = [
+            cities[code]._asdict() for code in codes if code in cities]
+
+    return included
+
+
+@app.get('/api/cafes')
+def cafes_api():
+    """
+    List cafes, by id. Return JSON like
+    {"cafes": [{"id": 1, "name": ...}, ...], "next_cursor": "..."}
+
+    Takes ?fields=name,address to return just those fields (and id),
+    ?limit=N, ?cursor=... (a next_cursor) for the next page and
+    ?include=city to add {"included": {"cities": [...]}}.
+    """
+
+    if not g.user:
+        return api_response({"error": "Not logged in"}, 401)
+
+    try:
+        fields, include = parse_cafe_api_args()
+    except InvalidArgument as exc:
+        return api_response({"error": str(exc)}, 400)
+
+    limit = request.args.get('limit', app.config['CAFES_PER_PAGE'], type=int)
+
+    if not 0 < limit <= app.config['API_MAX_PAGE_SIZE']:
+        return api_response({"error": "Invalid limit"}, 400)
+
+    page = keyset_page(
+        cafe_api_query(fields, include),
+        [Cafe.id],
+        after=request.args.get('cursor'),
+        limit=limit,
+    )
+
+    payload = {
+        "cafes": [cafe.to_dict(fields) for cafe in page.items],
+        "next_cursor": page.next_cursor,
+    }
+
+    if include:
+        payload["included"] = get_included(page.items, include)
+
+    return api_response(payload)
+
+
+@app.get('/api/cafes/<int:cafe_id>')
+def cafe_api(cafe_id):
+    """
+    Return JSON like {"cafe": {"id": 1, "name": ...}}; takes ?fields= and
+    ?include= like /api/cafes.
+    """
+
+    if not g.user:
+        return api_response({"error": "Not logged in"}, 401)
+
+    try:
+        fields, include = parse_cafe_api_args()
+    except InvalidArgument as exc:
+        return api_response({"error": str(exc)}, 400)
+
+    cafe = cafe_api_query(fields, include).filter_by(id=cafe_id).one_or_none()
+
+    if cafe is None:
+        return api_response({"error": "Not found"}, 404)
+
+    payload = {"cafe": cafe.to_dict(fields)}
+
+    if include:
+        payload["included"] = get_included([cafe], include)
+
+    return api_response(payload)
+
+
 @app.route('/cafes/add', methods=["GET", "POST"])
 def add_cafe():
     """
@@ -224,8 +632,7 @@ def add_cafe():
 
         db.session.add(cafe)
         db.session.flush()
-        cafe.save_cafe_map()
-
+        cafe.refresh_map()
 
         db.session.commit()
 
@@ -252,8 +659,6 @@ def edit_cafe(cafe_id):
         return redirect("/login")
 
     cafe = Cafe.query.get_or_404(cafe_id)
-    old_address = cafe.address
-    old_city = cafe.city_code
 
     form = AddEditCafeForm(obj=cafe)
     form.city_code.choices = City.get_choices()
@@ -261,16 +666,13 @@ def edit_cafe(cafe_id):
     if form.validate_on_submit():
         form.populate_obj(cafe)
 
-        changed_location = (
-            old_address != form.address.data or
-            old_city != form.city_code.data
-            )
-
         if not form.image_url.data:
             cafe.image_url = Cafe.image_url.default.arg
 
-        if changed_location:
-            cafe.save_cafe_map()
+        cafe.bump_version()
+
+        # no-op unless the (normalized) location actually changed
+        cafe.refresh_map()
 
         db.session.commit()
 
@@ -315,7 +717,36 @@ def delete_cafe(cafe_id):
 #########################
 # user profiles
 
+def get_liked_page():
+    """Return first Page of current user's liked cafes (kept on g)."""
+
+    if 'liked_page' not in g:
+        g.liked_page = Like.get_liked_cafes(
+            g.user.id, limit=app.config['LIKED_CAFES_PER_PAGE'])
+
+    return g.liked_page
+
+
+def profile_validators():
+    """ETag parts for profile: the user row and their first liked cafes."""
+
+    if not g.user:
+        return None
+
+    user = db.session.get(User, g.user.id)
+
+    if user is None:
+        return None
+
+    page = get_liked_page()
+    liked = [(cafe.id, cafe.version) for cafe in page.items]
+
+    parts = [user.id, user.updated_at, liked, page.next_cursor]
+    return parts, user.updated_at
+
+
 @app.get('/profile')
+@conditional(profile_validators)
 def display_user_profile():
     """Show user profile page."""
 
@@ -323,7 +754,7 @@ def display_user_profile():
         flash(NOT_LOGGED_IN_MSG, "danger")
         return redirect("/login")
 
-    return render_template('profile/detail.html')
+    return render_template('profile/detail.html', liked=get_liked_page())
 
 
 @app.route('/profile/edit', methods=["POST", "GET"])
@@ -344,6 +775,7 @@ def edit_user():
         g.user.image_url = form.image_url.data or DEFAULT_PROF_IMG_URL
 
         db.session.commit()
+        remember_user(g.user)
 
         flash('Profile edited.')
         return redirect(url_for('display_user_profile'))
@@ -361,20 +793,83 @@ def edit_user():
 @app.get('/api/likes')
 def check_like():
     """
-    Check if current user likes a speficifc cafe,returns
+    Check if current user likes a specific cafe, returns
     JSON like: {"likes": true|false}
+
+    Or, given ?cafe_ids=1,2,3, check many cafes at once, returns
+    JSON like: {"likes": {"1": true, "2": false, "3": false}}
     """
 
     if not g.user:
         return {"error": "Not logged in"}
 
-    cafe_id = request.args.get('cafe_id')
-    cafe = Cafe.query.get_or_404(cafe_id)
+    if 'cafe_ids' in request.args:
+        try:
+            cafe_ids = [
+                int(id) for id in request.args['cafe_ids'].split(',') if id]
+        except ValueError:
+            return jsonify({"error": "Invalid cafe_ids"}), 400
+
+        if len(cafe_ids) > app.config['MAX_LIKE_STATUS_IDS']:
+            return jsonify({"error": "Too many cafe_ids"}), 400
+
+        liked = Like.get_liked_ids(g.user.id, cafe_ids)
+        return jsonify(likes={str(id): id in liked for id in cafe_ids})
+
+    cafe_id = request.args.get('cafe_id', type=int)
 
-    status = cafe in g.user.liked_cafes
+    if cafe_id is None:
+        return jsonify({"error": "Invalid cafe_id"}), 400
+
+    status = db.session.get(Like, (g.user.id, cafe_id)) is not None
     return jsonify(likes=status)
 
 
+def get_json_cafe_id():
+    """Return the int cafe_id from the request's JSON body, or None."""
+
+    data = request.get_json(silent=True)
+
+    if not isinstance(data, dict):
+        return None
+
+    cafe_id = data.get('cafe_id')
+
+    # bool is an int too, but never a cafe id
+    if not isinstance(cafe_id, int) or isinstance(cafe_id, bool):
+        return None
+
+    return cafe_id
+
+
+@app.post('/api/likes/toggle')
+def toggle_like():
+    """
+    Given JSON like {"cafe_id": 1}, flip whether the current user likes
+    that cafe. Return JSON like {"cafe_id": 1, "liked": true}.
+    """
+
+    if not g.user:
+        return jsonify({"error": "Not logged in"})
+
+    cafe_id = get_json_cafe_id()
+
+    if cafe_id is None:
+        return jsonify({"error": "Invalid cafe_id"}), 400
+
+    try:
+        liked = Like.toggle(g.user.id, cafe_id)
+        db.session.commit()
+
+    except IntegrityError:
+        # no such cafe, or a concurrent request liked it first
+        db.session.rollback()
+        Cafe.query.get_or_404(cafe_id)
+        liked = True
+
+    return jsonify(cafe_id=cafe_id, liked=liked)
+
+
 @app.post('/api/like')
 def like_cafe():
     """
@@ -385,10 +880,13 @@ def like_cafe():
     if not g.user:
         return {"error": "Not logged in"}
 
-    cafe_id = request.json["cafe_id"]
+    cafe_id = get_json_cafe_id()
+
+    if cafe_id is None:
+        return jsonify({"error": "Invalid cafe_id"}), 400
     cafe = Cafe.query.get_or_404(cafe_id)
 
-    g.user.liked_cafes.append(cafe)
+    Like.add(g.user.id, cafe.id)
 
     db.session.commit()
 
@@ -404,14 +902,107 @@ def unlike_cafe():
     if not g.user:
         return jsonify({"error": "Not logged in"})
 
-    cafe_id = request.json["cafe_id"]
-    like = Like.query.get_or_404((g.user.id, cafe_id))
+    cafe_id = get_json_cafe_id()
+
+    if cafe_id is None:
+        return jsonify({"error": "Invalid cafe_id"}), 400
+
+    if not Like.remove(g.user.id, cafe_id):
+        abort(404)
 
-    db.session.delete(like)
     db.session.commit()
 
     return jsonify(unliked=cafe_id)
 
+@app.get('/api/users/me/likes')
+def my_liked_cafes():
+    """
+    List cafes the current user likes, by id. Return JSON like
+    {"cafes": [{"id": 1, "name": ...}, ...], "next_cursor": "..."}
+
+    Takes ?cursor=... (a next_cursor) for the next page and ?fields= like
+    /api/cafes.
+    """
+
+    if not g.user:
+        return api_response({"error": "Not logged in"}, 401)
+
+    try:
+        fields = parse_fields(request.args.get('fields'), Cafe.API_FIELDS)
+    except InvalidArgument as exc:
+        return api_response({"error": str(exc)}, 400)
+
+    page = Like.get_liked_cafes(
+        g.user.id,
+        after=request.args.get('cursor'),
+        limit=app.config['LIKED_CAFES_PER_PAGE'],
+    )
+
+    return api_response({
+        "cafes": [cafe.to_dict(fields) for cafe in page.items],
+        "next_cursor": page.next_cursor,
+    })
+
+#########################
+# background jobs
+
+@app.get('/api/jobs/<int:job_id>')
+def job_status(job_id):
+    """
+    Return status of a map job as JSON like
+    {"job": {"id": 1, "cafe_id": 1, "status": "done", ...}}
+    """
+
+    if not g.user or not g.user.admin:
+        return jsonify({"error": "Unauthorized"}), 403
+
+    job = MapJob.query.get_or_404(job_id)
+
+    return jsonify(job=job.to_dict())
+
+#####################
+# admin
+
+@app.get('/admin/db-stats')
+def db_stats_page():
+    """Show database pool status and per-request timings (admin only)."""
+
+    if not g.user or not g.user.admin:
+        flash("Unauthorized", "danger")
+        return redirect("/")
+
+    return render_template(
+        'admin/db-stats.html',
+        pool=get_pool_status(db.engine.pool),
+        stats=pool_stats.as_dict(),
+    )
+
+#####################
+# exports
+
+@app.get('/admin/export/<table>')
+def export_table(table):
+    """
+    Stream a dump of cafes, users (without passwords) or likes, as
+    ?format=ndjson (the default) or csv.
+    """
+
+    if not g.user or not g.user.admin:
+        return jsonify({"error": "Unauthorized"}), 403
+
+    format = request.args.get('format', 'ndjson')
+
+    if table not in exports.EXPORTS or format not in exports.FORMATS:
+        abort(404)
+
+    return Response(
+        stream_with_context(exports.export(table, format)),
+        mimetype=exports.FORMATS[format],
+        headers={
+            "Content-Disposition": f'attachment; filename="{table}.{format}"',
+        },
+    )
+
 #####################
 # errors
 
@@ -0,0 +1,437 @@
+"""ASGI entry point for Flask Cafe: `uvicorn asgi:app`.
+
+app.py's Flask app stays the WSGI entry point (gunicorn app:app); this
+serves the same site under an ASGI server. The like API, which pages call
+often and which only runs a few tiny queries, has native async handlers
+on SQLAlchemy's asyncio engine (asyncpg, or aiosqlite for SQLite), so one
+process can hold many concurrent like requests without a thread each:
+
+- GET /api/likes
+- POST /api/likes/toggle
+- POST /api/like
+- POST /api/unlike
+
+Everything else goes to the Flask app through asgiref's WsgiToAsgi
+adapter (a thread per request, as under WSGI). That includes the cafe
+list and cafe detail pages: they are not async views. They're built from
+templates, the fragment cache and ETag checks, which all run in Flask,
+and most are answered from the cache without waiting on the database, so
+they stay synchronous behind the adapter.
+
+The async handlers read the user from Flask's signed session cookie,
+check the user still exists (as auth.get_current_user does), and answer
+like the Flask views do. Config (database, pool size, replicas) comes
+from the Flask app.
+"""
+
+import json
+import time
+from datetime import datetime, timezone
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qsl
+
+from asgiref.wsgi import WsgiToAsgi
+from itsdangerous import BadSignature
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine
+from werkzeug.http import dump_cookie
+
+from api import dumps
+from app import app as flask_app
+from auth import CURR_USER_KEY
+from models import Cafe, Like, User
+from routing import PRIMARY_UNTIL_KEY
+
+
+# async DBAPI driver to use for each database
+ASYNC_DRIVERS = {
+    'postgresql': 'asyncpg',
+    'sqlite': 'aiosqlite',
+}
+
+
+def get_async_url(url):
+    """Return database url using its dialect's async driver."""
+
+    url = make_url(url)
+    backend = url.get_backend_name()
+
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver for {backend}")
+
+    return url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+
+
+def get_async_engine_options(config):
+    """Return create_async_engine options for the DB_* settings in config
+    (see dbstats.get_engine_options)."""
+
+    if config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        return {}
+
+    options = {
+        "pool_size": config['DB_POOL_SIZE'],
+        "max_overflow": config['DB_MAX_OVERFLOW'],
+        "pool_timeout": config['DB_POOL_TIMEOUT'],
+        "pool_recycle": config['DB_POOL_RECYCLE'],
+        "pool_pre_ping": config['DB_POOL_PRE_PING'],
+    }
+
+    if config['DB_STATEMENT_TIMEOUT_MS']:
+        options["connect_args"] = {"server_settings": {
+            "statement_timeout": str(config['DB_STATEMENT_TIMEOUT_MS']),
+        }}
+
+    return options
+
+
+class Request:
+    """The parts of an ASGI HTTP request the handlers use."""
+
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = dict(parse_qsl(scope.get('query_string', b'').decode()))
+        self.headers = {
+            name.decode('latin-1'): value.decode('latin-1')
+            for name, value in scope.get('headers', [])}
+        self.body = body
+
+        cookie = SimpleCookie()
+        cookie.load(self.headers.get('cookie', ''))
+        self.cookies = {name: morsel.value for name, morsel in cookie.items()}
+
+    def get_json(self):
+        """Return body parsed as JSON, or None if it isn't JSON."""
+
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+
+class Response:
+    """JSON response, with any extra headers."""
+
+    def __init__(self, payload, status=200, headers=()):
+        self.payload = payload
+        self.status = status
+        self.headers = list(headers)
+
+    async def send(self, send):
+        body = dumps(self.payload)
+
+        await send({
+            'type': 'http.response.start',
+            'status': self.status,
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(body)).encode()),
+                *[(name.encode('latin-1'), value.encode('latin-1'))
+                  for name, value in self.headers],
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+
+NOT_LOGGED_IN = {"error": "Not logged in"}
+
+
+class CafeAsgi:
+    """ASGI app: the like API natively, everything else via Flask."""
+
+    def __init__(self, flask_app, database_url=None):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.database_url = (
+            database_url or flask_app.config['SQLALCHEMY_DATABASE_URI'])
+        self.engine = None
+
+        self.routes = {
+            ('GET', '/api/likes'): self.check_like,
+            ('POST', '/api/likes/toggle'): self.toggle_like,
+            ('POST', '/api/like'): self.like_cafe,
+            ('POST', '/api/unlike'): self.unlike_cafe,
+        }
+
+    def get_engine(self):
+        """Return the async engine, creating it on first use."""
+
+        if self.engine is None:
+            self.engine = create_async_engine(
+                get_async_url(self.database_url),
+                **get_async_engine_options(self.flask_app.config))
+
+        return self.engine
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        handler = None
+        if scope['type'] == 'http':
+            handler = self.routes.get((scope['method'], scope['path']))
+
+        if handler is None:
+            await self.wsgi(scope, receive, send)
+            return
+
+        request = Request(scope, await read_body(receive))
+        response = await handler(request)
+        await response.send(send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+
+            if message['type'] == 'lifespan.startup':
+                self.get_engine()
+                await send({'type': 'lifespan.startup.complete'})
+
+            elif message['type'] == 'lifespan.shutdown':
+                if self.engine is not None:
+                    await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    #######################################
+    # sessions
+
+    def _serializer(self):
+        return self.flask_app.session_interface.get_signing_serializer(
+            self.flask_app)
+
+    def get_session(self, request):
+        """Return the Flask session (a dict) from request's cookie."""
+
+        name = self.flask_app.config['SESSION_COOKIE_NAME']
+        value = request.cookies.get(name)
+
+        if not value:
+            return {}
+
+        max_age = int(
+            self.flask_app.permanent_session_lifetime.total_seconds())
+
+        try:
+            return self._serializer().loads(value, max_age=max_age)
+        except BadSignature:
+            return {}
+
+    async def get_user_id(self, request):
+        """Return logged-in user's id, or None if not logged in or the
+        user has been deleted since."""
+
+        user_id = self.get_session(request).get(CURR_USER_KEY)
+
+        if user_id is None:
+            return None
+
+        async with self.get_engine().connect() as connection:
+            return await connection.scalar(
+                select(User.id).where(User.id == user_id))
+
+    def remember_write(self, request):
+        """Return headers sending this user's reads to the primary for a
+        while (like ReplicaRouter does after Flask requests that write)."""
+
+        router = self.flask_app.extensions.get('db_replicas')
+
+        if router is None or not router.bind_keys or not router.sticky_seconds:
+            return []
+
+        session = self.get_session(request)
+        session[PRIMARY_UNTIL_KEY] = time.time() + router.sticky_seconds
+
+        interface = self.flask_app.session_interface
+        app = self.flask_app
+        expires = None
+
+        if session.get('_permanent'):
+            expires = (datetime.now(timezone.utc)
+                       + app.permanent_session_lifetime)
+
+        return [('set-cookie', dump_cookie(
+            app.config['SESSION_COOKIE_NAME'],
+            self._serializer().dumps(session),
+            expires=expires,
+            domain=interface.get_cookie_domain(app),
+            path=interface.get_cookie_path(app),
+            secure=interface.get_cookie_secure(app),
+            httponly=interface.get_cookie_httponly(app),
+            samesite=interface.get_cookie_samesite(app),
+        ))]
+
+    #######################################
+    # likes (see the views of the same names in app.py)
+
+    async def check_like(self, request):
+        user_id = await self.get_user_id(request)
+
+        if user_id is None:
+            return Response(NOT_LOGGED_IN)
+
+        if 'cafe_ids' in request.args:
+            try:
+                cafe_ids = [int(id)
+                            for id in request.args['cafe_ids'].split(',') if id]
+            except ValueError:
+                return Response({"error": "Invalid cafe_ids"}, 400)
+
+            if len(cafe_ids) > self.flask_app.config['MAX_LIKE_STATUS_IDS']:
+                return Response({"error": "Too many cafe_ids"}, 400)
+
+            async with self.get_engine().connect() as connection:
+                liked = set(await connection.scalars(
+                    select(Like.cafe_id).where(Like.user_id == user_id,
+                                               Like.cafe_id.in_(cafe_ids))))
+
+            return Response(
+                {"likes": {str(id): id in liked for id in cafe_ids}})
+
+        try:
+            cafe_id = int(request.args['cafe_id'])
+        except (KeyError, ValueError):
+            return Response({"error": "Invalid cafe_id"}, 400)
+
+        async with self.get_engine().connect() as connection:
+            status = await connection.scalar(
+                select(Like.cafe_id).where(Like.user_id == user_id,
+                                           Like.cafe_id == cafe_id))
+
+        return Response({"likes": status is not None})
+
+    def _get_cafe_id(self, request):
+        data = request.get_json()
+
+        if not isinstance(data, dict):
+            return None
+
+        cafe_id = data.get('cafe_id')
+
+        # bool is an int too, but never a cafe id
+        if not isinstance(cafe_id, int) or isinstance(cafe_id, bool):
+            return None
+
+        return cafe_id
+
+    async def _cafe_exists(self, cafe_id):
+        async with self.get_engine().connect() as connection:
+            return await connection.scalar(
+                select(Cafe.id).where(Cafe.id == cafe_id)) is not None
+
+    async def toggle_like(self, request):
+        user_id = await self.get_user_id(request)
+
+        if user_id is None:
+            return Response(NOT_LOGGED_IN)
+
+        cafe_id = self._get_cafe_id(request)
+
+        if cafe_id is None:
+            return Response({"error": "Invalid cafe_id"}, 400)
+
+        try:
+            async with self.get_engine().begin() as connection:
+                deleted = (await connection.execute(
+                    Like.delete_statement(user_id, cafe_id))).rowcount
+
+                if deleted:
+                    liked = False
+                    await connection.execute(
+                        Like.count_change_statement(cafe_id, -1))
+                else:
+                    liked = True
+                    await connection.execute(
+                        Like.insert_statement(user_id, cafe_id))
+                    await connection.execute(
+                        Like.count_change_statement(cafe_id, 1))
+
+        except IntegrityError:
+            # a concurrent request liked it first, or the cafe (or user)
+            # is gone
+            if not await self._cafe_exists(cafe_id):
+                return Response({"error": "Not found"}, 404)
+
+            async with self.get_engine().connect() as connection:
+                like = await connection.scalar(
+                    select(Like.cafe_id).where(Like.user_id == user_id,
+                                               Like.cafe_id == cafe_id))
+
+            if like is None:
+                return Response(NOT_LOGGED_IN)
+
+            liked = True
+
+        return Response({"cafe_id": cafe_id, "liked": liked},
+                        headers=self.remember_write(request))
+
+    async def like_cafe(self, request):
+        user_id = await self.get_user_id(request)
+
+        if user_id is None:
+            return Response(NOT_LOGGED_IN)
+
+        cafe_id = self._get_cafe_id(request)
+
+        if cafe_id is None:
+            return Response({"error": "Invalid cafe_id"}, 400)
+
+        if not await self._cafe_exists(cafe_id):
+            return Response({"error": "Not found"}, 404)
+
+        try:
+            async with self.get_engine().begin() as connection:
+                await connection.execute(
+                    Like.insert_statement(user_id, cafe_id))
+                await connection.execute(
+                    Like.count_change_statement(cafe_id, 1))
+        except IntegrityError:
+            return Response({"error": "Already liked"}, 409)
+
+        return Response({"liked": cafe_id},
+                        headers=self.remember_write(request))
+
+    async def unlike_cafe(self, request):
+        user_id = await self.get_user_id(request)
+
+        if user_id is None:
+            return Response(NOT_LOGGED_IN)
+
+        cafe_id = self._get_cafe_id(request)
+
+        if cafe_id is None:
+            return Response({"error": "Invalid cafe_id"}, 400)
+
+        async with self.get_engine().begin() as connection:
+            deleted = (await connection.execute(
+                Like.delete_statement(user_id, cafe_id))).rowcount
+
+            if deleted:
+                await connection.execute(
+                    Like.count_change_statement(cafe_id, -1))
+
+        if not deleted:
+            return Response({"error": "Not found"}, 404)
+
+        return Response({"unliked": cafe_id},
+                        headers=self.remember_write(request))
+
+
+async def read_body(receive):
+    """Return the whole body of an ASGI HTTP request."""
+
+    body = b''
+
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+
+        if not message.get('more_body'):
+            return body
+
+
+app = CafeAsgi(flask_app)
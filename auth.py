@@ -0,0 +1,186 @@
+"""Current-user handling for Flask Cafe.
+
+Besides the user's id, the (signed) session cookie holds a snapshot of the
+user fields most pages need, so most requests never load the user row from
+the database. Anything else loads the full row on first use.
+
+The snapshot is stamped with the user's updated_at. Every
+USER_SNAPSHOT_TTL seconds a request re-checks that stamp (one
+single-column query by primary key), so a snapshot is dropped within that
+long of the user being changed (e.g. demoted or renamed) or deleted;
+requests in between don't touch the database at all.
+"""
+
+import time
+from datetime import timezone
+
+from flask import current_app, session, abort
+
+from models import db, User
+
+
+CURR_USER_KEY = "curr_user"
+CURR_USER_SNAPSHOT_KEY = "curr_user_snapshot"
+CURR_USER_CHECKED_KEY = "curr_user_checked_at"
+
+# bump when SNAPSHOT_FIELDS changes, so old cookies get rebuilt
+SNAPSHOT_VERSION = 2
+SNAPSHOT_FIELDS = (
+    'id',
+    'username',
+    'admin',
+    'first_name',
+    'last_name',
+    'image_url',
+)
+
+
+def get_stamp(updated_at):
+    """Return user's updated_at as an int (microseconds), for snapshots."""
+
+    if updated_at.tzinfo is None:
+        updated_at = updated_at.replace(tzinfo=timezone.utc)
+
+    return round(updated_at.timestamp() * 1_000_000)
+
+
+def make_snapshot(user):
+    """Return snapshot dict of user's session fields."""
+
+    snapshot = {field: getattr(user, field) for field in SNAPSHOT_FIELDS}
+    snapshot['v'] = SNAPSHOT_VERSION
+    snapshot['stamp'] = get_stamp(user.updated_at)
+
+    return snapshot
+
+
+def remember_user(user):
+    """Store user (id and snapshot) in session."""
+
+    session[CURR_USER_KEY] = user.id
+    session[CURR_USER_SNAPSHOT_KEY] = make_snapshot(user)
+    session[CURR_USER_CHECKED_KEY] = time.time()
+
+
+def forget_user():
+    """Remove user from session."""
+
+    session.pop(CURR_USER_KEY, None)
+    session.pop(CURR_USER_SNAPSHOT_KEY, None)
+    session.pop(CURR_USER_CHECKED_KEY, None)
+
+
+class SessionUser:
+    """Stand-in for the logged-in User.
+
+    Snapshot fields are answered from the session; any other attribute
+    (or setting an attribute) loads the User row, which from then on is
+    used for everything.
+    """
+
+    def __init__(self, snapshot, user=None):
+        object.__setattr__(self, '_snapshot', snapshot)
+        object.__setattr__(self, '_user', user)
+
+    def __repr__(self):
+        return f"<SessionUser #{self._snapshot['id']}>"
+
+    def _load(self):
+        """Return full User row, loading it if needed."""
+
+        if self._user is None:
+            user = db.session.get(User, self._snapshot['id'])
+
+            if user is None:
+                # deleted since they logged in
+                forget_user()
+                abort(401)
+
+            object.__setattr__(self, '_user', user)
+
+        return self._user
+
+    @property
+    def snapshot(self):
+        """Session snapshot this user was made from."""
+
+        return self._snapshot
+
+    @property
+    def is_loaded(self):
+        """Has the full User row been loaded?"""
+
+        return self._user is not None
+
+    def get_full_name(self):
+        """returns user's full name"""
+
+        return f"{self.first_name} {self.last_name}"
+
+    def __getattr__(self, name):
+        if self._user is None and name in self._snapshot:
+            return self._snapshot[name]
+
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+
+def get_current_user():
+    """Return SessionUser for logged-in user, or None.
+
+    With a current snapshot checked less than USER_SNAPSHOT_TTL seconds
+    ago, there's no query at all; after that, only the user's updated_at
+    is queried. The full row is loaded if the session has no snapshot
+    (e.g. for sessions created before snapshots existed) or the user
+    changed since it was taken.
+    """
+
+    user_id = session.get(CURR_USER_KEY)
+
+    if user_id is None:
+        return None
+
+    snapshot = session.get(CURR_USER_SNAPSHOT_KEY)
+
+    if (snapshot and snapshot.get('v') == SNAPSHOT_VERSION
+            and snapshot.get('id') == user_id):
+        ttl = current_app.config.get('USER_SNAPSHOT_TTL', 30)
+        now = time.time()
+
+        if now - session.get(CURR_USER_CHECKED_KEY, 0) < ttl:
+            return SessionUser(snapshot)
+
+        updated_at = db.session.scalar(
+            db.select(User.updated_at).where(User.id == user_id))
+
+        if updated_at is None:
+            # deleted since they logged in
+            forget_user()
+            return None
+
+        if get_stamp(updated_at) == snapshot.get('stamp'):
+            session[CURR_USER_CHECKED_KEY] = now
+            return SessionUser(snapshot)
+
+    user = db.session.get(User, user_id)
+
+    if user is None:
+        forget_user()
+        return None
+
+    remember_user(user)
+    return SessionUser(session[CURR_USER_SNAPSHOT_KEY], user)
+
+
+def refresh_snapshot(current_user):
+    """Update session snapshot if the loaded user no longer matches it."""
+
+    if current_user is None or not current_user.is_loaded:
+        return
+
+    snapshot = make_snapshot(current_user._user)
+
+    if snapshot != current_user.snapshot:
+        session[CURR_USER_SNAPSHOT_KEY] = snapshot
@@ -0,0 +1,495 @@
+"""Command-line commands for Flask Cafe (run with `flask <group> <command>`)."""
+
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask import current_app
+from flask.cli import AppGroup, with_appcontext
+
+import exports
+import imports
+import jobs
+import loadtest
+import migrations
+import passwords
+import synthetic
+from models import db, Cafe, MapJob, Like
+
+
+#######################################
+# background jobs
+
+jobs_cli = AppGroup('jobs', help="Run and inspect background map jobs.")
+
+
+@jobs_cli.command('work')
+@click.option('--once', is_flag=True, help="Run due jobs, then exit.")
+@click.option('--poll-interval', default=2.0, show_default=True,
+              help="Seconds to sleep when there is nothing to do.")
+def jobs_work(once, poll_interval):
+    """Run queued map jobs."""
+
+    if once:
+        count = jobs.run_pending()
+        click.echo(f"Ran {count} job(s).")
+    else:
+        jobs.work(poll_interval)
+
+
+@jobs_cli.command('status')
+def jobs_status():
+    """Show how many jobs are in each status."""
+
+    counts = (
+        db.session.query(MapJob.status, db.func.count())
+        .group_by(MapJob.status)
+        .all()
+    )
+
+    for status, count in sorted(counts):
+        click.echo(f"{status}: {count}")
+
+
+#######################################
+# maps
+
+maps_cli = AppGroup('maps', help="Manage cafe map images.")
+
+
+@maps_cli.command('regenerate')
+@click.option('--city', 'city_code', help="Only cafes in this city code.")
+@click.option('--concurrency', default=8, show_default=True,
+              type=click.IntRange(min=1),
+              help="Max map requests in flight at once.")
+def maps_regenerate(city_code, concurrency):
+    """Re-fetch maps for all cafes in parallel."""
+
+    query = Cafe.query
+    if city_code:
+        query = query.filter_by(city_code=city_code)
+
+    cafes = query.all()
+
+    start = time.perf_counter()
+    failures = Cafe.save_maps(cafes, concurrency=concurrency)
+    db.session.commit()
+    elapsed = time.perf_counter() - start
+
+    done = len(cafes) - len(failures)
+    rate = done / elapsed if elapsed else 0
+
+    for id, exc in failures.items():
+        click.echo(f"cafe {id}: {exc}", err=True)
+
+    click.echo(
+        f"Regenerated {done} map(s) in {elapsed:.2f}s "
+        f"({rate:.1f} maps/s), {len(failures)} failed."
+    )
+
+
+#######################################
+# likes
+
+likes_cli = AppGroup('likes', help="Maintain like data.")
+
+
+@likes_cli.command('reconcile')
+def likes_reconcile():
+    """Recompute cafe like counts from the likes table."""
+
+    fixed = Like.reconcile_counts()
+    db.session.commit()
+
+    click.echo(f"Fixed like_count on {fixed} cafe(s).")
+
+
+#######################################
+# search
+
+search_cli = AppGroup('search', help="Maintain the cafe search index.")
+
+
+@search_cli.command('reindex')
+def search_reindex():
+    """Recompute search data for every cafe."""
+
+    count = Cafe.reindex_search()
+    db.session.commit()
+
+    click.echo(f"Reindexed {count} cafe(s).")
+
+
+#######################################
+# passwords
+
+passwords_cli = AppGroup('passwords', help="Password hashing tools.")
+
+
+@passwords_cli.command('benchmark')
+@click.option('--rounds', default="8,10,12", show_default=True,
+              help="Comma-separated bcrypt costs to try.")
+@click.option('--seconds', default=2.0, show_default=True,
+              help="How long to run each cost.")
+@click.option('--threads', default=4, show_default=True,
+              help="Concurrent simulated logins.")
+def passwords_benchmark(rounds, seconds, threads):
+    """Measure password checks (logins) per second at different costs.
+
+    Uses BCRYPT_POOL_SIZE like the app does, so compare runs with and
+    without a pool.
+    """
+
+    app = current_app._get_current_object()
+
+    def check_for(hashed, deadline):
+        with app.app_context():
+            count = 0
+            while time.perf_counter() < deadline:
+                passwords.check_password(hashed, "benchmark")
+                count += 1
+            return count
+
+    pool_size = app.config.get('BCRYPT_POOL_SIZE', 0)
+    click.echo(f"{threads} thread(s), pool size {pool_size or 'none'}")
+
+    for cost in [int(cost) for cost in rounds.split(',')]:
+        hashed = passwords.hash_password("benchmark", rounds=cost)
+
+        start = time.perf_counter()
+        deadline = start + seconds
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = [executor.submit(check_for, hashed, deadline)
+                       for _ in range(threads)]
+            count = sum(future.result() for future in futures)
+
+        elapsed = time.perf_counter() - start
+        click.echo(f"cost {cost:2}: {count / elapsed:8.1f} logins/s")
+
+
+#######################################
+# exports
+
+
+@click.command('export')
+@click.argument('table', type=click.Choice(list(exports.EXPORTS)))
+@click.option('--format', 'format', default='ndjson', show_default=True,
+              type=click.Choice(list(exports.FORMATS)))
+@click.option('--output', '-o', type=click.File('w'), default='-',
+              help="File to write to (default: stdout).")
+@with_appcontext
+def export_command(table, format, output):
+    """Dump a table (without passwords) for analytics, streaming it."""
+
+    for chunk in exports.export(table, format):
+        output.write(chunk)
+
+
+#######################################
+# imports
+
+import_cli = AppGroup('import', help="Bulk-load data from files.")
+
+
+@import_cli.command('cafes')
+@click.argument('file', type=click.File('r', encoding='UTF-8'))
+@click.option('--format', 'format', type=click.Choice(['csv', 'ndjson']),
+              help="File format (default: from the file's extension).")
+@click.option('--batch-size', default=imports.BATCH_SIZE, show_default=True,
+              type=click.IntRange(min=1),
+              help="Rows written per statement.")
+@click.option('--maps/--no-maps', default=True, show_default=True,
+              help="Fetch maps for new cafes after importing.")
+@click.option('--concurrency', default=8, show_default=True,
+              type=click.IntRange(min=1),
+              help="Max map requests in flight at once.")
+def import_cafes(file, format, batch_size, maps, concurrency):
+    """Add or update cafes from a CSV or NDJSON file.
+
+    Rows need name, address and city_code (and may have description, url
+    and image_url); a row with the same name, address and city as an
+    existing cafe updates it.
+    """
+
+    if format is None:
+        format = 'ndjson' if file.name.endswith(('.ndjson', '.jsonl')) else 'csv'
+
+    start = time.perf_counter()
+    report = imports.import_cafes(
+        imports.read_rows(file, format), batch_size=batch_size)
+    elapsed = time.perf_counter() - start
+
+    for line, message in report.errors:
+        click.echo(f"line {line}: {message}", err=True)
+
+    rate = report.imported / elapsed if elapsed else 0
+    click.echo(
+        f"Imported {report.imported} cafe(s) ({report.inserted} new, "
+        f"{report.updated} updated) in {elapsed:.2f}s ({rate:.1f} rows/s), "
+        f"{len(report.errors)} row(s) with errors."
+    )
+
+    if not maps or not report.new_ids:
+        return
+
+    start = time.perf_counter()
+    failures = imports.generate_maps(report.new_ids, concurrency=concurrency)
+    elapsed = time.perf_counter() - start
+
+    for id, exc in failures.items():
+        click.echo(f"cafe {id}: {exc}", err=True)
+
+    done = len(report.new_ids) - len(failures)
+    rate = done / elapsed if elapsed else 0
+    click.echo(
+        f"Fetched {done} map(s) in {elapsed:.2f}s "
+        f"({rate:.1f} maps/s), {len(failures)} failed."
+    )
+
+
+#######################################
+# schema migrations
+
+db_cli = AppGroup('db', help="Manage the database schema.")
+
+
+@db_cli.command('upgrade')
+@click.option('--dry-run', is_flag=True,
+              help="List what would run, and the locks it would take.")
+@click.option('--batch-size', type=int,
+              help="Rows per backfill transaction.")
+@click.option('--pause', type=float,
+              help="Seconds to sleep between backfill batches.")
+def db_upgrade(dry_run, batch_size, pause):
+    """Apply pending schema migrations."""
+
+    if dry_run:
+        steps = migrations.plan()
+
+        for migration, ops in steps:
+            click.echo(f"{migration.version}: {migration.description}")
+
+            for statement, impact in ops:
+                click.echo(f"  {statement}")
+                click.echo(f"    lock: {impact}")
+
+        if not steps:
+            click.echo("Database is up to date.")
+
+        return
+
+    options = migrations.Options(
+        lock_timeout_ms=current_app.config['MIGRATION_LOCK_TIMEOUT_MS'],
+        batch_size=batch_size,
+        pause=pause,
+        log=click.echo,
+    )
+    applied = migrations.upgrade(options=options)
+
+    for migration in applied:
+        click.echo(f"Applied {migration.version}: {migration.description}")
+
+    if not applied:
+        click.echo("Database is up to date.")
+
+
+@db_cli.command('status')
+def db_status():
+    """List schema migrations not yet applied."""
+
+    pending = migrations.get_pending()
+
+    for migration in pending:
+        click.echo(f"Pending {migration.version}: {migration.description}")
+
+    if not pending:
+        click.echo("Database is up to date.")
+
+
+#######################################
+# synthetic data
+
+seed_cli = AppGroup('seed', help="Add data to the database.")
+
+
+@seed_cli.command('synthetic')
+@click.option('--cities', default=10, show_default=True,
+              type=click.IntRange(min=0))
+@click.option('--cafes', default=1000, show_default=True,
+              type=click.IntRange(min=0))
+@click.option('--users', default=1000, show_default=True,
+              type=click.IntRange(min=0))
+@click.option('--likes-per-user', default=10, show_default=True,
+              type=click.IntRange(min=0))
+@click.option('--seed', default=0, show_default=True,
+              help="Same seed, same data.")
+@click.option('--password', default="secret", show_default=True,
+              help="Password every user gets.")
+@click.option('--batch-size', default=synthetic.BATCH_SIZE,
+              show_default=True, type=click.IntRange(min=1),
+              help="Rows per INSERT.")
+def seed_synthetic(cities, cafes, users, likes_per_user, seed, password,
+                   batch_size):
+    """Add lots of made-up cities, cafes, users and likes."""
+
+    start = time.perf_counter()
+
+    counts = synthetic.generate(
+        cities, cafes, users, likes_per_user, seed=seed, password=password,
+        batch_size=batch_size, log=click.echo)
+
+    elapsed = time.perf_counter() - start
+    rows = sum(counts.values())
+
+    click.echo(
+        f"Added {counts['cities']} cities, {counts['cafes']} cafes, "
+        f"{counts['users']} users and {counts['likes']} likes in "
+        f"{elapsed:.1f}s ({rows / elapsed:.0f} rows/s).")
+
+
+#######################################
+# load testing
+
+loadtest_cli = AppGroup(
+    'loadtest', help="Measure latency & throughput under load.")
+
+
+def _loadtest_options(command):
+    """Options shared by the loadtest commands."""
+
+    options = [
+        click.option('--url',
+                     help="Server to test, e.g. http://localhost:8000 "
+                          "(default: this app, in-process)."),
+        click.option('--concurrency', '-c', default=4, show_default=True,
+                     type=click.IntRange(min=1),
+                     help="Simultaneous users."),
+        click.option('--username', envvar='LOADTEST_USERNAME',
+                     help="User to log in as."),
+        click.option('--password', envvar='LOADTEST_PASSWORD'),
+        click.option('--output', '-o', type=click.Path(dir_okay=False),
+                     help="Save the results to this JSON file."),
+        click.option('--baseline', type=click.File(),
+                     help="Earlier results to compare p95s against."),
+        click.option('--max-regression', default=0.2, show_default=True,
+                     help="Fail if a p95 grew by more than this fraction."),
+        click.option('--seed', default=0, show_default=True),
+    ]
+
+    for option in reversed(options):
+        command = option(command)
+
+    return command
+
+
+def _make_client_factory(url):
+    if url:
+        return lambda: loadtest.HttpClient(url)
+
+    app = current_app._get_current_object()
+    return lambda: loadtest.AppClient(app)
+
+
+def _report_results(results, output, baseline, max_regression):
+    """Print results table; save & compare them; exit 1 on regression."""
+
+    click.echo(
+        f"{'endpoint':<42} {'count':>7} {'err':>5} {'rps':>8} "
+        f"{'p50':>8} {'p95':>8} {'p99':>8}")
+
+    for endpoint, stats in results["endpoints"].items():
+        click.echo(
+            f"{endpoint:<42} {stats['count']:>7} {stats['errors']:>5} "
+            f"{stats['rps']:>8.1f} {stats['p50_ms']:>8.1f} "
+            f"{stats['p95_ms']:>8.1f} {stats['p99_ms']:>8.1f}")
+
+    if output:
+        with open(output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+        click.echo(f"Saved results to {output}.")
+
+    if baseline:
+        regressions = loadtest.compare(
+            json.load(baseline), results, max_regression)
+
+        for endpoint, before, after in regressions:
+            click.echo(
+                f"REGRESSION {endpoint}: p95 {before:.1f}ms -> {after:.1f}ms",
+                err=True)
+
+        if regressions:
+            click.get_current_context().exit(1)
+
+
+@loadtest_cli.command('run')
+@_loadtest_options
+@click.option('--scenario', '-s', 'scenarios', multiple=True,
+              metavar='NAME[=WEIGHT]',
+              help=f"Scenario to run: {', '.join(loadtest.SCENARIOS)} "
+                   f"(repeatable; default: a mix of all but admin_edit).")
+@click.option('--duration', type=float,
+              help="Seconds to run for.")
+@click.option('--iterations', type=int,
+              help="Scenarios per user (instead of --duration).")
+@click.option('--admin-username', envvar='LOADTEST_ADMIN_USERNAME',
+              help="Admin to log in as, for admin_edit.")
+@click.option('--admin-password', envvar='LOADTEST_ADMIN_PASSWORD')
+def loadtest_run(url, concurrency, username, password, output, baseline,
+                 max_regression, seed, scenarios, duration, iterations,
+                 admin_username, admin_password):
+    """Run user scenarios against the site."""
+
+    mix = {}
+
+    for scenario in scenarios:
+        name, _, weight = scenario.partition('=')
+
+        if name not in loadtest.SCENARIOS:
+            raise click.BadParameter(
+                f"Unknown scenario: {name}", param_hint='--scenario')
+
+        mix[name] = float(weight or 1)
+
+    if duration is None and iterations is None:
+        duration = 30
+
+    results = loadtest.run(
+        _make_client_factory(url),
+        current_app.url_map,
+        mix or loadtest.DEFAULT_MIX,
+        {
+            "username": username,
+            "password": password,
+            "admin_username": admin_username,
+            "admin_password": admin_password,
+        },
+        concurrency=concurrency,
+        duration=duration,
+        iterations=iterations,
+        seed=seed,
+    )
+
+    _report_results(results, output, baseline, max_regression)
+
+
+@loadtest_cli.command('replay')
+@_loadtest_options
+@click.argument('log', type=click.File())
+def loadtest_replay(url, concurrency, username, password, output, baseline,
+                    max_regression, seed, log):
+    """Replay a request log (recorded with REQUEST_LOG_PATH), as fast as
+    the users can go."""
+
+    results = loadtest.replay(
+        _make_client_factory(url),
+        current_app.url_map,
+        loadtest.read_log(log),
+        {"username": username, "password": password},
+        concurrency=concurrency,
+        seed=seed,
+    )
+
+    _report_results(results, output, baseline, max_regression)
@@ -0,0 +1,108 @@
+"""Conditional GET (ETag / Last-Modified) support for Flask Cafe views."""
+
+import hashlib
+import os
+import time
+from datetime import timezone
+from functools import wraps
+
+from flask import current_app, request, session, g, make_response
+
+
+def get_templates_version(template_dir):
+    """Return a stamp that changes whenever a template file changes.
+
+    Mixed into every ETag, so a deploy with new markup doesn't keep
+    answering 304 for pages rendered by the old templates.
+    """
+
+    mtimes = [
+        os.path.getmtime(os.path.join(root, name))
+        for root, dirs, files in os.walk(template_dir)
+        for name in files
+    ]
+
+    return str(max(mtimes, default=0))
+
+
+def _as_utc(dt):
+    """Return dt as an aware UTC datetime, truncated to seconds."""
+
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+
+    return dt.astimezone(timezone.utc).replace(microsecond=0)
+
+
+def _page_parts():
+    """ETag parts shared by every page: markup version, user and CSRF."""
+
+    user = g.get('user')
+    user_parts = user.snapshot if user is not None else None
+
+    # pages embed CSRF tokens that expire after WTF_CSRF_TIME_LIMIT, so
+    # never answer 304 with a page whose token is older than half of that
+    csrf_limit = current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600
+    csrf_bucket = int(time.time() // (csrf_limit / 2))
+
+    return [
+        current_app.config.get('ETAG_SALT', ''),
+        sorted(user_parts.items()) if user_parts else None,
+        session.get('csrf_token'),
+        csrf_bucket,
+    ]
+
+
+def conditional(get_validators):
+    """Decorate a GET view so repeat visits can be answered with 304.
+
+    get_validators is called with the view's arguments, before the view,
+    and returns (etag_parts, last_modified) or None to skip the check
+    (e.g. when not logged in). etag_parts must change whenever the page
+    would; it should be cheap to compute compared to rendering the page.
+    """
+
+    def decorator(view):
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+
+            # pages with flashed messages are one-offs; don't validate them
+            if request.method != 'GET' or session.get('_flashes'):
+                return view(*args, **kwargs)
+
+            validators = get_validators(*args, **kwargs)
+
+            if validators is None:
+                return view(*args, **kwargs)
+
+            parts, last_modified = validators
+            raw = repr([_page_parts(), parts]).encode('UTF-8')
+            etag = hashlib.sha1(raw).hexdigest()
+
+            if last_modified is not None:
+                last_modified = _as_utc(last_modified)
+
+            # Last-Modified is sent for clients' information, but only the
+            # ETag covers the user & CSRF parts, so only it can earn a 304
+            if request.if_none_match.contains_weak(etag):
+                resp = make_response('', 304)
+            else:
+                resp = make_response(view(*args, **kwargs))
+
+                if resp.status_code != 200:
+                    return resp
+
+            resp.set_etag(etag, weak=True)
+            resp.last_modified = last_modified
+
+            # per-user pages: browsers may keep them, but must revalidate
+            resp.cache_control.private = True
+            resp.cache_control.no_cache = True
+            resp.vary.add('Cookie')
+
+            return resp
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,312 @@
+"""Database connection pool settings and instrumentation.
+
+Pool sizing comes from DB_* config (see get_engine_options). DbStats then
+measures, for each request, how long it waited to check out connections
+and how many queries it ran in how long; it keeps process-wide totals for
+the /admin/db-stats page and warns about requests that run too many
+queries, or the same query over and over.
+
+count_queries() counts queries the same way for tests.
+"""
+
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+
+def get_engine_options(config):
+    """Return SQLALCHEMY_ENGINE_OPTIONS for the DB_* settings in config.
+
+    SQLite (used for quick test runs) keeps its own pooling; the pool
+    settings only apply to server databases.
+    """
+
+    if config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        return {}
+
+    options = {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": config['DB_POOL_SIZE'],
+        "max_overflow": config['DB_MAX_OVERFLOW'],
+        "pool_timeout": config['DB_POOL_TIMEOUT'],
+        "pool_recycle": config['DB_POOL_RECYCLE'],
+        "pool_pre_ping": config['DB_POOL_PRE_PING'],
+    }
+
+    if config['DB_STATEMENT_TIMEOUT_MS']:
+        options["connect_args"] = {
+            "options": f"-c statement_timeout={config['DB_STATEMENT_TIMEOUT_MS']}",
+        }
+
+    return options
+
+
+class PoolStats:
+    """Process-wide totals of checkout waits and per-request query time."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.checkout_time = 0.0
+            self.max_checkout_time = 0.0
+            self.timeouts = 0
+            self.requests = 0
+            self.queries = 0
+            self.query_time = 0.0
+            self.max_request_query_time = 0.0
+
+    def record_checkout(self, seconds):
+        with self._lock:
+            self.checkouts += 1
+            self.checkout_time += seconds
+            self.max_checkout_time = max(self.max_checkout_time, seconds)
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def record_request(self, queries, query_time):
+        with self._lock:
+            self.requests += 1
+            self.queries += queries
+            self.query_time += query_time
+            self.max_request_query_time = max(
+                self.max_request_query_time, query_time)
+
+    def as_dict(self):
+        """Return totals, and averages in milliseconds."""
+
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "checkout_timeouts": self.timeouts,
+                "avg_checkout_ms": _avg_ms(self.checkout_time, self.checkouts),
+                "max_checkout_ms": self.max_checkout_time * 1000,
+                "requests": self.requests,
+                "avg_queries_per_request": (
+                    self.queries / self.requests if self.requests else 0),
+                "avg_query_ms_per_request": _avg_ms(
+                    self.query_time, self.requests),
+                "max_query_ms_per_request": self.max_request_query_time * 1000,
+            }
+
+
+def _avg_ms(total, count):
+    return total / count * 1000 if count else 0
+
+
+pool_stats = PoolStats()
+
+
+class QueryCounter:
+    """Queries run while counting: how many, their total time and (if
+    tracking statements) how often each distinct statement ran.
+
+    Statements are counted by their SQL text, which has placeholders for
+    parameters, so the same query for different rows counts as a repeat:
+    that's the shape of an N+1.
+    """
+
+    def __init__(self, track_statements=True):
+        self.count = 0
+        self.time = 0.0
+        self.checkout_time = 0.0
+        self.statements = Counter() if track_statements else None
+
+    def record(self, statement, seconds):
+        self.count += 1
+        self.time += seconds
+
+        if self.statements is not None:
+            self.statements[statement] += 1
+
+    def repeated(self, threshold):
+        """Return [(statement, times run)] for statements run at least
+        threshold times, most repeated first."""
+
+        if self.statements is None:
+            return []
+
+        return [(statement, count)
+                for statement, count in self.statements.most_common()
+                if count >= threshold]
+
+
+# counters started by count_queries()
+_active_counters = []
+
+
+@contextmanager
+def count_queries():
+    """Count queries run inside the with block (e.g. in tests):
+
+        with count_queries() as queries:
+            client.get("/cafes")
+        assert queries.count <= 3
+    """
+
+    counter = QueryCounter()
+    _active_counters.append(counter)
+
+    try:
+        yield counter
+    finally:
+        _active_counters.remove(counter)
+
+
+def _get_request_counter():
+    """Return this request's QueryCounter, or None outside a request.
+
+    Statements are only tracked (for N+1 detection) in a sample of
+    requests, DB_QUERY_SAMPLE_RATE of them.
+    """
+
+    if not has_request_context():
+        return None
+
+    if 'db_queries' not in g:
+        rate = current_app.config.get('DB_QUERY_SAMPLE_RATE', 1.0)
+        g.db_queries = QueryCounter(track_statements=random.random() < rate)
+
+    return g.db_queries
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that times every checkout (waiting for a free connection,
+    or opening a new one)."""
+
+    def connect(self):
+        start = time.perf_counter()
+
+        try:
+            connection = super().connect()
+        except PoolTimeoutError:
+            pool_stats.record_timeout()
+            raise
+
+        seconds = time.perf_counter() - start
+        pool_stats.record_checkout(seconds)
+
+        counter = _get_request_counter()
+        if counter is not None:
+            counter.checkout_time += seconds
+
+        return connection
+
+
+def get_pool_status(pool):
+    """Return dict describing how full pool is."""
+
+    if not isinstance(pool, QueuePool):
+        return {"pool": type(pool).__name__}
+
+    capacity = pool.size() + max(pool._max_overflow, 0)
+
+    return {
+        "pool": type(pool).__name__,
+        "size": pool.size(),
+        "max_overflow": pool._max_overflow,
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": pool.overflow(),
+        "saturation": pool.checkedout() / capacity if capacity else 0,
+    }
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    seconds = time.perf_counter() - conn.info['query_start'].pop()
+    counter = _get_request_counter()
+
+    if counter is not None:
+        counter.record(statement, seconds)
+
+    for counter in _active_counters:
+        counter.record(statement, seconds)
+
+
+def _handle_error(context):
+    # failed statements never reach after_cursor_execute
+    if context.connection is not None:
+        starts = context.connection.info.get('query_start')
+        if starts:
+            starts.pop()
+
+
+class DbStats:
+    """Flask extension recording per-request database timings.
+
+    After each request it:
+
+    - adds the request's query count & time to pool_stats
+    - adds a Server-Timing header, if DB_SERVER_TIMING is set
+    - logs a warning if the request ran more than DB_QUERY_BUDGET queries
+    - logs a warning for each statement run DB_REPEATED_QUERY_THRESHOLD or
+      more times (a likely N+1), in sampled requests
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not event.contains(Engine, 'before_cursor_execute',
+                              _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute',
+                         _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute',
+                         _after_cursor_execute)
+            event.listen(Engine, 'handle_error', _handle_error)
+
+        self.logger = app.logger
+        app.after_request(self._record_request)
+        app.extensions['db_stats'] = self
+
+    def _record_request(self, response):
+        counter = g.pop('db_queries', None) or QueryCounter(False)
+        config = current_app.config
+
+        pool_stats.record_request(counter.count, counter.time)
+
+        if config.get('DB_SERVER_TIMING'):
+            response.headers.add(
+                'Server-Timing',
+                f'db;dur={counter.time * 1000:.1f};'
+                f'desc="{counter.count} queries"')
+            response.headers.add(
+                'Server-Timing',
+                f'db-wait;dur={counter.checkout_time * 1000:.1f}')
+
+        budget = config.get('DB_QUERY_BUDGET')
+
+        if budget and counter.count > budget:
+            self.logger.warning(
+                "%s %s ran %d queries (budget %d)",
+                request.method, request.path, counter.count, budget)
+
+        threshold = config.get('DB_REPEATED_QUERY_THRESHOLD', 5)
+
+        for statement, count in counter.repeated(threshold):
+            self.logger.warning(
+                "%s %s ran the same query %d times (N+1?): %s",
+                request.method, request.path, count,
+                ' '.join(statement.split())[:300])
+
+        return response
@@ -0,0 +1,116 @@
+"""Streaming exports of Flask Cafe tables (for analytics).
+
+Rows are read with a server-side cursor (yield_per), a batch at a time,
+and written out as they arrive, so memory stays flat however big the
+table is. Used by `flask export` and the admin /admin/export endpoint.
+"""
+
+import csv
+import io
+import json
+from datetime import datetime
+
+from models import db, Cafe, User, Like
+
+
+# exported columns per table; never add User.password
+EXPORTS = {
+    'cafes': [
+        Cafe.id, Cafe.name, Cafe.description, Cafe.url, Cafe.address,
+        Cafe.city_code, Cafe.image_url, Cafe.latitude, Cafe.longitude,
+        Cafe.like_count, Cafe.updated_at,
+    ],
+    'users': [
+        User.id, User.username, User.admin, User.email, User.first_name,
+        User.last_name, User.description, User.image_url, User.updated_at,
+    ],
+    'likes': [Like.user_id, Like.cafe_id],
+}
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+BATCH_SIZE = 1000
+
+
+def _value(value):
+    """Return value in a form both JSON and CSV can hold."""
+
+    if isinstance(value, datetime):
+        return value.isoformat()
+
+    return value
+
+
+def iter_rows(table, batch_size=BATCH_SIZE):
+    """Yield each row of table (as a tuple), in primary key order."""
+
+    columns = EXPORTS[table]
+    primary_key = [column for column in columns if column.primary_key]
+
+    result = db.session.execute(
+        db.select(*columns)
+        .order_by(*primary_key)
+        .execution_options(yield_per=batch_size)
+    )
+
+    try:
+        for row in result:
+            yield tuple(_value(value) for value in row)
+    finally:
+        # abandoned part way (e.g. client went away): free the cursor
+        result.close()
+
+
+def to_ndjson(names, rows, batch_size=BATCH_SIZE):
+    """Yield lines of JSON objects, one per row, a batch per chunk."""
+
+    lines = []
+
+    for row in rows:
+        lines.append(json.dumps(dict(zip(names, row)), separators=(',', ':')))
+
+        if len(lines) == batch_size:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def to_csv(names, rows, batch_size=BATCH_SIZE):
+    """Yield CSV text: a header line, then rows, a batch per chunk."""
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(names)
+
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def export(table, format):
+    """Yield chunks of text exporting table in format ("ndjson" or "csv")."""
+
+    if table not in EXPORTS:
+        raise ValueError(f"Unknown table: {table}")
+
+    names = [column.key for column in EXPORTS[table]]
+    rows = iter_rows(table)
+
+    if format == 'ndjson':
+        return to_ndjson(names, rows)
+
+    if format == 'csv':
+        return to_csv(names, rows)
+
+    raise ValueError(f"Unknown format: {format}")
@@ -0,0 +1,202 @@
+"""Cache for rendered template fragments (cafe cards, cafe detail body).
+
+Templates wrap a macro call in cached_fragment(name, obj, macro); the
+rendered HTML is stored under name + obj.cache_key, so whenever obj's
+version changes it is simply rendered (and cached) again under a new key.
+
+The backend is picked by FRAGMENT_CACHE_BACKEND:
+
+- "memory": per-process LRU, bounded to FRAGMENT_CACHE_MAX_BYTES
+- "filesystem": files in FRAGMENT_CACHE_DIR, shared by all workers on a
+  host, bounded to about FRAGMENT_CACHE_DIR_MAX_BYTES
+- "null": no caching
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from markupsafe import Markup
+
+
+class NullBackend:
+    """Backend that never caches anything."""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def clear(self):
+        pass
+
+
+class MemoryLRUBackend:
+    """In-process LRU cache bounded by total size of cached strings."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+
+            if value is not None:
+                self._items.move_to_end(key)
+
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+
+            self._items[key] = value
+            self.size += len(value)
+
+            while self.size > self.max_bytes and self._items:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
+class FileSystemBackend:
+    """Cache stored as one file per key in a directory.
+
+    Bounded to about max_bytes: once a tenth of that has been written
+    since the last sweep, the least recently written files are deleted
+    until the rest fit. Fragments for old versions are never written
+    again, so they are the first to go.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._written = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        name = hashlib.sha1(key.encode('UTF-8')).hexdigest()
+        return os.path.join(self.directory, f"{name}.html")
+
+    def get(self, key):
+        try:
+            with open(self._path(key), encoding='UTF-8') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, value):
+        # write then rename, so other workers never read half a fragment
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'w', encoding='UTF-8') as file:
+            file.write(value)
+        os.replace(tmp_path, self._path(key))
+
+        with self._lock:
+            self._written += len(value)
+            sweep = self._written >= self.max_bytes // 10
+
+            if sweep:
+                self._written = 0
+
+        if sweep:
+            self.sweep()
+
+    def sweep(self):
+        """Delete least recently written files until the rest fit in
+        max_bytes; returns the number deleted."""
+
+        files = []
+
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.html'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in files)
+        deleted = 0
+
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # another worker swept it first
+                pass
+
+            total -= size
+            deleted += 1
+
+        return deleted
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.html'):
+                os.remove(os.path.join(self.directory, name))
+
+
+def make_backend(config):
+    """Return the cache backend configured in app config."""
+
+    kind = config.get('FRAGMENT_CACHE_BACKEND', 'memory')
+
+    if kind == 'memory':
+        return MemoryLRUBackend(
+            config.get('FRAGMENT_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+
+    if kind == 'filesystem':
+        return FileSystemBackend(
+            config['FRAGMENT_CACHE_DIR'],
+            config.get('FRAGMENT_CACHE_DIR_MAX_BYTES', 256 * 1024 * 1024))
+
+    if kind == 'null':
+        return NullBackend()
+
+    raise ValueError(f"Unknown FRAGMENT_CACHE_BACKEND: {kind}")
+
+
+class FragmentCache:
+    """Flask extension exposing cached_fragment() to templates."""
+
+    def __init__(self, app=None):
+        self.backend = NullBackend()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.backend = make_backend(app.config)
+        app.extensions['fragment_cache'] = self
+        app.jinja_env.globals['cached_fragment'] = self.render
+
+    def render(self, name, obj, macro):
+        """Return macro(obj) rendered, from cache when possible."""
+
+        key = f"{name}:{obj.cache_key}"
+        html = self.backend.get(key)
+
+        if html is None:
+            html = str(macro(obj))
+            self.backend.set(key, html)
+
+        return Markup(html)
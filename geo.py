@@ -0,0 +1,124 @@
+"""Geometry helpers for finding cafes near a point.
+
+Cafes are bucketed into a grid of CELL_DEGREES x CELL_DEGREES cells; a
+B-tree index on the cell number lets a "near me" query read only the few
+cells overlapping its bounding box, then compute exact distances for that
+small batch.
+"""
+
+import math
+
+
+EARTH_RADIUS_KM = 6371.0
+
+# ~11km of latitude per cell
+CELL_DEGREES = 0.1
+CELLS_PER_ROW = int(360 / CELL_DEGREES)
+ROWS = int(180 / CELL_DEGREES)
+
+
+def _get_row(lat):
+    return min(math.floor((lat + 90) / CELL_DEGREES), ROWS - 1)
+
+
+def _get_col(lng):
+    # lng 180 is the last column, not a wrap back to the first
+    return min(math.floor((lng + 180) / CELL_DEGREES), CELLS_PER_ROW - 1)
+
+
+def get_cell(lat, lng):
+    """Return grid cell number containing (lat, lng)."""
+
+    return _get_row(lat) * CELLS_PER_ROW + _get_col(lng)
+
+
+def get_bounding_box(lat, lng, radius_km):
+    """Return (min_lat, max_lat, min_lng, max_lng) around a circle.
+
+    Longitudes aren't wrapped, so the box can run past +/-180 (see
+    get_lng_ranges); a box spanning 360 degrees covers all longitudes.
+    """
+
+    angle = radius_km / EARTH_RADIUS_KM
+    dlat = math.degrees(angle)
+    min_lat, max_lat = max(lat - dlat, -90), min(lat + dlat, 90)
+
+    # widest longitude on the circle (not radius / cos(lat), which is too
+    # narrow, and much too narrow near the poles)
+    ratio = math.sin(angle) / max(math.cos(math.radians(lat)), 1e-12)
+
+    if ratio >= 1 or min_lat == -90 or max_lat == 90:
+        # the circle takes in a pole, so every longitude
+        dlng = 180
+    else:
+        dlng = math.degrees(math.asin(ratio))
+
+    return (min_lat, max_lat, lng - dlng, lng + dlng)
+
+
+def spans_all_longitudes(box):
+    """Does bounding box cover every longitude?"""
+
+    min_lat, max_lat, min_lng, max_lng = box
+
+    return max_lng - min_lng >= 360
+
+
+def get_lng_ranges(box):
+    """Return [(min_lng, max_lng)] within -180..180 covered by box: one
+    range, or two if the box crosses the antimeridian."""
+
+    min_lat, max_lat, min_lng, max_lng = box
+
+    if spans_all_longitudes(box):
+        return [(-180, 180)]
+
+    if min_lng < -180:
+        return [(min_lng + 360, 180), (-180, max_lng)]
+
+    if max_lng > 180:
+        return [(min_lng, 180), (-180, max_lng - 360)]
+
+    return [(min_lng, max_lng)]
+
+
+def get_covering_cells(box):
+    """Return list of cell numbers overlapping bounding box, or None if
+    it spans all longitudes (filter on latitude alone, rather than list
+    whole rows of cells)."""
+
+    if spans_all_longitudes(box):
+        return None
+
+    min_lat, max_lat, min_lng, max_lng = box
+    rows = range(_get_row(min_lat), _get_row(max_lat) + 1)
+
+    return [
+        row * CELLS_PER_ROW + col
+        for low, high in get_lng_ranges(box)
+        for row in rows
+        for col in range(_get_col(low), _get_col(high) + 1)
+    ]
+
+
+def haversine_km(lat, lng, lats, lngs):
+    """Return great-circle distances (km) from (lat, lng) to many points.
+
+    lats and lngs are equal-length sequences; the point-independent terms
+    are computed once for the whole batch.
+    """
+
+    lat1 = math.radians(lat)
+    lng1 = math.radians(lng)
+    cos_lat1 = math.cos(lat1)
+
+    distances = []
+
+    for lat2, lng2 in zip(lats, lngs):
+        lat2 = math.radians(lat2)
+        a = (math.sin((lat2 - lat1) / 2) ** 2
+             + cos_lat1 * math.cos(lat2)
+             * math.sin((math.radians(lng2) - lng1) / 2) ** 2)
+        distances.append(2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a)))
+
+    return distances
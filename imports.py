@@ -0,0 +1,224 @@
+"""Bulk import of cafes from CSV or NDJSON files.
+
+Rows are checked with the same rules as the add/edit cafe form, then
+written in batches: one query finds which rows already exist, then new
+cafes are inserted and existing ones updated with one executemany each.
+A bad row is reported (with its line number) and skipped; the rest of the
+file still goes in.
+
+Maps aren't fetched while importing; import_cafes returns the ids of new
+cafes so generate_maps can fetch them afterwards, in parallel.
+"""
+
+import csv
+import json
+
+from sqlalchemy import tuple_
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.datastructures import MultiDict
+
+from forms import AddEditCafeForm
+from models import db, Cafe, City
+
+
+# columns read from each row
+FIELDS = ('name', 'description', 'url', 'address', 'city_code', 'image_url')
+
+BATCH_SIZE = 500
+
+
+class ImportReport:
+    """What an import did: counts, per-row errors and cafes needing maps."""
+
+    def __init__(self):
+        self.inserted = 0
+        self.updated = 0
+        self.errors = []
+        self.new_ids = []
+
+    @property
+    def imported(self):
+        return self.inserted + self.updated
+
+    def add_error(self, line, message):
+        self.errors.append((line, message))
+
+
+def read_rows(file, format):
+    """Yield (line number, row) for each row in a csv or ndjson file.
+
+    row is a dict, or a ValueError if the line couldn't be parsed.
+    """
+
+    if format == 'csv':
+        reader = csv.DictReader(file)
+
+        for row in reader:
+            yield reader.line_num, row
+
+    elif format == 'ndjson':
+        for line_num, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+
+            try:
+                row = json.loads(line)
+            except ValueError as exc:
+                yield line_num, ValueError(f"Invalid JSON: {exc}")
+                continue
+
+            if not isinstance(row, dict):
+                row = ValueError("Expected a JSON object")
+
+            yield line_num, row
+
+    else:
+        raise ValueError(f"Unknown format: {format}")
+
+
+def validate_row(row, city_choices):
+    """Check row like AddEditCafeForm would.
+
+    Returns (values, None) with values ready to insert, or (None, message).
+    """
+
+    formdata = MultiDict({
+        field: '' if row.get(field) is None else str(row[field])
+        for field in FIELDS
+    })
+
+    form = AddEditCafeForm(formdata=formdata, meta={'csrf': False})
+    form.city_code.choices = city_choices
+
+    if not form.validate():
+        return None, '; '.join(
+            f"{field}: {' '.join(errors)}"
+            for field, errors in form.errors.items()
+        )
+
+    return {
+        "name": form.name.data,
+        "description": form.description.data,
+        "url": form.url.data,
+        "address": form.address.data,
+        "city_code": form.city_code.data,
+        "image_url": form.image_url.data or Cafe.image_url.default.arg,
+    }, None
+
+
+def _key(values):
+    """Return natural key matching a row to an existing cafe."""
+
+    return (values["name"], values["address"], values["city_code"])
+
+
+def _write_batch(batch, report):
+    """Insert/update cafes in batch ({key: (line, values)}) and commit."""
+
+    rows = db.session.execute(
+        db.select(Cafe.id, Cafe.name, Cafe.address, Cafe.city_code)
+        .where(tuple_(Cafe.name, Cafe.address, Cafe.city_code)
+               .in_(list(batch)))
+    )
+    existing = {(name, address, city): id for id, name, address, city in rows}
+
+    inserts = [values for key, (_, values) in batch.items()
+               if key not in existing]
+    updates = [{**values, "id": existing[key]}
+               for key, (_, values) in batch.items() if key in existing]
+
+    new_ids = []
+    updated_ids = [values["id"] for values in updates]
+
+    if inserts:
+        new_ids = db.session.scalars(
+            db.insert(Cafe).returning(Cafe.id), inserts).all()
+
+    if updates:
+        db.session.execute(db.update(Cafe), updates)
+        db.session.execute(
+            db.update(Cafe)
+            .where(Cafe.id.in_(updated_ids))
+            .values(version=Cafe.version + 1)
+        )
+
+    # bulk statements skip the ORM events that keep this up to date
+    Cafe.reindex_search(ids=new_ids + updated_ids)
+
+    db.session.commit()
+
+    report.inserted += len(new_ids)
+    report.updated += len(updates)
+    report.new_ids.extend(new_ids)
+
+
+def _flush_batch(batch, report):
+    """Write batch; if that fails, write its rows one at a time, so one
+    bad row doesn't lose the others."""
+
+    try:
+        _write_batch(batch, report)
+        return
+    except SQLAlchemyError:
+        db.session.rollback()
+
+    for key, (line, values) in batch.items():
+        try:
+            _write_batch({key: (line, values)}, report)
+        except SQLAlchemyError as exc:
+            db.session.rollback()
+            error = getattr(exc, "orig", None) or exc
+            report.add_error(line, str(error).splitlines()[0])
+
+
+def import_cafes(rows, batch_size=BATCH_SIZE):
+    """Import cafes from (line number, row) pairs; returns ImportReport.
+
+    A row matching an existing cafe's name, address and city updates it;
+    any other row adds a new cafe.
+    """
+
+    report = ImportReport()
+    city_choices = City.get_choices()
+    batch = {}
+
+    for line, row in rows:
+        if isinstance(row, Exception):
+            report.add_error(line, str(row))
+            continue
+
+        values, error = validate_row(row, city_choices)
+
+        if error:
+            report.add_error(line, error)
+            continue
+
+        # a later row for the same cafe wins
+        batch[_key(values)] = (line, values)
+
+        if len(batch) >= batch_size:
+            _flush_batch(batch, report)
+            batch = {}
+
+    if batch:
+        _flush_batch(batch, report)
+
+    return report
+
+
+def generate_maps(cafe_ids, concurrency=8, batch_size=BATCH_SIZE):
+    """Fetch maps for these cafes, in parallel, a batch at a time.
+
+    Returns {cafe id: exception} for maps that couldn't be fetched.
+    """
+
+    failures = {}
+
+    for start in range(0, len(cafe_ids), batch_size):
+        ids = cafe_ids[start:start + batch_size]
+        cafes = Cafe.query.filter(Cafe.id.in_(ids)).all()
+
+        failures.update(Cafe.save_maps(cafes, concurrency=concurrency))
+        db.session.commit()
+
+    return failures
@@ -0,0 +1,122 @@
+"""Background map-render jobs for Flask Cafe.
+
+Saving a cafe only queues a MapJob; a worker (`flask jobs work`) fetches
+the map from MapQuest outside the request, retrying failures with
+exponential backoff.
+"""
+
+import time
+from datetime import timedelta
+
+from flask import current_app
+from sqlalchemy import or_
+
+from models import db, Cafe, MapJob, utcnow
+
+
+def claim_next_job():
+    """Claim the next due job for this worker, or return None.
+
+    A job is due if it is pending and its run_after has passed, or if it is
+    running but its worker's lease has expired (the worker probably died).
+    An expired job that has already used up MAP_JOB_MAX_ATTEMPTS is marked
+    failed instead, so a job that keeps crashing its worker can't run
+    forever. On Postgres, SKIP LOCKED lets several workers claim jobs
+    concurrently.
+    """
+
+    lease = current_app.config.get('MAP_JOB_LEASE_SECONDS', 300)
+    max_attempts = current_app.config.get('MAP_JOB_MAX_ATTEMPTS', 5)
+
+    while True:
+        now = utcnow()
+
+        job = (
+            MapJob.query
+            .filter(
+                or_(MapJob.status == MapJob.PENDING,
+                    MapJob.status == MapJob.RUNNING),
+                MapJob.run_after <= now,
+            )
+            .order_by(MapJob.run_after, MapJob.id)
+            .with_for_update(skip_locked=True)
+            .first()
+        )
+
+        if job is None:
+            db.session.rollback()
+            return None
+
+        if job.status == MapJob.RUNNING and job.attempts >= max_attempts:
+            job.status = MapJob.FAILED
+            job.last_error = "Worker lease expired on last attempt"
+            job.finished_at = now
+            db.session.commit()
+            continue
+
+        job.status = MapJob.RUNNING
+        job.attempts += 1
+        job.run_after = now + timedelta(seconds=lease)
+        db.session.commit()
+
+        return job
+
+
+def run_job(job):
+    """Render the map for a claimed job and record the outcome."""
+
+    max_attempts = current_app.config.get('MAP_JOB_MAX_ATTEMPTS', 5)
+    backoff = current_app.config.get('MAP_JOB_BACKOFF_SECONDS', 30)
+
+    cafe = db.session.get(Cafe, job.cafe_id)
+
+    try:
+        if cafe is not None:
+            cafe.save_cafe_map()
+
+    except Exception as exc:
+        db.session.rollback()
+        job.last_error = f"{type(exc).__name__}: {exc}"
+
+        if job.attempts >= max_attempts:
+            job.status = MapJob.FAILED
+            job.finished_at = utcnow()
+        else:
+            job.status = MapJob.PENDING
+            delay = backoff * 2 ** (job.attempts - 1)
+            job.run_after = utcnow() + timedelta(seconds=delay)
+
+    else:
+        job.status = MapJob.DONE
+        job.last_error = None
+        job.finished_at = utcnow()
+
+    db.session.commit()
+    return job
+
+
+def run_pending(limit=None):
+    """Run due jobs until none are left (or limit is reached).
+
+    Returns the number of jobs run.
+    """
+
+    count = 0
+
+    while limit is None or count < limit:
+        job = claim_next_job()
+        if job is None:
+            break
+
+        run_job(job)
+        count += 1
+
+    return count
+
+
+def work(poll_interval=2.0):
+    """Run jobs forever, sleeping poll_interval seconds when idle."""
+
+    while True:
+        if not run_pending():
+            time.sleep(poll_interval)
@@ -0,0 +1,538 @@
+"""Load testing for Flask Cafe.
+
+Runs scenarios (the paths real users take: browsing the cafe list, cafe
+pages, liking from likes.js, logging in, admins editing) or replays a
+recorded request log, from a pool of worker threads, each its own logged
+in user session. Requests go to a server over HTTP (e.g. a local gunicorn)
+or, with no url, straight to the app through its test client.
+
+The result is per-endpoint latency percentiles and requests/second, as a
+dict that's saved as JSON so a later run can be compared against it
+(see compare). Used by `flask loadtest`.
+
+With REQUEST_LOG_PATH set, RequestRecorder appends each request the app
+serves to that file as a JSON line, in the format replay reads.
+"""
+
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import requests
+from flask import request
+from werkzeug.exceptions import HTTPException
+
+
+# form fields never written to the request log
+REDACTED_FIELDS = ('password', 'csrf_token')
+
+CSRF_RE = re.compile(r'name="csrf_token"[^>]*value="([^"]*)"')
+
+DEFAULT_MIX = {
+    'browse': 4,
+    'detail': 4,
+    'like': 3,
+    'login': 1,
+}
+
+
+#######################################
+# clients
+
+
+class AppClient:
+    """Sends requests to app in-process, through its test client."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None, json=None):
+        response = self.client.open(path, method=method, data=data, json=json)
+        return response.status_code, response.get_data(as_text=True)
+
+
+class HttpClient:
+    """Sends requests to a running server over HTTP."""
+
+    def __init__(self, base_url, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def request(self, method, path, data=None, json=None):
+        response = self.session.request(
+            method, self.base_url + path, data=data, json=json,
+            allow_redirects=False, timeout=self.timeout)
+        return response.status_code, response.text
+
+
+#######################################
+# stats
+
+
+def percentile(sorted_values, fraction):
+    """Return the nearest-rank percentile (fraction, e.g. 0.95) of an
+    already sorted list."""
+
+    if not sorted_values:
+        return 0
+
+    rank = math.ceil(fraction * len(sorted_values))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+class Stats:
+    """Latencies and statuses of requests, per endpoint; thread-safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.errors = defaultdict(int)
+
+    def record(self, endpoint, seconds, status):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            self.statuses[endpoint][status] += 1
+
+            if status is None or status >= 500:
+                self.errors[endpoint] += 1
+
+    def report(self, duration):
+        """Return {endpoint: {...}} of counts, rps and latencies in ms,
+        plus "*" for all endpoints together."""
+
+        with self._lock:
+            latencies = {
+                endpoint: sorted(values)
+                for endpoint, values in self.latencies.items()}
+            latencies['*'] = sorted(
+                value for values in latencies.values() for value in values)
+
+            report = {}
+
+            for endpoint, values in sorted(latencies.items()):
+                statuses = (
+                    self.statuses[endpoint] if endpoint != '*' else {})
+
+                report[endpoint] = {
+                    "count": len(values),
+                    "errors": (self.errors[endpoint] if endpoint != '*'
+                               else sum(self.errors.values())),
+                    "rps": len(values) / duration if duration else 0,
+                    "p50_ms": percentile(values, 0.50) * 1000,
+                    "p95_ms": percentile(values, 0.95) * 1000,
+                    "p99_ms": percentile(values, 0.99) * 1000,
+                    "max_ms": (values[-1] if values else 0) * 1000,
+                    "statuses": {
+                        str(status): count
+                        for status, count in statuses.items()},
+                }
+
+            return report
+
+
+def get_endpoint(url_map, method, path):
+    """Return name to report path under, e.g. "GET /cafes/<int:cafe_id>"."""
+
+    path = path.split('?')[0]
+
+    try:
+        rule, _ = url_map.bind('localhost').match(
+            path, method=method, return_rule=True)
+    except HTTPException:
+        return f"{method} {path}"
+
+    return f"{method} {rule.rule}"
+
+
+def get_form_page(url_map, path):
+    """Return path of the page holding the form that posts to path: path
+    itself if it answers GET, else the nearest parent page that does
+    (e.g. /cafes/1 for /cafes/1/delete, / for /logout)."""
+
+    path = path.split('?')[0]
+    adapter = url_map.bind('localhost')
+
+    while True:
+        try:
+            adapter.match(path, method='GET')
+            return path
+        except HTTPException:
+            pass
+
+        if path in ('', '/'):
+            return '/'
+
+        path = path.rstrip('/').rsplit('/', 1)[0] or '/'
+
+
+#######################################
+# sessions & scenarios
+
+
+class Session:
+    """One simulated user: a client, timing every request it makes."""
+
+    def __init__(self, client, stats, url_map, cafe_ids=(), rng=None):
+        self.client = client
+        self.stats = stats
+        self.url_map = url_map
+        self.cafe_ids = list(cafe_ids)
+        self.rng = rng or random.Random()
+
+    def request(self, method, path, data=None, json=None, record=True):
+        """Make request; returns (status, body). Status is None if it
+        failed without a response."""
+
+        start = time.perf_counter()
+
+        try:
+            status, body = self.client.request(method, path, data, json)
+        except requests.RequestException as exc:
+            status, body = None, str(exc)
+
+        if record:
+            self.stats.record(
+                get_endpoint(self.url_map, method, path),
+                time.perf_counter() - start,
+                status)
+
+        return status, body
+
+    def get_csrf_token(self, path, record=False):
+        """Return CSRF token of the form on page at path."""
+
+        _, body = self.request('GET', path, record=record)
+        match = CSRF_RE.search(body or '')
+
+        return match.group(1) if match else ''
+
+    def login(self, username, password, record=True):
+        """Log in as this user; returns True if that worked."""
+
+        token = self.get_csrf_token('/login', record=record)
+        status, _ = self.request('POST', '/login', data={
+            "username": username,
+            "password": password,
+            "csrf_token": token,
+        }, record=record)
+
+        return status == 302
+
+    def random_cafe_id(self):
+        return self.rng.choice(self.cafe_ids)
+
+
+def browse(session, config):
+    """Cafe list, by name or by popularity."""
+
+    sort = session.rng.choice(['', '?sort=popular'])
+    session.request('GET', f'/cafes{sort}')
+
+
+def detail(session, config):
+    """One cafe's page."""
+
+    session.request('GET', f'/cafes/{session.random_cafe_id()}')
+
+
+def like(session, config):
+    """What likes.js does: check like states of a page of cafes, then
+    click a like button (twice, so likes don't pile up)."""
+
+    cafe_ids = session.rng.sample(
+        session.cafe_ids, min(len(session.cafe_ids), 24))
+    session.request(
+        'GET', f'/api/likes?cafe_ids={",".join(map(str, cafe_ids))}')
+
+    cafe_id = session.rng.choice(cafe_ids)
+
+    for _ in range(2):
+        session.request(
+            'POST', '/api/likes/toggle', json={"cafe_id": cafe_id})
+
+
+def login(session, config):
+    """Log in again, as the same user (all of the bcrypt work)."""
+
+    session.login(config['username'], config['password'])
+
+
+def admin_edit(session, config):
+    """Open a cafe's edit form and save it unchanged."""
+
+    cafe_id = session.random_cafe_id()
+    path = f'/cafes/{cafe_id}/edit'
+
+    status, body = session.request('GET', f'/api/cafes/{cafe_id}',
+                                   record=False)
+    if status != 200:
+        return
+
+    cafe = json.loads(body)["cafe"]
+    token = session.get_csrf_token(path)
+
+    # the default image is a relative url, which the form won't take
+    image_url = cafe["image_url"] if cafe["image_url"].startswith(
+        'http') else ''
+
+    session.request('POST', path, data={
+        "name": cafe["name"],
+        "description": cafe["description"],
+        "url": cafe["url"],
+        "address": cafe["address"],
+        "city_code": cafe["city_code"],
+        "image_url": image_url,
+        "csrf_token": token,
+    })
+
+
+SCENARIOS = {
+    'browse': browse,
+    'detail': detail,
+    'like': like,
+    'login': login,
+    'admin_edit': admin_edit,
+}
+
+
+def get_cafe_ids(session, limit=100):
+    """Return up to limit cafe ids (untimed), for scenarios to pick from."""
+
+    status, body = session.request(
+        'GET', f'/api/cafes?fields=id&limit={limit}', record=False)
+
+    if status != 200:
+        raise RuntimeError(f"Couldn't list cafes (status {status})")
+
+    return [cafe["id"] for cafe in json.loads(body)["cafes"]]
+
+
+#######################################
+# running
+
+
+def _make_session(make_client, stats, url_map, config, seed):
+    session = Session(make_client(), stats, url_map,
+                      rng=random.Random(seed))
+
+    if config.get('username'):
+        username, password = config['username'], config['password']
+
+        if config.get('admin'):
+            username, password = config['admin_username'], config[
+                'admin_password']
+
+        if not session.login(username, password, record=False):
+            raise RuntimeError(f"Couldn't log in as {username}")
+
+    return session
+
+
+def run(make_client, url_map, mix, config, concurrency=4, duration=None,
+        iterations=None, seed=0):
+    """Run scenarios from concurrency workers, each picking scenarios in
+    proportion to mix ({name: weight}), for duration seconds or
+    iterations scenarios each. Returns the report.
+
+    make_client is called once per worker for its client. config has the
+    username/password to log in with (and admin_username/admin_password
+    for admin_edit).
+    """
+
+    if duration is None and iterations is None:
+        raise ValueError("Give a duration or a number of iterations")
+
+    if 'admin_edit' in mix and not config.get('admin_username'):
+        raise ValueError("admin_edit needs an admin username and password")
+
+    stats = Stats()
+    names = list(mix)
+    weights = [mix[name] for name in names]
+
+    setup = _make_session(make_client, stats, url_map, config, seed)
+    cafe_ids = get_cafe_ids(setup)
+
+    if not cafe_ids:
+        raise RuntimeError("No cafes to test with")
+
+    def work(worker):
+        user = _make_session(make_client, stats, url_map, config,
+                             seed + worker + 1)
+        user.cafe_ids = cafe_ids
+
+        admin = None
+        if 'admin_edit' in mix:
+            admin = _make_session(make_client, stats, url_map,
+                                  {**config, "admin": True}, seed - worker - 1)
+            admin.cafe_ids = cafe_ids
+
+        deadline = time.monotonic() + duration if duration else None
+        done = 0
+
+        while True:
+            if deadline and time.monotonic() >= deadline:
+                break
+            if iterations is not None and done >= iterations:
+                break
+
+            name = user.rng.choices(names, weights)[0]
+            SCENARIOS[name](admin if name == 'admin_edit' else user, config)
+            done += 1
+
+    return _timed(stats, work, concurrency, {
+        "mode": "scenarios",
+        "mix": mix,
+    })
+
+
+def read_log(file):
+    """Yield recorded requests from a JSON-lines request log."""
+
+    for line in file:
+        if line.strip():
+            yield json.loads(line)
+
+
+def replay(make_client, url_map, records, config, concurrency=4, seed=0):
+    """Replay recorded requests (see RequestRecorder) from concurrency
+    workers, as fast as they'll go, in order as they're taken from the
+    log. Returns the report."""
+
+    stats = Stats()
+    records = iter(records)
+    lock = threading.Lock()
+
+    def work(worker):
+        session = _make_session(make_client, stats, url_map, config,
+                                seed + worker)
+
+        while True:
+            with lock:
+                record = next(records, None)
+
+            if record is None:
+                break
+
+            # logged passwords are redacted, so log in as the harness's
+            # own user instead
+            if (record['method'] == 'POST'
+                    and record['path'].split('?')[0] == '/login'
+                    and config.get('username')):
+                session.login(config['username'], config['password'])
+                continue
+
+            data = record.get('form')
+
+            if data is not None:
+                data = {
+                    **data,
+                    "csrf_token": session.get_csrf_token(
+                        get_form_page(url_map, record['path'])),
+                }
+
+            session.request(
+                record['method'], record['path'], data=data,
+                json=record.get('json'))
+
+    return _timed(stats, work, concurrency, {"mode": "replay"})
+
+
+def _timed(stats, work, concurrency, info):
+    started_at = datetime.now(timezone.utc)
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        for future in [pool.submit(work, i) for i in range(concurrency)]:
+            future.result()
+
+    duration = time.perf_counter() - start
+
+    return {
+        **info,
+        "started_at": started_at.isoformat(),
+        "duration_s": duration,
+        "concurrency": concurrency,
+        "endpoints": stats.report(duration),
+    }
+
+
+def compare(baseline, current, max_regression=0.2, metric='p95_ms'):
+    """Return [(endpoint, baseline value, current value)] for endpoints
+    whose metric got more than max_regression (a fraction) worse."""
+
+    regressions = []
+
+    for endpoint, stats in current["endpoints"].items():
+        before = baseline["endpoints"].get(endpoint)
+
+        if not before or not before[metric]:
+            continue
+
+        if stats[metric] > before[metric] * (1 + max_regression):
+            regressions.append((endpoint, before[metric], stats[metric]))
+
+    return regressions
+
+
+#######################################
+# recording
+
+
+class RequestRecorder:
+    """Flask extension appending each request to REQUEST_LOG_PATH, as a
+    JSON line replay can read.
+
+    Form posts are logged without passwords or CSRF tokens; static files
+    aren't logged.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.path = app.config.get('REQUEST_LOG_PATH')
+        self._lock = threading.Lock()
+
+        if self.path:
+            app.before_request(self._start)
+            app.after_request(self._record)
+
+        app.extensions['request_recorder'] = self
+
+    def _start(self):
+        request.environ['loadtest.start'] = time.perf_counter()
+
+    def _record(self, response):
+        if request.path.startswith('/static/'):
+            return response
+
+        start = request.environ.get('loadtest.start', time.perf_counter())
+        record = {
+            "method": request.method,
+            "path": request.full_path.rstrip('?'),
+            "status": response.status_code,
+            "ms": round((time.perf_counter() - start) * 1000, 3),
+        }
+
+        if request.is_json:
+            record["json"] = request.get_json(silent=True)
+        elif request.form:
+            record["form"] = {
+                key: value for key, value in request.form.items()
+                if key not in REDACTED_FIELDS}
+
+        line = json.dumps(record, separators=(',', ':'))
+
+        with self._lock, open(self.path, 'a') as file:
+            file.write(line + '\n')
+
+        return response
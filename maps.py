@@ -1,35 +1,220 @@
+import asyncio
+import hashlib
 import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 
 load_dotenv()
 API_KEY = os.environ.get("MAPQUEST_API_KEY")
+BASE_URL = os.environ.get("MAPQUEST_BASE_URL", "https://www.mapquestapi.com")
+
+# seconds to wait for MapQuest to connect / send a response
+TIMEOUT = float(os.environ.get("MAPQUEST_TIMEOUT", 10))
+
+# max keep-alive connections kept open to MapQuest
+POOL_SIZE = int(os.environ.get("MAPQUEST_POOL_SIZE", 10))
+
+# fetch many maps with asyncio (needs httpx): one thread with all the
+# requests in flight, rather than a thread per request
+ASYNC = os.environ.get("MAPQUEST_ASYNC") == "1"
+
+MAP_ZOOM = 15
+MAP_SIZE = "@2x"
+
+MAPS_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                        "static", "maps")
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Return the shared HTTP session, creating it on first use.
 
-def get_map_url(address, city, state):
+    Reusing one session keeps connections to MapQuest alive between calls
+    instead of doing a fresh TCP/TLS handshake for every map.
+    """
+
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+
+    return _session
+
+
+def get_map_url(address, city, state, zoom=MAP_ZOOM, size=MAP_SIZE):
     """Get MapQuest URL for a static map for this location."""
 
-    base = f"https://www.mapquestapi.com/staticmap/v5/map?key={API_KEY}"
+    base = f"{BASE_URL}/staticmap/v5/map?key={API_KEY}"
     where = f"{address},{city},{state}"
-    return f"{base}&center={where}&size=@2x&zoom=15&locations={where}"
+    return f"{base}&center={where}&size={size}&zoom={zoom}&locations={where}"
 
-def save_map(id, address, city, state):
-    """Get static map and save in static/maps directory of this app."""
 
-    path = os.path.abspath(os.path.dirname(__file__))
+def normalize(text):
+    """Lowercase text and collapse runs of whitespace/commas."""
 
-    url = get_map_url(address, city, state)
-    resp = requests.get(url)
+    return re.sub(r"[\s,]+", " ", text).strip().lower()
 
 
-    with open(f"{path}/static/maps/{id}.jpg", "wb") as file:
-        file.write(resp.content)
+def get_map_key(address, city, state, zoom=MAP_ZOOM, size=MAP_SIZE):
+    """Return the cache key for the map of this location.
+
+    The key is a hash of the normalized map parameters, so any two cafes
+    that would get the same image from MapQuest share one key (and file).
+    """
+
+    params = [normalize(address), normalize(city), normalize(state),
+              str(zoom), size]
+    return hashlib.sha256("|".join(params).encode("UTF-8")).hexdigest()[:32]
+
+
+def get_map_path(key):
+    """Return the file path for the map image with this key."""
+
+    return f"{MAPS_DIR}/{key}.jpg"
+
+
+def fetch_map(address, city, state):
+    """Fetch static map image for this location and return its bytes.
+
+    Raises requests.RequestException if MapQuest fails or times out.
+    """
+
+    resp = get_session().get(get_map_url(address, city, state),
+                             timeout=TIMEOUT)
+    resp.raise_for_status()
+
+    return resp.content
+
+
+def save_map(key, address, city, state):
+    """Get static map, save it under its key and return its size in bytes."""
+
+    return write_map(key, fetch_map(address, city, state))
+
+
+def write_map(key, content):
+    """Save map image content under its key; return its size in bytes."""
+
+    path = get_map_path(key)
+
+    # write then rename, so readers never see a half-written image
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(content)
+    os.replace(tmp_path, path)
+
+    return len(content)
 
-def delete_map(id):
-    """Delete map image from static/maps directory"""
 
-    path = os.path.abspath(os.path.dirname(__file__))
-    file_path = f"{path}/static/maps/{id}.jpg"
+def geocode(address, city, state):
+    """Return (latitude, longitude) of this location.
 
-    os.remove(file_path)
+    Returns None if MapQuest can't place it; raises
+    requests.RequestException if MapQuest fails or times out.
+    """
+
+    url, params = get_geocode_request(address, city, state)
+    resp = get_session().get(url, params=params, timeout=TIMEOUT)
+    resp.raise_for_status()
+
+    return parse_geocode(resp.json())
+
+
+def get_geocode_request(address, city, state):
+    """Return (url, query params) to geocode this location."""
+
+    return (f"{BASE_URL}/geocoding/v1/address",
+            {"key": API_KEY, "location": f"{address},{city},{state}"})
+
+
+def parse_geocode(data):
+    """Return (latitude, longitude) from a geocoding response, or None."""
+
+    for result in data.get("results", []):
+        for location in result.get("locations", []):
+            lat_lng = location["latLng"]
+            return lat_lng["lat"], lat_lng["lng"]
+
+    return None
+
+
+def save_maps(locations, concurrency=8):
+    """Save (and geocode) maps for many locations in parallel.
+
+    locations is an iterable of (key, address, city, state) tuples. At most
+    `concurrency` locations are in flight at once. Returns a dict of
+    {key: (size in bytes, (lat, lng) or None) or exception}.
+    """
+
+    def save(location):
+        try:
+            size = save_map(*location)
+            return location[0], (size, geocode(*location[1:]))
+        except Exception as exc:
+            return location[0], exc
+
+    if ASYNC:
+        return asyncio.run(save_maps_async(locations, concurrency))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return dict(executor.map(save, locations))
+
+
+async def save_maps_async(locations, concurrency=8):
+    """Like save_maps, from one thread: requests are made with httpx's
+    async client, at most `concurrency` at once."""
+
+    import httpx
+
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency,
+                          max_keepalive_connections=POOL_SIZE)
+
+    async with httpx.AsyncClient(timeout=TIMEOUT, limits=limits) as client:
+
+        async def save(location):
+            key, address, city, state = location
+
+            try:
+                async with semaphore:
+                    resp = await client.get(get_map_url(address, city, state))
+                    resp.raise_for_status()
+
+                    url, params = get_geocode_request(address, city, state)
+                    geocoded = await client.get(url, params=params)
+                    geocoded.raise_for_status()
+
+                size = await asyncio.to_thread(write_map, key, resp.content)
+                return key, (size, parse_geocode(geocoded.json()))
+
+            except Exception as exc:
+                return key, exc
+
+        return dict(await asyncio.gather(*map(save, locations)))
+
+
+def map_exists(key):
+    """Return True if the map image with this key is on disk."""
+
+    return os.path.exists(get_map_path(key))
+
+
+def delete_map(key):
+    """Delete map image from static/maps directory"""
 
+    file_path = get_map_path(key)
 
+    if os.path.exists(file_path):
+        os.remove(file_path)
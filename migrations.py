@@ -0,0 +1,686 @@
+"""Schema migrations for Flask Cafe.
+
+db.create_all() makes the tables of a new database, but doesn't change
+tables that already exist. Changes to existing databases are migrations,
+listed in MIGRATIONS in order; `flask db upgrade` runs the ones not yet
+recorded in the schema_migrations table.
+
+A migration is a list of operations, run one after another while the site
+stays up. Each is written to hold as few locks, for as short a time, as
+Postgres allows:
+
+- CreateIndex builds with CREATE INDEX CONCURRENTLY (reads & writes carry on)
+- Backfill updates rows a batch per transaction, pausing between batches
+- AddForeignKey / SetNotNull check existing rows with VALIDATE CONSTRAINT,
+  which doesn't block writes, rather than holding ACCESS EXCLUSIVE for a
+  full table scan
+- DDL runs with lock_timeout set, so a statement stuck behind a long query
+  gives up (and is retried) rather than queueing every query behind it
+
+An operation can't share a transaction with the others (CONCURRENTLY can't
+run in one), so a migration is only recorded once all of its operations
+are done. Operations check whether they're already done, so re-running a
+migration that failed part way, or one on a database create_all() just
+made, picks up where it left off.
+
+`flask db upgrade --dry-run` lists what would run and the locks it takes.
+"""
+
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from sqlalchemy import (
+    Column, DateTime, Float, Integer, MetaData, Table, Text, bindparam,
+    inspect, text)
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.schema import CreateColumn
+
+from models import db, CacheVersion, MapImage, MapJob
+
+
+Migration = namedtuple('Migration', ['version', 'description', 'operations'])
+
+# Postgres error code for "couldn't get lock within lock_timeout"
+LOCK_NOT_AVAILABLE = '55P03'
+
+LOCK_RETRIES = 3
+
+
+schema_migrations = Table(
+    'schema_migrations',
+    MetaData(),
+    Column('version', Text, primary_key=True),
+    Column('applied_at', DateTime(timezone=True), nullable=False),
+)
+
+
+class Options:
+    """Settings for a run of migrations."""
+
+    def __init__(self, lock_timeout_ms=0, batch_size=None, pause=None,
+                 log=None):
+        self.lock_timeout_ms = lock_timeout_ms
+        self.batch_size = batch_size
+        self.pause = pause
+        self.log = log or (lambda message: None)
+
+
+@contextmanager
+def _connect(engine, options, autocommit=False):
+    """Yield a connection with lock_timeout set: in a transaction that
+    commits on leaving the block, or (autocommit) outside one."""
+
+    with engine.connect() as connection:
+        postgres = connection.dialect.name == 'postgresql'
+        timeout = int(options.lock_timeout_ms) if postgres else 0
+
+        if autocommit and postgres:
+            connection = connection.execution_options(
+                isolation_level='AUTOCOMMIT')
+
+            if timeout:
+                connection.execute(text(f"SET lock_timeout = {timeout}"))
+
+            try:
+                yield connection
+            finally:
+                if timeout:
+                    connection.execute(text("RESET lock_timeout"))
+
+        else:
+            with connection.begin():
+                if timeout:
+                    connection.execute(
+                        text(f"SET LOCAL lock_timeout = {timeout}"))
+
+                yield connection
+
+
+def _is_lock_timeout(exc):
+    orig = getattr(exc, 'orig', None)
+    code = getattr(orig, 'pgcode', None) or getattr(orig, 'sqlstate', None)
+
+    return code == LOCK_NOT_AVAILABLE
+
+
+def estimate_rows(connection, table):
+    """Return roughly how many rows table has.
+
+    On Postgres this is the planner's estimate, which is free to read;
+    elsewhere it's an exact count.
+    """
+
+    if not inspect(connection).has_table(table):
+        return 0
+
+    if connection.dialect.name == 'postgresql':
+        rows = connection.scalar(
+            text("SELECT reltuples::bigint FROM pg_class "
+                 "WHERE oid = to_regclass(:table)"),
+            {"table": table})
+
+        # -1 means never vacuumed/analyzed
+        if rows is not None and rows >= 0:
+            return rows
+
+    return connection.scalar(text(f"SELECT count(*) FROM {table}"))
+
+
+class Operation:
+    """One step of a migration.
+
+    Subclasses give the SQL they run (describe), the locks it takes
+    (lock_impact) and whether it's already done (is_done), and run it.
+    """
+
+    # dialect this only applies to (None: all of them)
+    dialect = None
+
+    def applies_to(self, dialect):
+        return self.dialect is None or self.dialect == dialect.name
+
+    def is_done(self, connection):
+        return False
+
+    def describe(self, dialect):
+        raise NotImplementedError
+
+    def lock_impact(self, connection):
+        raise NotImplementedError
+
+    def run(self, engine, options):
+        raise NotImplementedError
+
+
+def _sqlite_impact(connection, table):
+    rows = estimate_rows(connection, table)
+    return f"database write lock while it runs (~{rows} rows in {table})"
+
+
+class CreateTable(Operation):
+    """Create table (and its indexes)."""
+
+    def __init__(self, table):
+        self.table = table
+
+    def is_done(self, connection):
+        return inspect(connection).has_table(self.table.name)
+
+    def describe(self, dialect):
+        return f"CREATE TABLE {self.table.name}"
+
+    def lock_impact(self, connection):
+        referenced = sorted({
+            key.column.table.name for key in self.table.foreign_keys})
+
+        if connection.dialect.name != 'postgresql' or not referenced:
+            return "new table; no locks on existing tables"
+
+        return (f"new table; SHARE ROW EXCLUSIVE on {', '.join(referenced)} "
+                f"for a moment (blocks writes, not reads)")
+
+    def run(self, engine, options):
+        with _connect(engine, options) as connection:
+            self.table.create(connection, checkfirst=True)
+
+
+class AddColumn(Operation):
+    """Add column to table.
+
+    column must be nullable or have a server_default: existing rows need
+    a value. For a NOT NULL column computed from other data, add it
+    nullable, Backfill it, then SetNotNull.
+    """
+
+    def __init__(self, table, column):
+        self.table = table
+        self.column = column
+
+    def is_done(self, connection):
+        return self.column.name in {
+            column['name']
+            for column in inspect(connection).get_columns(self.table)}
+
+    def describe(self, dialect):
+        column = CreateColumn(self.column).compile(dialect=dialect)
+
+        return f"ALTER TABLE {self.table} ADD COLUMN {column}"
+
+    def lock_impact(self, connection):
+        if connection.dialect.name != 'postgresql':
+            return _sqlite_impact(connection, self.table)
+
+        # a constant default (or none) is stored in the catalog, not
+        # written to every row
+        return (f"ACCESS EXCLUSIVE on {self.table} for a moment, no table "
+                f"rewrite (~{estimate_rows(connection, self.table)} rows); "
+                f"waits for, then blocks, queries on {self.table}")
+
+    def run(self, engine, options):
+        with _connect(engine, options) as connection:
+            if not self.is_done(connection):
+                connection.execute(text(self.describe(connection.dialect)))
+
+
+class CreateIndex(Operation):
+    """Create index on table's columns.
+
+    On Postgres it's built CONCURRENTLY, so writes carry on while it
+    builds; a concurrent build that failed leaves an INVALID index, which
+    is dropped and built again.
+    """
+
+    def __init__(self, name, table, columns, unique=False, using=None,
+                 concurrently=True, dialect=None):
+        self.name = name
+        self.table = table
+        self.columns = columns
+        self.unique = unique
+        self.using = using
+        self.concurrently = concurrently
+        self.dialect = dialect
+
+    def _state(self, connection):
+        """Return None (no index), "valid" or "invalid"."""
+
+        if connection.dialect.name == 'postgresql':
+            valid = connection.scalar(
+                text("SELECT i.indisvalid FROM pg_index i "
+                     "JOIN pg_class c ON c.oid = i.indexrelid "
+                     "WHERE c.relname = :name"),
+                {"name": self.name})
+
+            if valid is None:
+                return None
+
+            return "valid" if valid else "invalid"
+
+        names = {index['name']
+                 for index in inspect(connection).get_indexes(self.table)}
+
+        return "valid" if self.name in names else None
+
+    def _concurrent(self, dialect):
+        return self.concurrently and dialect.name == 'postgresql'
+
+    def is_done(self, connection):
+        return self._state(connection) == "valid"
+
+    def describe(self, dialect):
+        unique = "UNIQUE " if self.unique else ""
+        concurrently = "CONCURRENTLY " if self._concurrent(dialect) else ""
+        using = f" USING {self.using}" if self.using else ""
+
+        return (f"CREATE {unique}INDEX {concurrently}IF NOT EXISTS "
+                f"{self.name} ON {self.table}{using} "
+                f"({', '.join(self.columns)})")
+
+    def lock_impact(self, connection):
+        if connection.dialect.name != 'postgresql':
+            return _sqlite_impact(connection, self.table)
+
+        rows = estimate_rows(connection, self.table)
+
+        if self._concurrent(connection.dialect):
+            return (f"SHARE UPDATE EXCLUSIVE on {self.table}: reads and "
+                    f"writes carry on; two passes over ~{rows} rows")
+
+        return (f"SHARE on {self.table}: writes wait until the index is "
+                f"built (~{rows} rows)")
+
+    def run(self, engine, options):
+        dialect = engine.dialect
+        concurrent = self._concurrent(dialect)
+
+        with _connect(engine, options, autocommit=concurrent) as connection:
+            state = self._state(connection)
+
+            if state == "valid":
+                return
+
+            if state == "invalid":
+                options.log(f"  dropping invalid index {self.name}")
+                drop = "DROP INDEX CONCURRENTLY" if concurrent else "DROP INDEX"
+                connection.execute(text(f"{drop} IF EXISTS {self.name}"))
+
+            connection.execute(text(self.describe(dialect)))
+
+
+class AddForeignKey(Operation):
+    """Add a foreign key constraint (Postgres only: SQLite can't add
+    constraints to existing tables).
+
+    It's added NOT VALID, which only checks new rows, then validated,
+    which checks existing rows without blocking writes.
+    """
+
+    dialect = 'postgresql'
+
+    def __init__(self, name, table, column, ref_table, ref_column):
+        self.name = name
+        self.table = table
+        self.column = column
+        self.ref_table = ref_table
+        self.ref_column = ref_column
+
+    def is_done(self, connection):
+        return connection.scalar(
+            text("SELECT convalidated FROM pg_constraint WHERE conname = :name"),
+            {"name": self.name}) is True
+
+    def describe(self, dialect):
+        return (f"ALTER TABLE {self.table} ADD CONSTRAINT {self.name} "
+                f"FOREIGN KEY ({self.column}) "
+                f"REFERENCES {self.ref_table} ({self.ref_column}) NOT VALID; "
+                f"ALTER TABLE {self.table} VALIDATE CONSTRAINT {self.name}")
+
+    def lock_impact(self, connection):
+        rows = estimate_rows(connection, self.table)
+
+        return (f"SHARE ROW EXCLUSIVE on {self.table} and {self.ref_table} "
+                f"for a moment; then validating scans ~{rows} rows under "
+                f"SHARE UPDATE EXCLUSIVE (reads and writes carry on)")
+
+    def run(self, engine, options):
+        with _connect(engine, options) as connection:
+            exists = connection.scalar(
+                text("SELECT 1 FROM pg_constraint WHERE conname = :name"),
+                {"name": self.name})
+
+            if not exists:
+                connection.execute(text(
+                    f"ALTER TABLE {self.table} ADD CONSTRAINT {self.name} "
+                    f"FOREIGN KEY ({self.column}) "
+                    f"REFERENCES {self.ref_table} ({self.ref_column}) "
+                    f"NOT VALID"))
+
+        with _connect(engine, options) as connection:
+            connection.execute(text(
+                f"ALTER TABLE {self.table} VALIDATE CONSTRAINT {self.name}"))
+
+
+class SetNotNull(Operation):
+    """Make a (backfilled) column NOT NULL (Postgres only: SQLite can't
+    change an existing column).
+
+    SET NOT NULL on its own scans the table holding ACCESS EXCLUSIVE. A
+    validated CHECK (column IS NOT NULL) lets it skip the scan, and
+    validating only takes SHARE UPDATE EXCLUSIVE.
+    """
+
+    dialect = 'postgresql'
+
+    def __init__(self, table, column):
+        self.table = table
+        self.column = column
+        self.check = f"ck_{table}_{column}_not_null"
+
+    def is_done(self, connection):
+        return not {
+            column['name']: column['nullable']
+            for column in inspect(connection).get_columns(self.table)
+        }.get(self.column, True)
+
+    def describe(self, dialect):
+        return (f"ALTER TABLE {self.table} ADD CONSTRAINT {self.check} "
+                f"CHECK ({self.column} IS NOT NULL) NOT VALID; "
+                f"ALTER TABLE {self.table} VALIDATE CONSTRAINT {self.check}; "
+                f"ALTER TABLE {self.table} "
+                f"ALTER COLUMN {self.column} SET NOT NULL")
+
+    def lock_impact(self, connection):
+        rows = estimate_rows(connection, self.table)
+
+        return (f"validating scans ~{rows} rows under SHARE UPDATE "
+                f"EXCLUSIVE (reads and writes carry on); then ACCESS "
+                f"EXCLUSIVE on {self.table} for a moment, no scan")
+
+    def run(self, engine, options):
+        with _connect(engine, options) as connection:
+            if self.is_done(connection):
+                return
+
+            connection.execute(text(
+                f"ALTER TABLE {self.table} DROP CONSTRAINT IF EXISTS "
+                f"{self.check}"))
+            connection.execute(text(
+                f"ALTER TABLE {self.table} ADD CONSTRAINT {self.check} "
+                f"CHECK ({self.column} IS NOT NULL) NOT VALID"))
+
+        with _connect(engine, options) as connection:
+            connection.execute(text(
+                f"ALTER TABLE {self.table} VALIDATE CONSTRAINT {self.check}"))
+
+        with _connect(engine, options) as connection:
+            connection.execute(text(
+                f"ALTER TABLE {self.table} "
+                f"ALTER COLUMN {self.column} SET NOT NULL"))
+            connection.execute(text(
+                f"ALTER TABLE {self.table} DROP CONSTRAINT {self.check}"))
+
+
+class Backfill(Operation):
+    """Set columns of existing rows, batch_size rows per transaction,
+    sleeping pause seconds between batches so replication and other
+    queries keep up.
+
+    values is {column: SQL expression}, or a function taking the dialect
+    name and returning that. Rows are walked in key order; where (SQL)
+    limits which are updated.
+    """
+
+    def __init__(self, table, values, where=None, key='id', batch_size=1000,
+                 pause=0.1):
+        self.table = table
+        self.values = values
+        self.where = where
+        self.key = key
+        self.batch_size = batch_size
+        self.pause = pause
+
+    def _values(self, dialect):
+        if callable(self.values):
+            return self.values(dialect.name)
+
+        return self.values
+
+    def _set(self, dialect):
+        return ', '.join(
+            f"{column} = {value}"
+            for column, value in self._values(dialect).items())
+
+    def describe(self, dialect):
+        where = f" WHERE {self.where}" if self.where else ""
+
+        return (f"UPDATE {self.table} SET {self._set(dialect)}{where} "
+                f"(in batches of {self.batch_size})")
+
+    def _matching_rows(self, connection):
+        if not inspect(connection).has_table(self.table):
+            return 0
+
+        if self.where is None:
+            return estimate_rows(connection, self.table)
+
+        try:
+            with connection.begin_nested():
+                return connection.scalar(text(
+                    f"SELECT count(*) FROM {self.table} WHERE {self.where}"))
+        except DBAPIError:
+            # where uses a column an earlier step adds: every row matches
+            return estimate_rows(connection, self.table)
+
+    def lock_impact(self, connection):
+        rows = self._matching_rows(connection)
+        batches = -(-rows // self.batch_size)
+
+        return (f"row locks on up to {self.batch_size} rows at a time, one "
+                f"transaction per batch; ~{rows} rows in {batches} "
+                f"batch(es), pausing {self.pause}s between")
+
+    def run(self, engine, options):
+        batch_size = options.batch_size or self.batch_size
+        pause = self.pause if options.pause is None else options.pause
+        dialect = engine.dialect
+
+        where = f" AND ({self.where})" if self.where else ""
+        select_first = text(
+            f"SELECT {self.key} FROM {self.table} WHERE 1 = 1{where} "
+            f"ORDER BY {self.key} LIMIT :limit")
+        select_next = text(
+            f"SELECT {self.key} FROM {self.table} "
+            f"WHERE {self.key} > :last{where} "
+            f"ORDER BY {self.key} LIMIT :limit")
+        update = text(
+            f"UPDATE {self.table} SET {self._set(dialect)} "
+            f"WHERE {self.key} IN :keys{where}"
+        ).bindparams(bindparam('keys', expanding=True))
+
+        last = None
+        total = 0
+
+        while True:
+            with _connect(engine, options) as connection:
+                if last is None:
+                    keys = connection.scalars(
+                        select_first, {"limit": batch_size}).all()
+                else:
+                    keys = connection.scalars(
+                        select_next, {"last": last, "limit": batch_size}).all()
+
+                if keys:
+                    connection.execute(update, {"keys": keys})
+
+            total += len(keys)
+            options.log(f"  backfilled {total} rows of {self.table}")
+
+            if len(keys) < batch_size:
+                break
+
+            last = keys[-1]
+            time.sleep(pause)
+
+        return total
+
+
+def _search_vector(dialect):
+    """SQL for Cafe.search_vector, as Cafe.reindex_search computes it."""
+
+    document = (
+        "name || ' ' || (description || ' ' || (address || ' ' || "
+        "coalesce((SELECT cities.name FROM cities "
+        "WHERE cities.code = cafes.city_code), '')))")
+
+    if dialect == 'postgresql':
+        return {"search_vector": f"to_tsvector('english', {document})"}
+
+    return {"search_vector": f"lower({document})"}
+
+
+MIGRATIONS = [
+    Migration('0001', "Index likes by (cafe_id, user_id)", [
+        CreateIndex('ix_likes_cafe_id_user_id', 'likes',
+                    ['cafe_id', 'user_id']),
+    ]),
+    Migration('0002', "Add updated_at to cities, cafes and users", [
+        op
+        for table in ('cities', 'cafes', 'users')
+        for op in (
+            AddColumn(table, Column('updated_at', DateTime(timezone=True))),
+            Backfill(table, {"updated_at": "CURRENT_TIMESTAMP"},
+                     where="updated_at IS NULL",
+                     key='code' if table == 'cities' else 'id'),
+            SetNotNull(table, 'updated_at'),
+        )
+    ]),
+    Migration('0003', "Cache versions, shared map images", [
+        CreateTable(CacheVersion.__table__),
+        CreateTable(MapImage.__table__),
+        AddColumn('cafes', Column('map_key', Text)),
+        AddForeignKey('cafes_map_key_fkey', 'cafes', 'map_key',
+                      'map_images', 'key'),
+    ]),
+    Migration('0004', "Cafe versions, like counts and list indexes", [
+        AddColumn('cafes', Column(
+            'version', Integer, nullable=False, server_default='1')),
+        AddColumn('cafes', Column(
+            'like_count', Integer, nullable=False, server_default='0')),
+        Backfill('cafes', {
+            "like_count": "(SELECT count(*) FROM likes "
+                          "WHERE likes.cafe_id = cafes.id)",
+        }),
+        CreateIndex('ix_cafes_name_id', 'cafes', ['name', 'id']),
+        CreateIndex('ix_cafes_like_count_id', 'cafes', ['like_count', 'id']),
+    ]),
+    Migration('0005', "Cafe coordinates", [
+        AddColumn('cafes', Column('latitude', Float)),
+        AddColumn('cafes', Column('longitude', Float)),
+        AddColumn('cafes', Column('geo_cell', Integer)),
+        CreateIndex('ix_cafes_geo_cell', 'cafes', ['geo_cell']),
+    ]),
+    Migration('0006', "Cafe search", [
+        AddColumn('cafes', Column(
+            'search_vector', TSVECTOR().with_variant(Text(), 'sqlite'))),
+        Backfill('cafes', _search_vector, where="search_vector IS NULL"),
+        CreateIndex('ix_cafes_search_vector', 'cafes', ['search_vector'],
+                    using='gin', dialect='postgresql'),
+    ]),
+    Migration('0007', "Map render queue", [
+        CreateTable(MapJob.__table__),
+    ]),
+]
+
+
+def get_applied(connection):
+    """Return set of versions already applied."""
+
+    schema_migrations.create(connection, checkfirst=True)
+
+    return set(connection.scalars(schema_migrations.select().with_only_columns(
+        schema_migrations.c.version)))
+
+
+def get_pending(engine=None, migrations=None):
+    """Return list of migrations not yet applied, in order."""
+
+    engine = engine or db.engine
+
+    with engine.begin() as connection:
+        applied = get_applied(connection)
+
+    return [m for m in (migrations or MIGRATIONS) if m.version not in applied]
+
+
+def plan(engine=None, migrations=None):
+    """Return what upgrade would do, without doing it:
+    [(migration, [(SQL, locks it would take)])]."""
+
+    engine = engine or db.engine
+    pending = get_pending(engine, migrations)
+    dialect = engine.dialect
+    steps = []
+
+    with engine.connect() as connection:
+        for migration in pending:
+            ops = []
+
+            for op in migration.operations:
+                if not op.applies_to(dialect):
+                    impact = f"skipped on {dialect.name}"
+                elif op.is_done(connection):
+                    impact = "none (already done)"
+                else:
+                    impact = op.lock_impact(connection)
+
+                ops.append((op.describe(dialect), impact))
+
+            steps.append((migration, ops))
+
+    return steps
+
+
+def _run(op, engine, options):
+    """Run op, retrying if it gives up waiting for a lock."""
+
+    for attempt in range(1, LOCK_RETRIES + 1):
+        try:
+            return op.run(engine, options)
+        except OperationalError as exc:
+            if not _is_lock_timeout(exc) or attempt == LOCK_RETRIES:
+                raise
+
+            options.log(f"  lock timeout, retrying ({attempt})")
+            time.sleep(attempt)
+
+
+def upgrade(engine=None, migrations=None, options=None):
+    """Apply pending migrations, in order; returns list of those applied.
+
+    A migration is recorded in schema_migrations once all its operations
+    have run; if one fails, the migration stays pending, and running it
+    again skips the operations already done.
+    """
+
+    engine = engine or db.engine
+    options = options or Options()
+    dialect = engine.dialect
+    applied = []
+
+    for migration in get_pending(engine, migrations):
+        for op in migration.operations:
+            if op.applies_to(dialect):
+                options.log(f"  {op.describe(dialect)}")
+                _run(op, engine, options)
+
+        with engine.begin() as connection:
+            connection.execute(schema_migrations.insert().values(
+                version=migration.version,
+                applied_at=datetime.now(timezone.utc),
+            ))
+
+        applied.append(migration)
+
+    return applied
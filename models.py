@@ -1,17 +1,38 @@
 """Data models for Flask Cafe"""
 
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
 
-from flask_bcrypt import Bcrypt
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
-from maps import save_map, delete_map
-
-
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from sqlalchemy import event, inspect
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, deferred
+from maps import (
+    save_map, save_maps, delete_map, map_exists, get_map_key, geocode)
+from geo import (
+    get_cell, get_bounding_box, get_covering_cells, get_lng_ranges,
+    haversine_km)
+from passwords import hash_password, check_password, needs_rehash
+from routing import RoutingSession
+from pagination import keyset_page
+
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 DEFAULT_PROF_IMG_URL = '/static/images/default-pic.png'
 DEFAULT_CAFE_IMG_URL = '/static/images/default-cafe.png'
 
 
+def utcnow():
+    """Return the current time as an aware UTC datetime."""
+
+    return datetime.now(timezone.utc)
+
+
 class City(db.Model):
     """Cities for cafes."""
 
@@ -32,14 +53,337 @@ class City(db.Model):
         nullable=False,
     )
 
+    updated_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+        default=utcnow,
+        onupdate=utcnow,
+    )
+
     @classmethod
     def get_choices(self):
         """
-        gets all current cities from database, returns list
+        gets all current cities (from the city registry), returns list
         of tuples (city code, city name)
         """
-        return [(city.code, city.name) for city in City.query.all()]
+        return [
+            (city.code, city.name)
+            for city in city_registry.get_cities().values()
+        ]
+
+
+# dialects with INSERT ... ON CONFLICT DO UPDATE
+UPSERT_DIALECTS = {
+    'postgresql': postgresql,
+    'sqlite': sqlite,
+}
+
 
+class CacheVersion(db.Model):
+    """Version stamps for in-process caches.
+
+    A process notices that another process changed cached data (e.g. the
+    cities) by seeing the stamp for that cache go up.
+    """
+
+    __tablename__ = 'cache_versions'
+
+    name = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    @classmethod
+    def get(cls, name):
+        """Return current version for cache name (0 if never bumped)."""
+
+        version = db.session.execute(
+            db.select(cls.version).where(cls.name == name)).scalar()
+
+        return version or 0
+
+    @classmethod
+    def bump(cls, name, connection):
+        """Increment version for cache name, using connection.
+
+        Uses Core statements on the given connection, so it is safe to call
+        from inside session events. The first bump is an upsert, so two
+        processes bumping a new name at once don't collide.
+        """
+
+        table = cls.__table__
+        dialect = UPSERT_DIALECTS.get(connection.dialect.name)
+
+        if dialect is not None:
+            connection.execute(
+                dialect.insert(table)
+                .values(name=name, version=1)
+                .on_conflict_do_update(
+                    index_elements=[table.c.name],
+                    set_={"version": table.c.version + 1})
+            )
+            return
+
+        updated = connection.execute(
+            table.update()
+            .where(table.c.name == name)
+            .values(version=table.c.version + 1)
+        ).rowcount
+
+        if not updated:
+            connection.execute(table.insert().values(name=name, version=1))
+
+
+CityInfo = namedtuple('CityInfo', ['code', 'name', 'state'])
+
+
+class CityRegistry:
+    """In-process cache of all cities, keyed by city code.
+
+    Cities rarely change, so rather than query them for every form and
+    cafe card, the registry loads them all once. After CITY_CACHE_TTL
+    seconds it re-checks the "cities" CacheVersion (one tiny query) and
+    only reloads if some process changed a city. Changes made by this
+    process invalidate it immediately.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.invalidate()
+
+    def invalidate(self):
+        """Forget cached cities; they are reloaded on next use."""
+
+        self._cities = None
+        self._version = None
+        self._checked_at = None
+
+    def get_cities(self):
+        """Return dict of {code: CityInfo}, ordered by city name."""
+
+        ttl = current_app.config.get('CITY_CACHE_TTL', 60)
+        now = time.monotonic()
+
+        with self._lock:
+            if (self._cities is not None
+                    and now - self._checked_at < ttl):
+                return self._cities
+
+            version = CacheVersion.get('cities')
+
+            if self._cities is None or version != self._version:
+                rows = db.session.execute(
+                    db.select(City.code, City.name, City.state)
+                    .order_by(City.name)
+                ).all()
+                self._cities = {row.code: CityInfo(*row) for row in rows}
+                self._version = version
+
+            self._checked_at = now
+            return self._cities
+
+    def get(self, code):
+        """Return CityInfo for code, or None."""
+
+        return self.get_cities().get(code)
+
+    @property
+    def version(self):
+        """Current cities version (for keys of caches built on cities)."""
+
+        self.get_cities()
+        return self._version
+
+
+city_registry = CityRegistry()
+
+
+@event.listens_for(Session, 'after_flush')
+def _bump_cities_after_flush(session, flush_context):
+    """Bump cities version when a flush writes any City."""
+
+    changed = any(
+        isinstance(obj, City)
+        for obj in [*session.new, *session.dirty, *session.deleted]
+    )
+
+    if changed:
+        CacheVersion.bump('cities', session.connection())
+        session.info['cities_changed'] = True
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _bump_cities_on_bulk_write(orm_execute_state):
+    """Bump cities version for bulk INSERT/UPDATE/DELETE of cities."""
+
+    state = orm_execute_state
+    mapper = state.bind_mapper
+
+    if ((state.is_insert or state.is_update or state.is_delete)
+            and mapper is City.__mapper__):
+        CacheVersion.bump('cities', state.session.connection())
+        state.session.info['cities_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_cities_after_commit(session):
+    """Drop this process's cached cities once a city change is committed."""
+
+    if session.info.pop('cities_changed', False):
+        city_registry.invalidate()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_city_changes_after_rollback(session):
+    session.info.pop('cities_changed', None)
+
+
+
+class MapImage(db.Model):
+    """A map image on disk, shared by every cafe at the same location.
+
+    Images are stored under a hash of their normalized map parameters (see
+    maps.get_map_key) and reference-counted by the cafes that use them.
+    Unreferenced ("orphan") images are kept for reuse until the orphans
+    outgrow MAP_CACHE_MAX_ORPHAN_BYTES, then evicted least recently used first.
+    """
+
+    __tablename__ = 'map_images'
+
+    __table_args__ = (
+        db.Index('ix_map_images_ref_count_last_used_at',
+                 'ref_count', 'last_used_at'),
+    )
+
+    key = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    ref_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    size = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    last_used_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+        default=utcnow,
+    )
+
+    # geocoded position of the location; copied to cafes using the image
+    latitude = db.Column(
+        db.Float,
+    )
+
+    longitude = db.Column(
+        db.Float,
+    )
+
+    def __repr__(self):
+        return f'<MapImage key={self.key} refs={self.ref_count}>'
+
+    @classmethod
+    def add(cls, key, size, coordinates=None):
+        """Record a newly saved image (if not already recorded)."""
+
+        latitude, longitude = coordinates or (None, None)
+
+        try:
+            with db.session.begin_nested():
+                db.session.add(cls(key=key, size=size,
+                                   latitude=latitude, longitude=longitude))
+        except IntegrityError:
+            # another worker saved the same location at the same time
+            pass
+
+    @classmethod
+    def acquire(cls, key):
+        """Add a reference to image."""
+
+        cls.query.filter_by(key=key).update({
+            cls.ref_count: cls.ref_count + 1,
+            cls.last_used_at: utcnow(),
+        })
+
+    @classmethod
+    def release(cls, key):
+        """Drop a reference to image; it stays on disk until evicted."""
+
+        cls.query.filter_by(key=key).update({
+            cls.ref_count: cls.ref_count - 1,
+            cls.last_used_at: utcnow(),
+        })
+
+    @classmethod
+    def evict_orphans(cls, max_bytes=None):
+        """Delete least recently used orphans beyond max_bytes in total.
+
+        Returns the number of images evicted.
+        """
+
+        if max_bytes is None:
+            max_bytes = current_app.config.get(
+                'MAP_CACHE_MAX_ORPHAN_BYTES', 50 * 1024 * 1024)
+
+        orphans = (
+            cls.query
+            .filter(cls.ref_count <= 0)
+            .order_by(cls.last_used_at.desc())
+            .all()
+        )
+
+        kept = 0
+        evicted = 0
+
+        for image in orphans:
+            if kept + image.size <= max_bytes:
+                kept += image.size
+                continue
+
+            db.session.delete(image)
+            delete_map_after_commit(image.key)
+            evicted += 1
+
+        return evicted
+
+
+def delete_map_after_commit(key):
+    """Delete map image key from disk once the session commits.
+
+    Deleting it straight away would leave rows pointing at a missing file
+    if the transaction then rolled back.
+    """
+
+    db.session.info.setdefault('maps_to_delete', set()).add(key)
+
+
+@event.listens_for(Session, 'after_commit')
+def _delete_maps_after_commit(session):
+    """Delete map files whose removal was just committed."""
+
+    for key in session.info.pop('maps_to_delete', ()):
+        delete_map(key)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _keep_maps_after_rollback(session):
+    """Keep map files whose removal was rolled back."""
+
+    session.info.pop('maps_to_delete', None)
 
 
 class Cafe(db.Model):
@@ -47,6 +391,18 @@ class Cafe(db.Model):
 
     __tablename__ = 'cafes'
 
+    __table_args__ = (
+        # support keyset pagination of the cafe list by (name, id) and
+        # by popularity, (like_count, id)
+        db.Index('ix_cafes_name_id', 'name', 'id'),
+        db.Index('ix_cafes_like_count_id', 'like_count', 'id'),
+        db.Index('ix_cafes_geo_cell', 'geo_cell'),
+        db.Index(
+            'ix_cafes_search_vector', 'search_vector',
+            postgresql_using='gin',
+        ).ddl_if(dialect='postgresql'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -86,32 +442,343 @@ class Cafe(db.Model):
 
     )
 
+    map_key = db.Column(
+        db.Text,
+        db.ForeignKey('map_images.key'),
+    )
+
+    # bumped whenever cafe's rendered markup changes (see cache_key)
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
+    # number of Likes for cafe, kept up to date by Like.add/remove;
+    # `flask likes reconcile` fixes any drift
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    updated_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+        default=utcnow,
+        onupdate=utcnow,
+    )
+
+    # position, geocoded with the map (see MapImage); geo_cell is the
+    # geo.get_cell grid cell, indexed for "near me" queries
+    latitude = db.Column(
+        db.Float,
+    )
+
+    longitude = db.Column(
+        db.Float,
+    )
+
+    geo_cell = db.Column(
+        db.Integer,
+    )
+
+    # name, description, address & city name, for search.py: a tsvector
+    # on Postgres, plain text elsewhere; kept current by _set_search_vector
+    search_vector = deferred(db.Column(
+        TSVECTOR().with_variant(db.Text(), 'sqlite'),
+    ))
+
     city = db.relationship("City", backref='cafes')
 
+    SEARCH_FIELDS = ('name', 'description', 'address', 'city_code')
+
     def __repr__(self):
         return f'<Cafe id={self.id} name="{self.name}">'
 
+    @staticmethod
+    def make_search_vector(name, description, address, city_name, dialect):
+        """Return value (or SQL expression) to store in search_vector."""
+
+        document = ' '.join([name, description or '', address, city_name])
+
+        if dialect == 'postgresql':
+            return db.func.to_tsvector('english', document)
+
+        return document.lower()
+
+    @classmethod
+    def reindex_search(cls, ids=None):
+        """Recompute search_vector for every cafe (e.g. after a city is
+        renamed), or just cafes with these ids. Returns number of cafes
+        reindexed."""
+
+        city = City.__table__
+        cafe = cls.__table__
+        dialect = db.engine.dialect.name
+
+        city_name = (
+            db.select(city.c.name)
+            .where(city.c.code == cafe.c.city_code)
+            .scalar_subquery()
+        )
+
+        document = db.func.coalesce(city_name, '')
+        for column in [cafe.c.name, cafe.c.description, cafe.c.address]:
+            document = column + ' ' + document
+
+        if dialect == 'postgresql':
+            value = db.func.to_tsvector('english', document)
+        else:
+            value = db.func.lower(document)
+
+        statement = cafe.update().values(search_vector=value)
+
+        if ids is not None:
+            statement = statement.where(cafe.c.id.in_(ids))
+
+        return db.session.execute(statement).rowcount
+
+    @property
+    def cache_key(self):
+        """Key for cafe's cached fragments; changes when they would."""
+
+        return f'{self.id}.{self.version}.{city_registry.version}'
+
+    def bump_version(self):
+        """Mark cafe's cached fragments as stale."""
+
+        # done in SQL so concurrent bumps can't both write the same version
+        self.version = Cafe.version + 1
+
+    @property
+    def map_url(self):
+        """URL of cafe's map image."""
+
+        if self.map_key:
+            return f'/static/maps/{self.map_key}.jpg'
+
+        # maps saved before the map cache were named by cafe id
+        return f'/static/maps/{self.id}.jpg'
+
+    def get_city(self):
+        """Return CityInfo for cafe's city (from the city registry)."""
+
+        # look up by city_code: self.city is stale if city_code just changed
+        city = city_registry.get(self.city_code)
+
+        if city is None:
+            # city added by another process since the registry last checked
+            city = db.session.get(City, self.city_code)
+
+        return city
+
+    def get_map_key(self):
+        """Return the map cache key for cafe's current location."""
+
+        city = self.get_city()
+        return get_map_key(self.address, city.name, city.state)
+
+    def set_coordinates(self, latitude, longitude):
+        """Set cafe's position (or clear it, given None)."""
+
+        self.latitude = latitude
+        self.longitude = longitude
+        self.geo_cell = (
+            get_cell(latitude, longitude) if latitude is not None else None)
+
+    def _set_map_key(self, key):
+        """Point cafe at a different map image, moving its reference."""
+
+        if self.map_key:
+            MapImage.release(self.map_key)
+
+        MapImage.acquire(key)
+        self.map_key = key
+        self.bump_version()
+
+        image = db.session.get(MapImage, key)
+        self.set_coordinates(image.latitude, image.longitude)
+
+    def use_cached_map(self):
+        """Point cafe at an already-saved map for its location, if any.
+
+        Returns True if cafe now has an up-to-date map.
+        """
+
+        key = self.get_map_key()
+
+        if key == self.map_key:
+            return True
+
+        if db.session.get(MapImage, key) is None or not map_exists(key):
+            return False
+
+        self._set_map_key(key)
+        return True
+
+    def refresh_map(self):
+        """Make sure cafe's map matches its location.
+
+        Uses the map cache when it can; otherwise queues a MapJob to fetch
+        the map and returns it.
+        """
+
+        if not self.use_cached_map():
+            return MapJob.enqueue(self)
+
     def save_cafe_map(self):
-        """saves map for cafe"""
+        """saves map for cafe (fetching it only if not cached)"""
+
+        if self.use_cached_map():
+            return
 
-        save_map(self.id, self.address, self.city.name, self.city.state)
+        city = self.get_city()
+        key = self.get_map_key()
+
+        size = save_map(key, self.address, city.name, city.state)
+        coordinates = geocode(self.address, city.name, city.state)
+        MapImage.add(key, size, coordinates)
+        self._set_map_key(key)
+
+    @classmethod
+    def save_maps(cls, cafes, concurrency=8):
+        """Re-fetch maps for many cafes in parallel.
+
+        Each distinct location is fetched once. Returns a dict of
+        {cafe id: exception} for cafes whose map could not be fetched.
+        """
 
+        by_key = {}
+        for cafe in cafes:
+            by_key.setdefault(cafe.get_map_key(), []).append(cafe)
+
+        locations = [
+            (key, cafe.address, cafe.get_city().name, cafe.get_city().state)
+            for key, (cafe, *_) in by_key.items()
+        ]
+
+        results = save_maps(locations, concurrency=concurrency)
+        failures = {}
+
+        for key, result in results.items():
+            if isinstance(result, Exception):
+                failures.update({cafe.id: result for cafe in by_key[key]})
+                continue
+
+            size, coordinates = result
+            image = db.session.get(MapImage, key)
+
+            if image is None:
+                MapImage.add(key, size, coordinates)
+            else:
+                image.size = size
+                image.latitude, image.longitude = coordinates or (None, None)
+
+            for cafe in by_key[key]:
+                if cafe.map_key != key:
+                    cafe._set_map_key(key)
+                else:
+                    cafe.set_coordinates(*(coordinates or (None, None)))
+
+        return failures
 
     def delete_cafe_map(self):
-        "deletes cafe map"
+        "drops cafe's reference to its map, evicting old unused maps"
+
+        if self.map_key:
+            MapImage.release(self.map_key)
+            self.map_key = None
+
+        if self.id is not None:
+            # maps saved before the map cache were named by cafe id
+            delete_map_after_commit(str(self.id))
+
+        MapImage.evict_orphans()
+
+
+    @classmethod
+    def find_nearby(cls, latitude, longitude, radius_km, limit=50):
+        """Return [(cafe, distance in km)] within radius, nearest first.
+
+        Only reads cafes in the grid cells overlapping the circle's bounding
+        box (via the geo_cell index), then filters that batch by exact
+        distance.
+        """
+
+        box = get_bounding_box(latitude, longitude, radius_km)
+        min_lat, max_lat, min_lng, max_lng = box
+        cells = get_covering_cells(box)
+
+        query = cls.query.filter(
+            cls.latitude.between(min_lat, max_lat),
+            db.or_(*(cls.longitude.between(low, high)
+                     for low, high in get_lng_ranges(box))),
+        )
+
+        if cells is not None:
+            query = query.filter(cls.geo_cell.in_(cells))
+
+        candidates = query.all()
+
+        distances = haversine_km(
+            latitude, longitude,
+            [cafe.latitude for cafe in candidates],
+            [cafe.longitude for cafe in candidates],
+        )
 
-        delete_map(self.id)
+        nearby = sorted(
+            (pair for pair in zip(candidates, distances)
+             if pair[1] <= radius_km),
+            key=lambda pair: (pair[1], pair[0].id),
+        )
 
+        return nearby[:limit]
+
+    # fields in to_dict(), in order
+    API_FIELDS = (
+        'id', 'name', 'description', 'url', 'address', 'city_code',
+        'image_url', 'latitude', 'longitude')
+
+    def to_dict(self, fields=API_FIELDS):
+        """Return cafe as a JSON-friendly dict (of just fields, if given)."""
+
+        return {field: getattr(self, field) for field in fields}
 
     def get_city_state(self):
         """Return 'city, state' for cafe."""
 
-        city = self.city
+        city = self.get_city()
         return f'{city.name}, {city.state}'
 
 
 
 
+@event.listens_for(Cafe, 'before_insert')
+@event.listens_for(Cafe, 'before_update')
+def _set_search_vector(mapper, connection, cafe):
+    """Recompute cafe's search_vector if any searched field changed."""
+
+    state = inspect(cafe)
+    changed = state.pending or any(
+        state.attrs[field].history.has_changes()
+        for field in Cafe.SEARCH_FIELDS
+    )
+
+    if not changed:
+        return
+
+    city_name = connection.execute(
+        db.select(City.name).where(City.code == cafe.city_code)
+    ).scalar() or ''
+
+    cafe.search_vector = Cafe.make_search_vector(
+        cafe.name, cafe.description, cafe.address, city_name,
+        connection.dialect.name)
+
+
 class User(db.Model):
     """Users in System"""
 
@@ -165,6 +832,13 @@ class User(db.Model):
         nullable=False,
     )
 
+    updated_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+        default=utcnow,
+        onupdate=utcnow,
+    )
+
     liked_cafes = db.relationship('Cafe', secondary='likes', backref='liking_users')
 
     def __repr__(self):
@@ -189,7 +863,7 @@ class User(db.Model):
                  ):
         """Register user w/ a hashed password & return user"""
 
-        hashed = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed = hash_password(password)
 
         user = cls(username=username,
                    admin=admin or False,
@@ -205,11 +879,19 @@ class User(db.Model):
     @classmethod
     def authenticate(cls, username, password):
         """Authenticate user given a username & password
-        returns user insance or False if not found/wrong password"""
+        returns user insance, None if not found or False if wrong password
+
+        If the stored hash's cost isn't the configured BCRYPT_LOG_ROUNDS,
+        it is replaced with a new hash (caller should commit)."""
 
         user = cls.query.filter_by(username=username).one_or_none()
 
-        if user and bcrypt.check_password_hash(user.password, password):
+        if user is None:
+            return None
+
+        if check_password(user.password, password):
+            if needs_rehash(user.password):
+                user.password = hash_password(password)
             return user
         else:
             return False
@@ -223,6 +905,12 @@ class Like(db.Model):
     # each row represents a user liking a cafe
     # making a primary key + foreign key makes every user and like combo unique
 
+    __table_args__ = (
+        # the primary key serves "cafes this user likes"; this serves "users
+        # who like this cafe" and cascading deletes of cafes
+        db.Index('ix_likes_cafe_id_user_id', 'cafe_id', 'user_id'),
+    )
+
     user_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete='cascade'),
@@ -235,6 +923,209 @@ class Like(db.Model):
         primary_key=True
     )
 
+    @classmethod
+    def add(cls, user_id, cafe_id):
+        """Make user like cafe (raises IntegrityError if they already do)."""
+
+        db.session.execute(cls.insert_statement(user_id, cafe_id))
+        cls._change_count(cafe_id, 1)
+
+    @classmethod
+    def remove(cls, user_id, cafe_id):
+        """Make user unlike cafe; return False if they didn't like it."""
+
+        deleted = db.session.execute(
+            cls.delete_statement(user_id, cafe_id)).rowcount
+
+        if deleted:
+            cls._change_count(cafe_id, -1)
+
+        return bool(deleted)
+
+    @classmethod
+    def toggle(cls, user_id, cafe_id):
+        """Flip whether user likes cafe; return True if they now like it.
+
+        Tries to delete the like first and only inserts if there was
+        nothing to delete, so each step is a single primary-key statement.
+        """
+
+        if cls.remove(user_id, cafe_id):
+            return False
+
+        cls.add(user_id, cafe_id)
+        return True
+
+    # the statements add/remove run, for running elsewhere (asgi.py runs
+    # them on an async connection)
+
+    @classmethod
+    def insert_statement(cls, user_id, cafe_id):
+        return db.insert(cls).values(user_id=user_id, cafe_id=cafe_id)
+
+    @classmethod
+    def delete_statement(cls, user_id, cafe_id):
+        return db.delete(cls).where(cls.user_id == user_id,
+                                    cls.cafe_id == cafe_id)
+
+    @staticmethod
+    def count_change_statement(cafe_id, delta):
+        """Statement atomically adding delta to cafe's like_count (never
+        below 0)."""
+
+        new_count = Cafe.like_count + delta
+
+        return (
+            db.update(Cafe)
+            .where(Cafe.id == cafe_id)
+            .values(
+                like_count=db.case((new_count > 0, new_count), else_=0),
+                # likes don't change what the cafe's pages show
+                updated_at=Cafe.updated_at,
+            )
+        )
+
+    @classmethod
+    def _change_count(cls, cafe_id, delta):
+        db.session.execute(cls.count_change_statement(cafe_id, delta))
+
+    @classmethod
+    def reconcile_counts(cls):
+        """Recompute every cafe's like_count from the likes table.
+
+        Returns the number of cafes whose count was wrong.
+        """
+
+        counts = dict(db.session.execute(
+            db.select(cls.cafe_id, db.func.count()).group_by(cls.cafe_id)
+        ).all())
+
+        drifted = [
+            {"id": id, "like_count": counts.get(id, 0)}
+            for id, like_count in db.session.execute(
+                db.select(Cafe.id, Cafe.like_count))
+            if counts.get(id, 0) != like_count
+        ]
+
+        if drifted:
+            db.session.execute(db.update(Cafe), drifted)
+
+        return len(drifted)
+
+    @classmethod
+    def get_liked_ids(cls, user_id, cafe_ids):
+        """Return set of the given cafe ids that user likes (one query)."""
+
+        return set(db.session.scalars(
+            db.select(cls.cafe_id).where(cls.user_id == user_id,
+                                         cls.cafe_id.in_(cafe_ids))
+        ))
+
+    @classmethod
+    def get_liked_cafes(cls, user_id, after=None, limit=20):
+        """Return a Page of cafes user likes, by cafe id, starting after
+        cursor (walks the likes primary key, however many likes there are)."""
+
+        query = (
+            Cafe.query
+            .join(cls, cls.cafe_id == Cafe.id)
+            .filter(cls.user_id == user_id)
+        )
+
+        return keyset_page(query, [Cafe.id], after=after, limit=limit)
+
+
+
+class MapJob(db.Model):
+    """Queued map render for a cafe, run by the `flask jobs work` worker."""
+
+    __tablename__ = 'map_jobs'
+
+    __table_args__ = (
+        db.Index('ix_map_jobs_status_run_after', 'status', 'run_after'),
+    )
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    cafe_id = db.Column(
+        db.Integer,
+        db.ForeignKey('cafes.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default=PENDING,
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # earliest time a pending job may run; for a running job, when its
+    # worker's lease expires and another worker may pick it up again
+    run_after = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+        default=utcnow,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    created_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+        default=utcnow,
+    )
+
+    finished_at = db.Column(
+        db.DateTime(timezone=True),
+    )
+
+    def __repr__(self):
+        return f'<MapJob id={self.id} cafe_id={self.cafe_id} {self.status}>'
+
+    @classmethod
+    def enqueue(cls, cafe):
+        """Queue a map render for cafe and return the job.
+
+        The job is added to the current transaction, so workers only see it
+        once the cafe itself is committed. If the cafe already has a job
+        waiting, that one is reused.
+        """
+
+        job = cls.query.filter_by(cafe_id=cafe.id, status=cls.PENDING).first()
+
+        if job is None:
+            job = cls(cafe_id=cafe.id)
+            db.session.add(job)
+
+        job.run_after = utcnow()
+        return job
+
+    def to_dict(self):
+        """Return job status as a JSON-friendly dict."""
+
+        return {
+            "id": self.id,
+            "cafe_id": self.cafe_id,
+            "status": self.status,
+            "attempts": self.attempts,
+            "last_error": self.last_error,
+        }
 
 
 def connect_db(app):
@@ -243,6 +1134,5 @@ def connect_db(app):
     You should call this in your Flask app.
     """
 
-    app.app_context().push()
     db.app = app
     db.init_app(app)
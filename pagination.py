@@ -0,0 +1,104 @@
+"""Keyset (seek) pagination helpers for Flask Cafe."""
+
+import base64
+import json
+from collections import namedtuple
+
+from sqlalchemy import tuple_
+
+
+Page = namedtuple('Page', ['items', 'next_cursor'])
+
+
+def get_sort_key(columns, descending=False):
+    """Return a name for an ordering, e.g. "like_count,id:desc"."""
+
+    names = ','.join(col.key for col in columns)
+    return f"{names}:{'desc' if descending else 'asc'}"
+
+
+def encode_cursor(values, sort_key):
+    """Encode a tuple of sort-key values as an opaque, URL-safe cursor.
+
+    The cursor records sort_key (see get_sort_key), so it's only used
+    again with the ordering it came from.
+    """
+
+    raw = json.dumps([sort_key, list(values)],
+                     separators=(',', ':')).encode('UTF-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _is_value_for(value, column):
+    """Can value be compared with column (an int or str column)?"""
+
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return False
+
+    if python_type is int:
+        return isinstance(value, int) and not isinstance(value, bool)
+
+    if python_type is str:
+        return isinstance(value, str)
+
+    return False
+
+
+def decode_cursor(cursor, columns, descending=False):
+    """Decode a cursor made by encode_cursor for this ordering.
+
+    Returns a tuple of values for columns, or None if the cursor is
+    missing or malformed, was made for another ordering, or holds values
+    of the wrong types (callers treat that as "start from the first page").
+    """
+
+    if not cursor:
+        return None
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        sort_key, values = json.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, TypeError):
+        return None
+
+    if sort_key != get_sort_key(columns, descending):
+        return None
+
+    if (not isinstance(values, list) or len(values) != len(columns)
+            or not all(map(_is_value_for, values, columns))):
+        return None
+
+    return tuple(values)
+
+
+def keyset_page(query, columns, after=None, limit=20, descending=False):
+    """Return one Page of `query`, ordered by `columns`, starting after cursor.
+
+    `columns` must end with a unique column (usually the primary key) so the
+    ordering is total. Instead of OFFSET, the page is found by comparing the
+    row value (col1, col2, ...) against the last row of the previous page,
+    which an index on the same columns answers without scanning skipped rows.
+    """
+
+    key = tuple_(*columns)
+    values = decode_cursor(after, columns, descending)
+
+    if values is not None:
+        query = query.filter(key < values if descending else key > values)
+
+    order = [col.desc() if descending else col for col in columns]
+
+    # fetch one extra row to find out whether there is a next page
+    rows = query.order_by(*order).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(
+            (getattr(last, col.key) for col in columns),
+            get_sort_key(columns, descending))
+
+    return Page(rows, next_cursor)
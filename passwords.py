@@ -0,0 +1,93 @@
+"""Password hashing for Flask Cafe (bcrypt).
+
+BCRYPT_LOG_ROUNDS sets the cost of new hashes. Hashes with a different
+cost still verify, and User.authenticate rehashes them at the configured
+cost on the next successful login.
+
+If BCRYPT_POOL_SIZE is set, hashing runs in a pool of that many worker
+processes, so a burst of logins can't hog the CPU (and GIL) of the web
+worker that other requests are waiting on.
+"""
+
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+from flask import current_app
+
+
+DEFAULT_LOG_ROUNDS = 12
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _check(hashed, password):
+    return bcrypt.checkpw(password, hashed)
+
+
+def get_pool(size):
+    """Return the shared hashing process pool, creating it on first use."""
+
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            # spawn, not fork: don't copy the app's threads and DB sockets
+            _pool = ProcessPoolExecutor(
+                max_workers=size,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+
+    return _pool
+
+
+def _run(fn, *args):
+    """Run fn(*args) in the hashing pool if there is one, else inline."""
+
+    size = current_app.config.get('BCRYPT_POOL_SIZE', 0)
+
+    if not size:
+        return fn(*args)
+
+    return get_pool(size).submit(fn, *args).result()
+
+
+def get_log_rounds():
+    """Return configured cost for new hashes."""
+
+    return current_app.config.get('BCRYPT_LOG_ROUNDS', DEFAULT_LOG_ROUNDS)
+
+
+def hash_password(password, rounds=None):
+    """Return bcrypt hash of password (as str)."""
+
+    rounds = rounds or get_log_rounds()
+    return _run(_hash, password.encode('UTF-8'), rounds).decode('UTF-8')
+
+
+def check_password(hashed, password):
+    """Return True if password matches hashed."""
+
+    try:
+        return _run(_check, hashed.encode('UTF-8'), password.encode('UTF-8'))
+    except ValueError:
+        # not a valid bcrypt hash
+        return False
+
+
+def get_rounds(hashed):
+    """Return cost a hash was made with (from its "$2b$12$..." prefix)."""
+
+    return int(hashed.split('$')[2])
+
+
+def needs_rehash(hashed):
+    """Return True if hashed was made with a cost other than configured."""
+
+    return get_rounds(hashed) != get_log_rounds()
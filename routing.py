@@ -0,0 +1,159 @@
+"""Read-replica routing for Flask Cafe.
+
+With DATABASE_REPLICA_URLS set, each replica becomes a Flask-SQLAlchemy
+bind ("replica_0", "replica_1", ...) and RoutingSession sends plain
+SELECTs made while handling GET/HEAD requests to them, round-robin.
+Everything else goes to the primary:
+
+- writes (flushes, INSERT/UPDATE/DELETE, SELECT ... FOR UPDATE)
+- any query after a write in the same session (read-after-write)
+- queries in other requests (POSTs read what they're about to change)
+- queries outside requests (CLI commands, the job worker)
+- for REPLICA_STICKY_SECONDS after a request wrote, that user's requests,
+  so they see their own changes even if the replicas lag a little
+
+A replica that fails a health check (SELECT 1, run at most every
+REPLICA_HEALTH_INTERVAL seconds) is skipped until it passes one again; if
+none are healthy, reads go to the primary.
+"""
+
+import itertools
+import threading
+import time
+
+from flask import current_app, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import select, literal
+from sqlalchemy.sql import Select
+from sqlalchemy.sql.dml import UpdateBase
+
+
+PRIMARY_UNTIL_KEY = 'db_primary_until'
+
+READ_METHODS = ('GET', 'HEAD')
+
+
+def get_replica_binds(urls):
+    """Return SQLALCHEMY_BINDS entries for replica urls."""
+
+    return {f"replica_{i}": url for i, url in enumerate(urls)}
+
+
+class ReplicaRouter:
+    """Flask extension choosing healthy replicas, round-robin."""
+
+    def __init__(self, db, app=None):
+        self.db = db
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.bind_keys = sorted(
+            key for key in app.config.get('SQLALCHEMY_BINDS') or {}
+            if key.startswith('replica_'))
+        self.health_interval = app.config.get('REPLICA_HEALTH_INTERVAL', 10)
+        self.sticky_seconds = app.config.get('REPLICA_STICKY_SECONDS', 5)
+
+        self._cycle = itertools.cycle(self.bind_keys)
+        self._lock = threading.Lock()
+        self._health = {}
+
+        app.after_request(self._remember_write)
+        app.teardown_request(self._reset_session)
+        app.extensions['db_replicas'] = self
+
+    def is_healthy(self, key):
+        """Return True if replica passed its last health check, running
+        the check again if it's more than health_interval old."""
+
+        healthy, checked_at = self._health.get(key, (False, 0))
+
+        if time.monotonic() - checked_at < self.health_interval:
+            return healthy
+
+        try:
+            with self.db.engines[key].connect() as connection:
+                connection.execute(select(literal(1)))
+            healthy = True
+        except Exception:
+            current_app.logger.warning("replica %s failed health check", key)
+            healthy = False
+
+        self._health[key] = (healthy, time.monotonic())
+        return healthy
+
+    def choose(self):
+        """Return engine for next healthy replica, or None if none are."""
+
+        for _ in self.bind_keys:
+            with self._lock:
+                key = next(self._cycle)
+
+            if self.is_healthy(key):
+                return self.db.engines[key]
+
+        return None
+
+    def _remember_write(self, response):
+        """After a request that wrote, send this user to the primary for
+        a while."""
+
+        if (self.bind_keys and self.sticky_seconds
+                and self.db.session.info.get('wrote')):
+            session[PRIMARY_UNTIL_KEY] = time.time() + self.sticky_seconds
+
+        return response
+
+    def _reset_session(self, exc):
+        # the session can outlive a request (e.g. in tests)
+        if not self.bind_keys:
+            return
+
+        self.db.session.info.pop('wrote', None)
+        self.db.session.info.pop('replica', None)
+
+
+class RoutingSession(Session):
+    """Session sending reads in GET/HEAD requests to a replica."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            if self._flushing or _is_write(clause):
+                self.info['wrote'] = True
+
+            elif self._can_use_replica(clause):
+                engine = self.info.get('replica')
+
+                if engine is None:
+                    engine = current_app.extensions['db_replicas'].choose()
+                    self.info['replica'] = engine
+
+                if engine is not None:
+                    return engine
+
+        return super().get_bind(mapper, clause, bind, **kwargs)
+
+    def _can_use_replica(self, clause):
+        if not has_request_context() or self.info.get('wrote'):
+            return False
+
+        router = current_app.extensions.get('db_replicas')
+
+        if router is None or not router.bind_keys:
+            return False
+
+        if request.method not in READ_METHODS:
+            return False
+
+        if session.get(PRIMARY_UNTIL_KEY, 0) > time.time():
+            return False
+
+        return isinstance(clause, Select)
+
+
+def _is_write(clause):
+    """Return True if clause writes (or locks rows to write them)."""
+
+    return isinstance(clause, UpdateBase) or (
+        isinstance(clause, Select) and clause._for_update_arg is not None)
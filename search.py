@@ -0,0 +1,157 @@
+"""Full-text search over cafes.
+
+On Postgres, each cafe's name, description, address and city name are kept
+in a tsvector column (Cafe.search_vector) with a GIN index, and a search is
+a single ranked, counted, paginated query.
+
+Other databases (e.g. SQLite for test runs) store the same text in that
+column, and searches are answered from an in-process inverted index that is
+rebuilt whenever the cafes table changes.
+"""
+
+import bisect
+import math
+import re
+import threading
+from collections import namedtuple, Counter, defaultdict
+
+from models import db, Cafe
+
+
+SearchResults = namedtuple('SearchResults', ['cafes', 'total', 'page', 'per_page'])
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """Return list of lowercase word tokens in text."""
+
+    return TOKEN_RE.findall(text.lower())
+
+
+def search_cafes(q, page=1, per_page=20):
+    """Return SearchResults for cafes matching every word in q.
+
+    Words match as prefixes ("roast" finds "roasters"); results are ordered
+    by relevance.
+    """
+
+    tokens = tokenize(q)
+    page = max(page, 1)
+
+    if not tokens:
+        return SearchResults([], 0, page, per_page)
+
+    if db.engine.dialect.name == 'postgresql':
+        return _search_postgres(tokens, page, per_page)
+
+    return _search_fallback(tokens, page, per_page)
+
+
+def _search_postgres(tokens, page, per_page):
+    """Search using the tsvector column and its GIN index."""
+
+    query = db.func.to_tsquery(
+        'english', ' & '.join(f'{token}:*' for token in tokens))
+    rank = db.func.ts_rank(Cafe.search_vector, query)
+
+    rows = db.session.execute(
+        db.select(Cafe, db.func.count().over())
+        .where(Cafe.search_vector.op('@@')(query))
+        .order_by(rank.desc(), Cafe.id)
+        .limit(per_page)
+        .offset((page - 1) * per_page)
+    ).all()
+
+    total = rows[0][1] if rows else 0
+    return SearchResults([cafe for cafe, _ in rows], total, page, per_page)
+
+
+class InvertedIndex:
+    """In-memory inverted index of cafe search documents."""
+
+    def __init__(self, documents):
+        """documents is an iterable of (cafe id, text)."""
+
+        self.postings = defaultdict(dict)
+        self.size = 0
+
+        for id, text in documents:
+            self.size += 1
+            for token, count in Counter(tokenize(text or '')).items():
+                self.postings[token][id] = count
+
+        self.vocabulary = sorted(self.postings)
+
+    def _prefix_matches(self, prefix):
+        """Return {cafe id: score} for documents with a word starting prefix."""
+
+        scores = defaultdict(float)
+        start = bisect.bisect_left(self.vocabulary, prefix)
+
+        for token in self.vocabulary[start:]:
+            if not token.startswith(prefix):
+                break
+
+            postings = self.postings[token]
+            idf = math.log(1 + self.size / len(postings))
+
+            for id, count in postings.items():
+                scores[id] += count * idf
+
+        return scores
+
+    def search(self, tokens):
+        """Return [(cafe id, score)] matching all tokens, best first."""
+
+        results = None
+
+        for token in tokens:
+            scores = self._prefix_matches(token)
+
+            if results is None:
+                results = scores
+            else:
+                results = {
+                    id: score + scores[id]
+                    for id, score in results.items() if id in scores
+                }
+
+        return sorted(results.items(), key=lambda item: (-item[1], item[0]))
+
+
+_index = None
+_index_stamp = None
+_index_lock = threading.Lock()
+
+
+def get_fallback_index():
+    """Return inverted index of all cafes, rebuilding it if cafes changed."""
+
+    global _index, _index_stamp
+
+    stamp = tuple(db.session.execute(
+        db.select(db.func.count(Cafe.id), db.func.max(Cafe.updated_at),
+                  db.func.sum(Cafe.id))
+    ).one())
+
+    with _index_lock:
+        if _index is None or stamp != _index_stamp:
+            _index = InvertedIndex(db.session.execute(
+                db.select(Cafe.id, Cafe.search_vector)).all())
+            _index_stamp = stamp
+
+        return _index
+
+
+def _search_fallback(tokens, page, per_page):
+    """Search using the in-process inverted index."""
+
+    matches = get_fallback_index().search(tokens)
+    start = (page - 1) * per_page
+    ids = [id for id, _ in matches[start:start + per_page]]
+
+    by_id = {cafe.id: cafe for cafe in Cafe.query.filter(Cafe.id.in_(ids))}
+    cafes = [by_id[id] for id in ids if id in by_id]
+
+    return SearchResults(cafes, len(matches), page, per_page)
@@ -1,11 +1,14 @@
 """Initial data."""
 
-from models import City, Cafe, db , User
+from models import City, Cafe, db , User, Like
 
 from app import app
 
-db.drop_all()
-db.create_all()
+app.app_context().push()
+
+# just the primary (replicas, if any, get its changes by replication)
+db.drop_all(bind_key=None)
+db.create_all(bind_key=None)
 
 
 #######################################
@@ -79,13 +82,14 @@ u1.liked_cafes.append(c1)
 u1.liked_cafes.append(c2)
 ua.liked_cafes.append(c1)
 
+db.session.flush()
+Like.reconcile_counts()
 db.session.commit()
 
 
 #######################################
 # cafe maps
 
-c1.save_cafe_map()
-c2.save_cafe_map()
+Cafe.save_maps([c1, c2])
 
 db.session.commit()
@@ -0,0 +1,28 @@
+"use strict";
+
+const $moreLikedBtn = $('#more-liked-cafes');
+const LIKED_CAFES_URL = "/api/users/me/likes";
+
+/** fetches the next page of liked cafes and adds them to the list */
+async function handleMoreLikedClick(evt) {
+  const cursor = $moreLikedBtn.data('cursor');
+
+  const params = new URLSearchParams({ cursor, fields: "name" });
+  const resp = await fetch(`${LIKED_CAFES_URL}?${params}`);
+  const data = await resp.json();
+
+  for (const cafe of data.cafes) {
+    $('<a class="btn btn-outline-primary">')
+      .attr('href', `/cafes/${cafe.id}`)
+      .text(cafe.name)
+      .appendTo('#liked-cafes');
+  }
+
+  if (data.next_cursor) {
+    $moreLikedBtn.data('cursor', data.next_cursor);
+  } else {
+    $moreLikedBtn.remove();
+  }
+}
+
+$moreLikedBtn.on('click', handleMoreLikedClick);
@@ -1,97 +1,76 @@
 "use strict";
 
-const $likeBtn = $('.like-button');
+const $likeBtns = $('.like-button');
 const CHECK_LIKE_URL = "/api/likes";
-const ADD_LIKE_URL = "/api/like";
-const UNLIKE_URL = "/api/unlike";
+const TOGGLE_LIKE_URL = "/api/likes/toggle";
 
-/** handles the clikc of the like button. Makes request to like api to check if liked */
-async function handleLikeClick() {
+/** handles the click of a like button. One request flips the like and
+ * tells us the new state */
+async function handleLikeClick(evt) {
+  const $btn = $(evt.target).closest('.like-button');
+  const cafeId = $btn.data('cafe-id');
 
-  const cafeId = $likeBtn.attr('id');
-  console.log(cafeId)
-
-  const liked = await isLiked(cafeId);
-  console.log(liked)
-
-  if (liked) {
-    await unlikeCafe(cafeId);
-    changeButtonToUnliked();
-  } else {
-    await likeCafe(cafeId);
-    changeButtonToLiked();
-  }
+  const liked = await toggleLike(cafeId);
+  setButtonState($btn, liked);
 }
 
-/** makes a request to lunike API to unnlike a cafe */
-async function unlikeCafe(cafe_id) {
-  const respnse = await fetch(
-    UNLIKE_URL,
+/** makes a request to like API to flip like; returns true if now liked */
+async function toggleLike(cafeId) {
+  const resp = await fetch(
+    TOGGLE_LIKE_URL,
     {
       method: "POST",
       headers: {
         "Content-Type": "application/json"
       },
       body: JSON.stringify({
-        "cafe_id": Number(cafe_id)
+        "cafe_id": Number(cafeId)
       })
     }
   );
-}
+  const data = await resp.json();
 
-/** makes a request to like API to add a cafe to user likes */
-async function likeCafe(cafe_id) {
-  const respnse = await fetch(
-    ADD_LIKE_URL,
-    {
-      method: "POST",
-      headers: {
-        "Content-Type": "application/json"
-      },
-      body: JSON.stringify({
-        "cafe_id": Number(cafe_id)
-      })
-    }
-  );
+  return data.liked === true;
 }
 
-/** checks like status of a cafe */
-async function isLiked(cafeId) {
-  const params = new URLSearchParams({ cafe_id: cafeId });
+/** checks like status of many cafes at once; returns {cafeId: bool} */
+async function getLikes(cafeIds) {
+  const params = new URLSearchParams({ cafe_ids: cafeIds.join(",") });
 
   const resp = await fetch(`${CHECK_LIKE_URL}?${params}`);
   const data = await resp.json();
 
-  return data.likes === true;
+  return data.likes || {};
 }
 
-/** change to a liked button */
-function changeButtonToLiked() {
-  $likeBtn.html("Unlike")
-    .removeClass("btn-outline-primary")
-    .addClass("btn-primary");
-}
-
-/** change to a unliked button */
-function changeButtonToUnliked() {
-  $likeBtn.html("Like")
-    .removeClass("btn-primary")
-    .addClass("btn-outline-primary");
+/** change button to liked ("Unlike") or unliked ("Like") */
+function setButtonState($btn, liked) {
+  if (liked) {
+    $btn.html("Unlike")
+      .removeClass("btn-outline-primary")
+      .addClass("btn-primary");
+  } else {
+    $btn.html("Like")
+      .removeClass("btn-primary")
+      .addClass("btn-outline-primary");
+  }
 }
 
 
-$likeBtn.on('click', handleLikeClick);
+$likeBtns.on('click', handleLikeClick);
 
-/**On start of page, have the proper like button state */
+/**On start of page, have the proper like button states (one request for
+ * all the buttons on the page) */
 async function start() {
-  const cafeId = $likeBtn.attr('id');
-  const liked = await isLiked(cafeId);
+  const cafeIds = $likeBtns.map((i, btn) => $(btn).data('cafe-id')).get();
+  if (cafeIds.length === 0) return;
 
-  if (liked) {
-    changeButtonToLiked();
-  } else {
-    changeButtonToUnliked();
-  }
+  const likes = await getLikes(cafeIds);
+
+  $likeBtns.each((i, btn) => {
+    const $btn = $(btn);
+    setButtonState($btn, likes[$btn.data('cafe-id')] === true);
+  });
 }
 
-start();
\ No newline at end of file
+start();
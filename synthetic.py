@@ -0,0 +1,294 @@
+"""Synthetic data, for trying Flask Cafe at scale.
+
+generate() adds as many cities, cafes, users and likes as asked for,
+enough (10^5-10^6 rows) to benchmark the cafe list, profiles and likes.
+The same seed always gives the same data.
+
+It's built to be quick:
+
+- rows go in with bulk INSERTs, a batch per statement, not ORM flushes
+- every user gets the same password, hashed once
+- no maps are fetched: every cafe shares one placeholder map image
+
+Like real data, it's lumpy: a few cities have most of the cafes, and a
+few cafes get most of the likes.
+"""
+
+import itertools
+import os
+import random
+import shutil
+
+from maps import get_map_path
+from models import (
+    db, Cafe, City, Like, MapImage, User, DEFAULT_CAFE_IMG_URL)
+from geo import get_cell
+from passwords import hash_password
+
+
+BATCH_SIZE = 5000
+
+PLACEHOLDER_MAP_KEY = 'synthetic-placeholder'
+PLACEHOLDER_MAP_SOURCE = os.path.join(
+    os.path.abspath(os.path.dirname(__file__)),
+    "static", "images", "default-cafe.png")
+
+CITY_NAMES = [
+    "Springfield", "Riverside", "Fairview", "Greenville", "Bristol",
+    "Clinton", "Franklin", "Georgetown", "Madison", "Salem", "Arlington",
+    "Ashland", "Burlington", "Dover", "Hudson", "Kingston", "Lexington",
+    "Milford", "Newport", "Oxford",
+]
+
+STATES = [
+    "AL", "AZ", "CA", "CO", "FL", "GA", "IL", "MA", "MI", "MN", "NC", "NY",
+    "OH", "OR", "PA", "TN", "TX", "VA", "WA", "WI",
+]
+
+CAFE_WORDS = [
+    "Bean", "Brew", "Roast", "Cup", "Crema", "Grind", "Kettle", "Mug",
+    "Press", "Pour", "Steam", "Drip", "Ember", "Oak", "Sparrow", "Harbor",
+    "Lantern", "Copper", "Maple", "Velvet",
+]
+
+CAFE_KINDS = ["Cafe", "Coffee", "Roasters", "Espresso Bar", "Tea House",
+              "Bakery & Cafe", "Coffee Co."]
+
+STREETS = ["Main", "Oak", "Pine", "Maple", "Cedar", "Elm", "Washington",
+           "Lake", "Hill", "Park", "Market", "Mission", "Grand", "Broadway"]
+
+STREET_KINDS = ["St", "Ave", "Blvd", "Rd", "Way"]
+
+DESCRIPTION_WORDS = [
+    "cozy", "spacious", "quiet", "lively", "pour-over", "espresso",
+    "pastries", "wifi", "outlets", "patio", "roasted", "in-house", "latte",
+    "cold brew", "friendly", "baristas", "study", "sunny", "seating",
+    "neighborhood", "favorite", "single-origin", "oat milk", "sandwiches",
+]
+
+FIRST_NAMES = [
+    "Alex", "Sam", "Jordan", "Taylor", "Morgan", "Casey", "Riley", "Jamie",
+    "Avery", "Quinn", "Parker", "Drew", "Robin", "Kai", "Noor", "Ari",
+]
+
+LAST_NAMES = [
+    "Smith", "Garcia", "Nguyen", "Patel", "Kim", "Cohen", "Okafor", "Rossi",
+    "Silva", "Muller", "Khan", "Lopez", "Brown", "Tanaka", "Ivanova",
+]
+
+
+def _batches(rows, size):
+    """Yield lists of up to size items from iterable rows."""
+
+    rows = iter(rows)
+
+    while batch := list(itertools.islice(rows, size)):
+        yield batch
+
+
+def _next_number(column):
+    """Return 1 + the largest id so far, for numbering new rows uniquely."""
+
+    return (db.session.scalar(db.select(db.func.max(column))) or 0) + 1
+
+
+def _popular_first(rng, ids):
+    """Return (ids, cumulative weights): ids shuffled, weighted 1/rank
+    (Zipf), for rng.choices."""
+
+    ids = list(ids)
+    rng.shuffle(ids)
+
+    return ids, list(itertools.accumulate(1 / rank
+                                          for rank in range(1, len(ids) + 1)))
+
+
+def make_cities(rng, count, start):
+    """Return count city rows, numbered from start: codes, names & states,
+    and a center each."""
+
+    cities = []
+
+    for number in range(start, start + count):
+        name = CITY_NAMES[number % len(CITY_NAMES)]
+        if number >= len(CITY_NAMES):
+            name = f"{name} {number // len(CITY_NAMES) + 1}"
+
+        cities.append({
+            "code": f"syn{number}",
+            "name": name,
+            "state": rng.choice(STATES),
+            # somewhere in the continental US
+            "center": (rng.uniform(26, 48), rng.uniform(-123, -70)),
+        })
+
+    return cities
+
+
+def make_cafe(rng, number, city):
+    """Return values for one cafe, in city."""
+
+    lat, lng = city["center"]
+    lat = lat + rng.gauss(0, 0.03)
+    lng = lng + rng.gauss(0, 0.03)
+
+    name = f"{rng.choice(CAFE_WORDS)} & {rng.choice(CAFE_WORDS)} " \
+           f"{rng.choice(CAFE_KINDS)}"
+    description = ' '.join(
+        rng.choice(DESCRIPTION_WORDS)
+        for _ in range(rng.randint(6, 30))).capitalize() + '.'
+
+    return {
+        "name": name,
+        "description": description,
+        "url": f"https://example.com/cafes/{number}",
+        "address": f"{rng.randint(1, 9999)} {rng.choice(STREETS)} "
+                   f"{rng.choice(STREET_KINDS)}",
+        "city_code": city["code"],
+        "image_url": DEFAULT_CAFE_IMG_URL,
+        "map_key": PLACEHOLDER_MAP_KEY,
+        "latitude": lat,
+        "longitude": lng,
+        "geo_cell": get_cell(lat, lng),
+    }
+
+
+def make_user(rng, number, hashed_password):
+    """Return values for one user (all share hashed_password)."""
+
+    first = rng.choice(FIRST_NAMES)
+    last = rng.choice(LAST_NAMES)
+    username = f"{first}{last}{number}".lower()
+
+    return {
+        "username": username,
+        "admin": False,
+        "email": f"{username}@example.com",
+        "first_name": first,
+        "last_name": last,
+        "description": "",
+        "password": hashed_password,
+    }
+
+
+def add_placeholder_map(cafe_count):
+    """Save the placeholder map image (if need be) and record cafe_count
+    more cafes using it."""
+
+    path = get_map_path(PLACEHOLDER_MAP_KEY)
+
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(PLACEHOLDER_MAP_SOURCE, path)
+
+    MapImage.add(PLACEHOLDER_MAP_KEY, os.path.getsize(path))
+    db.session.execute(
+        db.update(MapImage)
+        .where(MapImage.key == PLACEHOLDER_MAP_KEY)
+        .values(ref_count=MapImage.ref_count + cafe_count)
+    )
+
+
+def _insert(model, rows, batch_size, log, label):
+    """Bulk-insert rows of model, a batch per statement; returns new ids
+    in the order of rows."""
+
+    ids = []
+
+    for batch in _batches(rows, batch_size):
+        ids.extend(db.session.scalars(
+            db.insert(model).returning(
+                model.id, sort_by_parameter_order=True),
+            batch).all())
+        db.session.commit()
+        log(f"{label}: {len(ids)}")
+
+    return ids
+
+
+def generate(cities, cafes, users, likes_per_user, seed=0,
+             password="secret", batch_size=BATCH_SIZE, log=None):
+    """Add synthetic cities, cafes, users and likes; returns
+    {"cities": n, "cafes": n, "users": n, "likes": n}.
+
+    Users can log in with password. Runs again add more rows (numbered on
+    from the ones already there) rather than replacing them.
+    """
+
+    log = log or (lambda message: None)
+    rng = random.Random(seed)
+
+    first_city = db.session.scalar(
+        db.select(db.func.count()).where(City.code.like('syn%'))) + 1
+    city_rows = make_cities(rng, cities, first_city)
+    city_count = 0
+
+    for batch in _batches(city_rows, batch_size):
+        db.session.execute(db.insert(City), [
+            {key: value for key, value in city.items() if key != "center"}
+            for city in batch])
+        city_count += len(batch)
+    db.session.commit()
+    log(f"cities: {city_count}")
+
+    if cities and cafes:
+        add_placeholder_map(cafes)
+        db.session.commit()
+
+    # a few cities have most of the cafes
+    city_weights = list(itertools.accumulate(
+        1 / rank for rank in range(1, len(city_rows) + 1)))
+    first_cafe = _next_number(Cafe.id)
+
+    cafe_ids = _insert(Cafe, (
+        make_cafe(rng, number, rng.choices(
+            city_rows, cum_weights=city_weights)[0])
+        for number in range(first_cafe, first_cafe + cafes)
+    ) if city_rows else (), batch_size, log, "cafes")
+
+    # bulk inserts skip the ORM event that keeps this up to date
+    for batch in _batches(cafe_ids, batch_size):
+        Cafe.reindex_search(ids=batch)
+        db.session.commit()
+
+    hashed = hash_password(password)
+    first_user = _next_number(User.id)
+
+    user_ids = _insert(User, (
+        make_user(rng, number, hashed)
+        for number in range(first_user, first_user + users)
+    ), batch_size, log, "users")
+
+    like_count = 0
+
+    if cafe_ids and likes_per_user:
+        ranked, weights = _popular_first(rng, cafe_ids)
+        per_user = min(likes_per_user, len(ranked))
+
+        def likes():
+            for user_id in user_ids:
+                liked = set()
+
+                while len(liked) < per_user:
+                    liked.update(rng.choices(
+                        ranked, cum_weights=weights,
+                        k=per_user - len(liked)))
+
+                for cafe_id in sorted(liked):
+                    yield {"user_id": user_id, "cafe_id": cafe_id}
+
+        for batch in _batches(likes(), batch_size):
+            db.session.execute(db.insert(Like), batch)
+            db.session.commit()
+            like_count += len(batch)
+            log(f"likes: {like_count}")
+
+        Like.reconcile_counts()
+        db.session.commit()
+
+    return {
+        "cities": city_count,
+        "cafes": len(cafe_ids),
+        "users": len(user_ids),
+        "likes": like_count,
+    }
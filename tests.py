@@ -1,11 +1,43 @@
 """Tests for Flask Cafe."""
 
 
-from app import app, CURR_USER_KEY
-from models import db, Cafe, City, connect_db, User, Like
-from flask import session
+from app import app, fragment_cache, login_throttle
+from auth import (
+    CURR_USER_KEY, CURR_USER_SNAPSHOT_KEY, CURR_USER_CHECKED_KEY)
+from models import (
+    db, Cafe, City, connect_db, User, Like, MapJob, MapImage, CacheVersion,
+    city_registry)
+from flask import Flask, session
 from unittest import TestCase
+from unittest.mock import patch
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+import tempfile
+import jobs
+import exports
+import asgi
+import asyncio
+import loadtest
+import migrations
+import synthetic
+import maps
+from fragment_cache import MemoryLRUBackend, FileSystemBackend
+from search import search_cafes
+from geo import get_bounding_box, get_cell, get_covering_cells
+from pagination import encode_cursor, get_sort_key
+from throttle import MemoryBackend, SlidingWindow
+from routing import ReplicaRouter, get_replica_binds, PRIMARY_UNTIL_KEY
+import passwords
 import re
+import gzip
+import time
+from datetime import datetime, timezone
+import json
+from sqlalchemy import Column, Integer, create_engine, inspect, text
+from sqlalchemy.exc import TimeoutError as SQLAlchemyTimeoutError
+from dbstats import (
+    pool_stats, get_engine_options, get_pool_status, InstrumentedQueuePool,
+    count_queries)
 import os
 
 os.environ["DATABASE_URL"] = "postgresql:///flaskcafe_test"
@@ -15,9 +47,18 @@ os.environ["FLASK_DEBUG"] = "0"
 # Make Flask errors be real errors, rather than HTML pages with error info
 app.config['TESTING'] = True
 
+# Tests use the database outside of requests
+app.app_context().push()
+
+# Check every request for repeated queries
+app.config['DB_QUERY_SAMPLE_RATE'] = 1.0
+
 # Don't req CSRF for testing
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Cheap password hashes, so tests don't spend their time in bcrypt
+app.config['BCRYPT_LOG_ROUNDS'] = 4
+
 db.drop_all()
 db.create_all()
 
@@ -41,6 +82,41 @@ def login_for_test(client, user_id):
         sess[CURR_USER_KEY] = user_id
 
 
+class StubMapHandler(BaseHTTPRequestHandler):
+    """Stands in for MapQuest: returns fake image bytes (or an error)."""
+
+    status = 200
+    requests_served = 0
+
+    def do_GET(self):
+        if self.path.startswith("/geocoding/"):
+            self.send_response(self.status)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(
+                b'{"results": [{"locations": '
+                b'[{"latLng": {"lat": 37.79, "lng": -122.40}}]}]}')
+            return
+
+        StubMapHandler.requests_served += 1
+        self.send_response(self.status)
+        self.send_header("Content-Type", "image/jpeg")
+        self.end_headers()
+        self.wfile.write(b"fake-jpg")
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub_map_server():
+    """Start a local stub map server; returns (server, base_url)."""
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubMapHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
 #######################################
 # data to use for test objects / testing forms
 
@@ -150,8 +226,62 @@ class CityModelTestCase(TestCase):
         City.query.delete()
         db.session.commit()
 
-    # depending on how you solve exercise, you may have things to test on
-    # the City model, so here's a good place to put that stuff.
+    def test_get_choices(self):
+        self.assertEqual(City.get_choices(), [("sf", "San Francisco")])
+
+    def test_get_choices_cached(self):
+        City.get_choices()
+
+        with patch.object(db.session, "execute") as execute:
+            self.assertEqual(City.get_choices(), [("sf", "San Francisco")])
+            self.assertEqual(self.cafe.get_city_state(), "San Francisco, CA")
+            execute.assert_not_called()
+
+    def test_city_write_invalidates(self):
+        City.get_choices()
+
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        db.session.commit()
+
+        self.assertEqual(
+            City.get_choices(),
+            [("oak", "Oakland"), ("sf", "San Francisco")])
+
+    def test_bulk_insert_bumps_version(self):
+        version = CacheVersion.get("cities")
+
+        db.session.execute(
+            db.insert(City), [{"code": "oak", "name": "Oakland", "state": "CA"}])
+        db.session.commit()
+
+        self.assertEqual(CacheVersion.get("cities"), version + 1)
+        self.assertEqual(
+            City.get_choices(),
+            [("oak", "Oakland"), ("sf", "San Francisco")])
+
+    def test_first_bump_inserts_version(self):
+        db.session.execute(
+            db.delete(CacheVersion).where(CacheVersion.name == "new"))
+
+        CacheVersion.bump("new", db.session.connection())
+        CacheVersion.bump("new", db.session.connection())
+        db.session.commit()
+
+        self.assertEqual(CacheVersion.get("new"), 2)
+
+    def test_other_process_change_seen_after_ttl(self):
+        City.get_choices()
+
+        # simulate another worker renaming a city: only the stamp tells us
+        db.session.execute(
+            City.__table__.update().values(name="San Fran"))
+        CacheVersion.bump("cities", db.session.connection())
+        db.session.commit()
+
+        self.assertEqual(City.get_choices(), [("sf", "San Francisco")])
+
+        city_registry._checked_at -= app.config["CITY_CACHE_TTL"]
+        self.assertEqual(City.get_choices(), [("sf", "San Fran")])
 
 
 #######################################
@@ -226,6 +356,72 @@ class CafeViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn(b"Test Cafe", resp.data)
 
+    def test_list_pagination(self):
+        cafe2 = Cafe(**{**CAFE_DATA, "name": "Another Cafe"})
+        db.session.add(cafe2)
+        db.session.commit()
+
+        app.config['CAFES_PER_PAGE'] = 1
+
+        try:
+            with app.test_client() as client:
+                login_for_test(client, self.user_id)
+
+                resp = client.get("/cafes")
+                html = resp.data.decode('UTF-8')
+                self.assertIn("Another Cafe", html)
+                self.assertNotIn("Test Cafe", html)
+
+                cursor = re.search(r'after=([\w-]+)', html).group(1)
+                resp = client.get(f"/cafes?after={cursor}")
+                html = resp.data.decode('UTF-8')
+                self.assertIn("Test Cafe", html)
+                self.assertNotIn("Another Cafe", html)
+                self.assertNotIn("Next page", html)
+        finally:
+            app.config['CAFES_PER_PAGE'] = 24
+
+    def test_list_sort_popular(self):
+        cafe2 = Cafe(**{**CAFE_DATA, "name": "Another Cafe"})
+        db.session.add(cafe2)
+        db.session.commit()
+
+        Like.add(self.user_id, self.cafe_id)
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            html = client.get("/cafes?sort=popular").data.decode('UTF-8')
+            self.assertLess(html.index("Test Cafe"), html.index("Another Cafe"))
+
+            html = client.get("/cafes").data.decode('UTF-8')
+            self.assertLess(html.index("Another Cafe"), html.index("Test Cafe"))
+
+        Like.query.delete()
+        db.session.commit()
+
+    def test_list_bad_cursor(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.get("/cafes?after=not-a-cursor")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Test Cafe", resp.data)
+
+    def test_list_cursor_from_other_sort(self):
+        popular = encode_cursor(
+            [0, self.cafe_id], get_sort_key([Cafe.like_count, Cafe.id], True))
+        forged = encode_cursor(
+            [0, "x"], get_sort_key([Cafe.name, Cafe.id]))
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            for cursor in (popular, forged):
+                resp = client.get(f"/cafes?after={cursor}")
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn(b"Test Cafe", resp.data)
+
     def test_detail(self):
         with app.test_client() as client:
             login_for_test(client, self.user_id)
@@ -282,6 +478,11 @@ class CafeAdminViewsTestCase(TestCase):
                 follow_redirects=True)
             self.assertIn(b'added', resp.data)
 
+            # map is rendered later by the worker, not during the request
+            cafe = Cafe.query.filter_by(name=CAFE_DATA_EDIT["name"]).one()
+            job = MapJob.query.filter_by(cafe_id=cafe.id).one()
+            self.assertEqual(job.status, MapJob.PENDING)
+
     def test_dynamic_cities_vocab(self):
         id = self.cafe_id
 
@@ -313,6 +514,62 @@ class CafeAdminViewsTestCase(TestCase):
                 follow_redirects=True)
             self.assertIn(b'edited', resp.data)
 
+    def test_edit_refreshes_cached_fragments(self):
+        id = self.cafe_id
+
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+
+            self.assertIn(b"Test Cafe", client.get("/cafes").data)
+            self.assertIn(b"Test Cafe", client.get(f"/cafes/{id}").data)
+
+            client.post(f"/cafes/{id}/edit", data=CAFE_DATA_EDIT)
+
+            resp = client.get("/cafes")
+            self.assertIn(b"new-name", resp.data)
+            self.assertNotIn(b"Test Cafe", resp.data)
+
+            resp = client.get(f"/cafes/{id}")
+            self.assertIn(b"new-description", resp.data)
+
+    def test_detail_conditional_get(self):
+        id = self.cafe_id
+
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+
+            resp = client.get(f"/cafes/{id}")
+            etag = resp.headers["ETag"]
+            self.assertIsNotNone(resp.headers["Last-Modified"])
+
+            resp = client.get(f"/cafes/{id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+
+            resp = client.get("/cafes")
+            list_etag = resp.headers["ETag"]
+
+            client.post(f"/cafes/{id}/edit", data=CAFE_DATA_EDIT)
+
+            resp = client.get(f"/cafes/{id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"new-name", resp.data)
+
+            resp = client.get("/cafes", headers={"If-None-Match": list_etag})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_conditional_get_is_per_user(self):
+        id = self.cafe_id
+
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            etag = client.get(f"/cafes/{id}").headers["ETag"]
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.get(f"/cafes/{id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+
     def test_unauthorized_edit(self):
         id = self.cafe_id
 
@@ -337,258 +594,340 @@ class CafeAdminViewsTestCase(TestCase):
             self.assertIn(b'Test description', resp.data)
 
 
-#######################################
-# users
-
-
-class UserModelTestCase(TestCase):
-    """Tests for the user model."""
+class MapJobTestCase(TestCase):
+    """Tests for background map jobs."""
 
     def setUp(self):
-        """Before each test, add sample users."""
+        """Before each test, add sample city and cafe"""
 
-        User.query.delete()
+        MapJob.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
 
-        user = User.register(**TEST_USER_DATA)
-        db.session.add(user)
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
 
         db.session.commit()
 
-        self.user = user
+        self.cafe = cafe
 
     def tearDown(self):
-        """After each test, remove all users."""
+        """After each test, remove all jobs and cafes."""
 
-        User.query.delete()
+        MapJob.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
         db.session.commit()
 
-    def test_authenticate(self):
-        rez = User.authenticate("test", "secret")
-        self.assertEqual(rez, self.user)
+        # ids get reused; don't leave this test's objects in the session
+        db.session.expunge_all()
 
-    def test_authenticate_fail(self):
-        rez = User.authenticate("no-such-user", "secret")
-        self.assertFalse(rez)
+    def test_enqueue_reuses_pending_job(self):
+        job1 = MapJob.enqueue(self.cafe)
+        db.session.commit()
+        job2 = MapJob.enqueue(self.cafe)
+        db.session.commit()
 
-        rez = User.authenticate("test", "password")
-        self.assertFalse(rez)
+        self.assertEqual(job1.id, job2.id)
 
-    def test_full_name(self):
-        self.assertEqual(self.user.get_full_name(), "Testy MacTest")
+    def test_run_pending(self):
+        job = MapJob.enqueue(self.cafe)
+        db.session.commit()
 
-    def test_register(self):
-        u = User.register(**TEST_USER_DATA)
-        # test that password gets bcrypt-hashed (all start w/$2b$)
-        self.assertEqual(u.password[:4], "$2b$")
-        db.session.rollback()
+        with patch("models.save_map", return_value=8) as save_map, \
+                patch("models.geocode", return_value=(37.79, -122.40)):
+            self.assertEqual(jobs.run_pending(), 1)
 
+        save_map.assert_called_once()
+        self.assertEqual(job.status, MapJob.DONE)
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(self.cafe.latitude, 37.79)
 
-class AuthViewsTestCase(TestCase):
-    """Tests for views on logging in/logging out/registration."""
+    def test_retry_then_fail(self):
+        job = MapJob.enqueue(self.cafe)
+        db.session.commit()
 
-    def setUp(self):
-        """Before each test, add sample users."""
+        app.config['MAP_JOB_MAX_ATTEMPTS'] = 2
 
-        User.query.delete()
+        try:
+            with patch("models.save_map", side_effect=IOError("timed out")):
+                jobs.run_pending()
+                self.assertEqual(job.status, MapJob.PENDING)
+                self.assertIn("timed out", job.last_error)
 
-        user = User.register(**TEST_USER_DATA)
-        db.session.add(user)
+                # backoff: not due again yet
+                self.assertEqual(jobs.run_pending(), 0)
 
-        db.session.commit()
+                job.run_after = job.created_at
+                db.session.commit()
+                jobs.run_pending()
+        finally:
+            app.config['MAP_JOB_MAX_ATTEMPTS'] = 5
 
-        self.user_id = user.id
+        self.assertEqual(job.status, MapJob.FAILED)
+        self.assertEqual(job.attempts, 2)
 
-    def tearDown(self):
-        """After each test, remove all users."""
+    def test_expired_lease_on_last_attempt_fails(self):
+        job = MapJob.enqueue(self.cafe)
+        db.session.commit()
 
-        User.query.delete()
+        # a worker claimed its last attempt, then died
+        job.status = MapJob.RUNNING
+        job.attempts = app.config['MAP_JOB_MAX_ATTEMPTS']
+        job.run_after = job.created_at
         db.session.commit()
 
-    def test_signup(self):
-        with app.test_client() as client:
-            resp = client.get("/signup")
-            self.assertIn(b'Sign Up', resp.data)
+        self.assertIsNone(jobs.claim_next_job())
+        self.assertEqual(job.status, MapJob.FAILED)
+        self.assertEqual(job.attempts, app.config['MAP_JOB_MAX_ATTEMPTS'])
+        self.assertIn("lease expired", job.last_error)
 
-            resp = client.post(
-                "/signup",
-                data=TEST_USER_DATA_NEW,
-                follow_redirects=True,
-            )
 
-            self.assertIn(b"You are signed up and logged in.", resp.data)
-            self.assertTrue(session.get(CURR_USER_KEY))
+class MapsClientTestCase(TestCase):
+    """Tests for the maps client against a local stub server."""
 
-    def test_signup_username_taken(self):
-        with app.test_client() as client:
-            resp = client.get("/signup")
-            self.assertIn(b'Sign Up', resp.data)
+    def setUp(self):
+        """Before each test, start stub server and add sample cafes"""
 
-            # signup with same data as the already-added user
-            resp = client.post(
-                "/signup",
-                data=TEST_USER_DATA,
-                follow_redirects=True,
-            )
+        Cafe.query.delete()
+        City.query.delete()
 
-            self.assertIn(b"Username already taken", resp.data)
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
 
-    def test_login(self):
-        with app.test_client() as client:
-            resp = client.get("/login")
-            self.assertIn(b'Welcome Back!', resp.data)
+        cafes = [Cafe(**{**CAFE_DATA, "name": f"Cafe {i}"}) for i in range(5)]
+        db.session.add_all(cafes)
 
-            resp = client.post(
-                "/login",
-                data={"username": "test", "password": "WRONG"},
-                follow_redirects=True,
-            )
+        db.session.commit()
 
-            self.assertIn(b"Invalid credentials", resp.data)
+        self.cafe_ids = [cafe.id for cafe in cafes]
 
-            resp = client.post(
-                "/login",
-                data={"username": "test", "password": "secret"},
-                follow_redirects=True,
-            )
+        self.server, base_url = start_stub_map_server()
+        self.maps_dir = tempfile.TemporaryDirectory()
 
-            self.assertIn(b"Hello, test", resp.data)
-            self.assertEqual(session.get(CURR_USER_KEY), self.user_id)
+        self.patches = [
+            patch("maps.BASE_URL", base_url),
+            patch("maps.MAPS_DIR", self.maps_dir.name),
+        ]
+        for p in self.patches:
+            p.start()
 
-    def test_logout(self):
-        with app.test_client() as client:
-            login_for_test(client, self.user_id)
-            resp = client.post("/logout", follow_redirects=True)
+    def tearDown(self):
+        """After each test, stop stub server and remove all cafes."""
 
-            self.assertIn(b"successfully logged out", resp.data)
-            self.assertEqual(session.get(CURR_USER_KEY), None)
+        for p in self.patches:
+            p.stop()
 
+        self.server.shutdown()
+        self.server.server_close()
+        self.maps_dir.cleanup()
 
-class NavBarTestCase(TestCase):
-    """Tests navigation bar."""
+        Cafe.query.delete()
+        MapImage.query.delete()
+        City.query.delete()
+        db.session.commit()
 
-    def setUp(self):
-        """Before tests, add sample user."""
+    def test_fetch_map(self):
+        self.assertEqual(
+            maps.fetch_map("500 Sansome St", "San Francisco", "CA"),
+            b"fake-jpg")
+
+    def test_fetch_map_error(self):
+        with patch.object(StubMapHandler, "status", 500):
+            with self.assertRaises(maps.requests.HTTPError):
+                maps.fetch_map("500 Sansome St", "San Francisco", "CA")
+
+    def test_save_maps_async(self):
+        locations = [
+            ("a", "500 Sansome St", "San Francisco", "CA"),
+            ("b", "1 Main St", "San Francisco", "CA"),
+        ]
+
+        with patch("maps.ASYNC", True):
+            results = maps.save_maps(locations, concurrency=2)
+
+        self.assertEqual(results, {
+            "a": (len(b"fake-jpg"), (37.79, -122.40)),
+            "b": (len(b"fake-jpg"), (37.79, -122.40)),
+        })
+        self.assertTrue(maps.map_exists("a"))
+
+    def test_save_maps_async_error(self):
+        with patch("maps.ASYNC", True), \
+                patch.object(StubMapHandler, "status", 500):
+            results = maps.save_maps(
+                [("a", "500 Sansome St", "San Francisco", "CA")])
+
+        self.assertIsInstance(results["a"], Exception)
+        self.assertFalse(maps.map_exists("a"))
+
+    def test_regenerate_command(self):
+        Cafe.query.filter_by(name="Cafe 0").update({"address": "1 Main St"})
+        db.session.commit()
 
-        User.query.delete()
+        StubMapHandler.requests_served = 0
 
-        user = User.register(**TEST_USER_DATA)
+        runner = app.test_cli_runner()
+        result = runner.invoke(
+            args=["maps", "regenerate", "--city", "sf", "--concurrency", "3"])
 
-        db.session.add_all([user])
-        db.session.commit()
+        self.assertIn("Regenerated 5 map(s)", result.output)
+        self.assertIn("0 failed", result.output)
 
-        self.user_id = user.id
+        # one fetch per distinct location, not per cafe
+        self.assertEqual(StubMapHandler.requests_served, 2)
 
-    def tearDown(self):
-        """After tests, remove all users."""
+        for id in self.cafe_ids:
+            cafe = db.session.get(Cafe, id)
+            with open(maps.get_map_path(cafe.map_key), "rb") as file:
+                self.assertEqual(file.read(), b"fake-jpg")
 
-        User.query.delete()
-        db.session.commit()
+    def test_regenerate_command_bad_concurrency(self):
+        runner = app.test_cli_runner()
+        result = runner.invoke(
+            args=["maps", "regenerate", "--concurrency", "0"])
 
-    def test_anon_navbar(self):
-        """Tests that navbar only has the proper buttons logged out users see"""
-        with app.test_client() as client:
-            resp = client.get("/")
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn("Invalid value for '--concurrency'", result.output)
 
-            self.assertIn(b"Sign Up", resp.data)
-            self.assertIn(b"Log In", resp.data)
-            self.assertNotIn(b"Log Out", resp.data)
 
-    def test_logged_in_navbar(self):
-        """"Tests that navbar only has the proper buttons logged in users see"""
+class MapCacheTestCase(TestCase):
+    """Tests for the content-addressed map image cache."""
 
-        with app.test_client() as client:
-            login_for_test(client, self.user_id)
+    def setUp(self):
+        """Before each test, start stub server and add sample cafes"""
 
-            resp = client.get('/')
-            self.assertIn(b"Where Coffee Dreams Come True", resp.data)
-            self.assertIn(b"Log Out", resp.data)
-            self.assertIn(b"Browse Cafes", resp.data)
-            self.assertNotIn(b"Log In", resp.data)
-            self.assertNotIn(b"Sign Up", resp.data)
-            self.assertEqual(session.get(CURR_USER_KEY), self.user_id)
+        Cafe.query.delete()
+        MapImage.query.delete()
+        City.query.delete()
 
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
 
-class ProfileViewsTestCase(TestCase):
-    """Tests for views on user profiles."""
+        cafe1 = Cafe(**CAFE_DATA)
+        cafe2 = Cafe(**{**CAFE_DATA, "address": " 500  SANSOME st "})
+        db.session.add_all([cafe1, cafe2])
 
-    def setUp(self):
-        """Before each test, add sample user."""
+        db.session.commit()
 
-        User.query.delete()
+        self.cafe1 = cafe1
+        self.cafe2 = cafe2
 
-        user = User.register(**TEST_USER_DATA)
-        db.session.add(user)
+        self.server, base_url = start_stub_map_server()
+        self.maps_dir = tempfile.TemporaryDirectory()
 
-        db.session.commit()
+        self.patches = [
+            patch("maps.BASE_URL", base_url),
+            patch("maps.MAPS_DIR", self.maps_dir.name),
+        ]
+        for p in self.patches:
+            p.start()
 
-        self.user_id = user.id
+        StubMapHandler.requests_served = 0
 
     def tearDown(self):
-        """After each test, remove all users."""
+        """After each test, stop stub server and remove all cafes."""
 
-        User.query.delete()
-        db.session.commit()
+        for p in self.patches:
+            p.stop()
 
-    def test_anon_profile(self):
-        with app.test_client() as client:
-            resp = client.get('/profile', follow_redirects=True)
+        self.server.shutdown()
+        self.server.server_close()
+        self.maps_dir.cleanup()
 
-            self.assertIn(b'You are not logged in', resp.data)
-            self.assertNotIn(b'Edit Your Profile', resp.data)
-            self.assertIsNone(session.get(CURR_USER_KEY))
+        Cafe.query.delete()
+        MapImage.query.delete()
+        City.query.delete()
+        db.session.commit()
 
-    def test_logged_in_profile(self):
-        with app.test_client() as client:
-            login_for_test(client, self.user_id)
+    def test_same_location_shares_map(self):
+        self.cafe1.save_cafe_map()
+        self.cafe2.save_cafe_map()
+        db.session.commit()
 
-            resp = client.get('/profile', follow_redirects=True)
-            self.assertIn(b"Edit Your Profile", resp.data)
-            self.assertIn(b'Testy MacTest', resp.data)
-            self.assertNotIn(b'You are not logged in', resp.data)
-            self.assertTrue(session.get(CURR_USER_KEY))
+        self.assertEqual(StubMapHandler.requests_served, 1)
+        self.assertEqual(self.cafe1.map_key, self.cafe2.map_key)
+        self.assertEqual(db.session.get(MapImage, self.cafe1.map_key).ref_count, 2)
 
-    def test_anon_profile_edit(self):
-        with app.test_client() as client:
-            resp = client.post(
-                'profile/edit',
-                data=TEST_USER_DATA_EDIT,
-                follow_redirects=True)
+    def test_geocoded_with_map(self):
+        self.cafe1.save_cafe_map()
+        self.cafe2.refresh_map()
+        db.session.commit()
 
-            self.assertEqual(resp.status_code, 200)
-            self.assertIn(b'You are not logged in', resp.data)
-            self.assertNotIn(b'Profile edited', resp.data)
-            self.assertIn(b'Username', resp.data)
-            self.assertIn(b'Password', resp.data)
+        for cafe in [self.cafe1, self.cafe2]:
+            self.assertEqual((cafe.latitude, cafe.longitude), (37.79, -122.40))
+            self.assertIsNotNone(cafe.geo_cell)
 
+    def test_refresh_map_uses_cache(self):
+        self.cafe1.save_cafe_map()
+        db.session.commit()
 
-    def test_logged_in_profile_edit(self):
-        with app.test_client() as client:
-            login_for_test(client, self.user_id)
+        self.assertIsNone(self.cafe2.refresh_map())
+        self.assertEqual(self.cafe2.map_key, self.cafe1.map_key)
+        self.assertEqual(MapJob.query.count(), 0)
 
-            resp = client.post(
-                'profile/edit',
-                data=TEST_USER_DATA_EDIT,
-                follow_redirects=True)
+    def test_delete_decrements_then_evicts(self):
+        self.cafe1.save_cafe_map()
+        self.cafe2.save_cafe_map()
+        db.session.commit()
 
-            self.assertNotIn(b'You are not logged in', resp.data)
-            self.assertIn(b'Profile edited', resp.data)
-            self.assertIn(b'new-fn new-ln', resp.data)
-            self.assertIn(b'new-email@test.com', resp.data)
+        key = self.cafe1.map_key
+        image = db.session.get(MapImage, key)
 
+        self.cafe1.delete_cafe_map()
+        db.session.commit()
+        self.assertEqual(image.ref_count, 1)
+        self.assertTrue(maps.map_exists(key))
 
-#######################################
-# likes
+        # orphan is kept while under the size bound...
+        self.cafe2.delete_cafe_map()
+        db.session.commit()
+        self.assertEqual(image.ref_count, 0)
+        self.assertTrue(maps.map_exists(key))
 
+        # ...and evicted once over it
+        self.assertEqual(MapImage.evict_orphans(max_bytes=0), 1)
+        db.session.commit()
+        self.assertIsNone(db.session.get(MapImage, key))
+        self.assertFalse(maps.map_exists(key))
 
-class LikeViewsTestCase(TestCase):
-    """Tests for views on cafes."""
+    def test_evicted_map_kept_on_rollback(self):
+        self.cafe1.save_cafe_map()
+        db.session.commit()
+
+        key = self.cafe1.map_key
+        self.cafe1.delete_cafe_map()
+        db.session.commit()
+
+        self.assertEqual(MapImage.evict_orphans(max_bytes=0), 1)
+        self.assertTrue(maps.map_exists(key))
+        db.session.rollback()
+
+        self.assertIsNotNone(db.session.get(MapImage, key))
+        self.assertTrue(maps.map_exists(key))
+
+    def test_delete_removes_legacy_map(self):
+        maps.write_map(str(self.cafe1.id), b"old-map")
+
+        self.cafe1.delete_cafe_map()
+        self.assertTrue(maps.map_exists(str(self.cafe1.id)))
+
+        db.session.commit()
+        self.assertFalse(maps.map_exists(str(self.cafe1.id)))
+
+
+class FragmentCacheTestCase(TestCase):
+    """Tests for the rendered-fragment cache."""
 
     def setUp(self):
-        """Before each test, add sample user, city, cafes, likes"""
-        Like.query.delete()
-        User.query.delete()
+        """Before each test, add sample city, cafe and user"""
+
         Cafe.query.delete()
         City.query.delete()
+        User.query.delete()
 
         sf = City(**CITY_DATA)
         db.session.add(sf)
@@ -596,116 +935,2087 @@ class LikeViewsTestCase(TestCase):
         cafe = Cafe(**CAFE_DATA)
         db.session.add(cafe)
 
-        user = User.register(**TEST_USER_DATA)
+        user = User(**TEST_USER_DATA)
         db.session.add(user)
 
+        db.session.commit()
+
+        self.cafe = cafe
+        self.user_id = user.id
+
+    def tearDown(self):
+        """After each test, remove all cafes and users."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def test_card_rendered_once(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            client.get("/cafes")
+
+            key = f"cafe-card:{self.cafe.cache_key}"
+            self.assertIn("Test Cafe", fragment_cache.backend.get(key))
+
+            fragment_cache.backend.set(key, "<p>from cache</p>")
+            self.assertIn(b"from cache", client.get("/cafes").data)
+
+    def test_bump_version_changes_key(self):
+        key = self.cafe.cache_key
+
+        self.cafe.bump_version()
+        db.session.commit()
+
+        self.assertNotEqual(self.cafe.cache_key, key)
+
+    def test_memory_backend_is_size_bounded(self):
+        backend = MemoryLRUBackend(max_bytes=10)
+        backend.set("a", "12345")
+        backend.set("b", "12345")
+        backend.get("a")
+        backend.set("c", "12345")
+
+        # b was least recently used
+        self.assertIsNone(backend.get("b"))
+        self.assertEqual(backend.get("a"), "12345")
+        self.assertEqual(backend.size, 10)
+
+    def test_filesystem_backend(self):
+        with tempfile.TemporaryDirectory() as directory:
+            backend = FileSystemBackend(directory, 1000)
+            self.assertIsNone(backend.get("a"))
+
+            backend.set("a", "<p>hi</p>")
+            self.assertEqual(
+                FileSystemBackend(directory, 1000).get("a"), "<p>hi</p>")
+
+    def test_filesystem_backend_bounded(self):
+        with tempfile.TemporaryDirectory() as directory:
+            backend = FileSystemBackend(directory, max_bytes=100)
+
+            # a and b written a while ago, a first
+            for when, key in enumerate(["a", "b"], start=1000):
+                backend.set(key, "x" * 40)
+                os.utime(backend._path(key), (when, when))
+
+            backend.set("c", "x" * 40)
+
+            self.assertIsNone(backend.get("a"))
+            self.assertEqual(backend.get("b"), "x" * 40)
+            self.assertEqual(backend.get("c"), "x" * 40)
+
+
+class SearchTestCase(TestCase):
+    """Tests for cafe search."""
+
+    def setUp(self):
+        """Before each test, add sample city, cafes and user"""
+
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        db.session.add_all([
+            Cafe(**CAFE_DATA),
+            Cafe(**{**CAFE_DATA, "name": "Ritual Coffee Roasters",
+                    "description": "Roasting since 2005."}),
+            Cafe(**{**CAFE_DATA, "name": "Sightglass",
+                    "description": "Coffee bar and roastery."}),
+        ])
+
+        user = User(**TEST_USER_DATA)
+        db.session.add(user)
 
         db.session.commit()
 
-        self.cafe_id = cafe.id
         self.user_id = user.id
 
     def tearDown(self):
-        """After each test, remove all users."""
+        """After each test, remove all cafes and users."""
 
-        Like.query.delete()
         Cafe.query.delete()
         City.query.delete()
         User.query.delete()
         db.session.commit()
 
-    def test_likes_display(self):
-        """Tests like list is displayed in user profile if user has liked cafes"""
+    def test_search_prefix_and_rank(self):
+        results = search_cafes("roast")
+
+        self.assertEqual(results.total, 2)
+        self.assertEqual(
+            [cafe.name for cafe in results.cafes],
+            ["Ritual Coffee Roasters", "Sightglass"])
 
+    def test_search_all_words(self):
+        results = search_cafes("coffee bar")
+        self.assertEqual([cafe.name for cafe in results.cafes], ["Sightglass"])
+
+        # city name is searchable too
+        self.assertEqual(search_cafes("san francisco").total, 3)
+        self.assertEqual(search_cafes("").total, 0)
+
+    def test_search_sees_edits(self):
+        cafe = Cafe.query.filter_by(name="Sightglass").one()
+        cafe.description = "Tea only."
+        db.session.commit()
+
+        self.assertEqual(search_cafes("coffee bar").total, 0)
+        self.assertEqual(search_cafes("tea").total, 1)
+
+    def test_search_pages(self):
+        results = search_cafes("san", page=2, per_page=2)
+
+        self.assertEqual(results.total, 3)
+        self.assertEqual(len(results.cafes), 1)
+
+    def test_search_views(self):
         with app.test_client() as client:
             login_for_test(client, self.user_id)
 
-            user = User.query.get_or_404(self.user_id)
-            cafe = Cafe.query.get_or_404(self.cafe_id)
+            resp = client.get("/cafes/search?q=ritual")
+            self.assertIn(b"Ritual Coffee Roasters", resp.data)
+            self.assertNotIn(b"Sightglass", resp.data)
 
-            user.liked_cafes.append(cafe)
-            resp = client.get('/profile')
+            resp = client.get("/api/cafes/search?q=ritual")
+            self.assertEqual(resp.json["total"], 1)
+            self.assertEqual(
+                resp.json["cafes"][0]["name"], "Ritual Coffee Roasters")
 
-            self.assertIn(b'Your Liked Cafes', resp.data)
-            self.assertIn(b'Test Cafe', resp.data)
+    def test_reindex_command(self):
+        City.query.update({"name": "Frisco"})
+        db.session.commit()
 
-    def test_no_likes_display(self):
-        """Tests correct display if user has no liked cafes"""
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["search", "reindex"])
+
+        self.assertIn("Reindexed 3 cafe(s).", result.output)
+        self.assertEqual(search_cafes("frisco").total, 3)
+
+
+class NearbyTestCase(TestCase):
+    """Tests for finding cafes near a point."""
+
+    def setUp(self):
+        """Before each test, add sample city, placed cafes and user"""
+
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        places = {
+            "Downtown": (37.7946, -122.4014),
+            "Mission": (37.7599, -122.4148),
+            "Oakland": (37.8044, -122.2712),
+        }
+        for name, (lat, lng) in places.items():
+            cafe = Cafe(**{**CAFE_DATA, "name": name})
+            cafe.set_coordinates(lat, lng)
+            db.session.add(cafe)
+
+        db.session.add(Cafe(**{**CAFE_DATA, "name": "Not geocoded"}))
+
+        user = User(**TEST_USER_DATA)
+        db.session.add(user)
 
-        user2 = User(**TEST_USER_DATA_NEW)
-        db.session.add(user2)
         db.session.commit()
 
-        with app.test_client() as client:
-            login_for_test(client, user2.id)
+        self.user_id = user.id
 
-            resp = client.get('/profile')
+    def tearDown(self):
+        """After each test, remove all cafes and users."""
 
-            self.assertIn(b"Your Liked Cafes", resp.data)
-            self.assertIn(b"You have no liked cafes", resp.data)
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
 
-    def test_get_api_like(self):
-        """Tests get request to like api"""
+    def test_find_nearby(self):
+        nearby = Cafe.find_nearby(37.7946, -122.4014, radius_km=5)
+
+        self.assertEqual(
+            [cafe.name for cafe, _ in nearby], ["Downtown", "Mission"])
+        self.assertAlmostEqual(nearby[0][1], 0)
+        self.assertAlmostEqual(nearby[1][1], 4.0, places=1)
+
+    def add_cafes(self, places):
+        for name, (lat, lng) in places.items():
+            cafe = Cafe(**{**CAFE_DATA, "name": name})
+            cafe.set_coordinates(lat, lng)
+            db.session.add(cafe)
 
-        like = Like(user_id=self.user_id, cafe_id=self.cafe_id)
-        db.session.add(like)
         db.session.commit()
 
-        with app.test_client() as client:
-            resp_fail = client.get(
-                '/api/likes',
-                query_string={"cafe_id": self.cafe_id})
+    def test_find_nearby_across_antimeridian(self):
+        self.add_cafes({
+            "East": (0, 179.95),
+            "West": (0, -179.95),
+            "Far": (0, 170),
+        })
 
-            self.assertEqual(resp_fail.json, {"error": "Not logged in"})
+        nearby = Cafe.find_nearby(0, 179.9, radius_km=20)
 
-            login_for_test(client, self.user_id)
+        self.assertEqual([cafe.name for cafe, _ in nearby], ["East", "West"])
 
-            resp_success = client.get(
-                '/api/likes',
-                query_string={"cafe_id": self.cafe_id})
+    def test_find_nearby_near_pole(self):
+        self.add_cafes({
+            "Near side": (89.95, 10),
+            "Far side": (89.95, -170),
+            "Too far": (89, 0),
+        })
 
-            self.assertEqual(resp_success.json, {"likes": True})
+        nearby = Cafe.find_nearby(89.9, 10, radius_km=30)
 
-    def test_post_api_like(self):
-        """Tests post request to like API adds cafe to likes"""
+        self.assertEqual(
+            [cafe.name for cafe, _ in nearby], ["Near side", "Far side"])
 
+    def test_find_nearby_wide_near_pole(self):
+        # at 89.5N a 50km circle reaches ~64 degrees of longitude either
+        # side, far more than radius / cos(lat) suggests
+        self.add_cafes({"Just inside": (89.905, 53.1)})
+
+        nearby = Cafe.find_nearby(89.5, 0, radius_km=50)
+
+        self.assertEqual([cafe.name for cafe, _ in nearby], ["Just inside"])
+        self.assertLess(nearby[0][1], 50)
+
+    def test_covering_cells(self):
+        box = get_bounding_box(0, 179.9, 20)
+        cells = get_covering_cells(box)
+
+        self.assertIn(get_cell(0, 180), cells)
+        self.assertIn(get_cell(0, 179.95), cells)
+        self.assertIn(get_cell(0, -179.95), cells)
+        self.assertNotIn(get_cell(0, 170), cells)
+
+        self.assertIsNone(get_covering_cells(get_bounding_box(89.9, 10, 30)))
+
+    def test_nearby_api(self):
         with app.test_client() as client:
-            resp_fail = client.post(
-                f"/api/like",
-                json={"cafe_id": self.cafe_id})
+            login_for_test(client, self.user_id)
 
-            self.assertEqual(resp_fail.json, {"error": "Not logged in"})
+            resp = client.get(
+                "/api/cafes/nearby",
+                query_string={"lat": 37.80, "lng": -122.27, "radius": 15})
+            self.assertEqual(
+                [cafe["name"] for cafe in resp.json["cafes"]],
+                ["Oakland", "Downtown", "Mission"])
+
+            resp = client.get(
+                "/api/cafes/nearby",
+                query_string={"lat": 37.80, "lng": -122.27, "radius": 500})
+            self.assertEqual(resp.status_code, 400)
+
+
+class CafeApiTestCase(TestCase):
+    """Tests for the /api/cafes JSON resources."""
+
+    def setUp(self):
+        """Before each test, add sample city, cafes and user"""
 
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+
+        cafes = [Cafe(**{**CAFE_DATA, "name": f"Cafe {i}"}) for i in range(3)]
+        cafes[2].city_code = "oak"
+        db.session.add_all(cafes)
+
+        user = User(**TEST_USER_DATA)
+        db.session.add(user)
+
+        db.session.commit()
+
+        self.cafe_ids = [cafe.id for cafe in cafes]
+        self.user_id = user.id
+
+    def tearDown(self):
+        """After each test, remove all cafes and users."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def test_list_fields_and_cursor(self):
+        with app.test_client() as client:
             login_for_test(client, self.user_id)
 
-            resp_success = client.post(
-                f"/api/like",
-                json={"cafe_id": self.cafe_id})
+            resp = client.get(
+                "/api/cafes", query_string={"fields": "name", "limit": 2})
+            self.assertEqual(resp.json["cafes"], [
+                {"id": self.cafe_ids[0], "name": "Cafe 0"},
+                {"id": self.cafe_ids[1], "name": "Cafe 1"},
+            ])
+
+            resp = client.get("/api/cafes", query_string={
+                "fields": "name", "limit": 2,
+                "cursor": resp.json["next_cursor"]})
+            self.assertEqual(
+                [cafe["name"] for cafe in resp.json["cafes"]], ["Cafe 2"])
+            self.assertIsNone(resp.json["next_cursor"])
+
+    def test_list_bad_args(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
 
-            self.assertEqual(resp_success.json, {"liked": self.cafe_id})
+            resp = client.get("/api/cafes", query_string={"fields": "secret"})
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(resp.json["error"], "Unknown field: secret")
 
-    def test_post_unlike(self):
-        """Tests post request to unlike API removes cafe from likes"""
+            resp = client.get("/api/cafes", query_string={"include": "likes"})
+            self.assertEqual(resp.status_code, 400)
+
+            resp = client.get("/api/cafes", query_string={"limit": 1000})
+            self.assertEqual(resp.status_code, 400)
 
+    def test_include_city_one_query(self):
         with app.test_client() as client:
-            resp_fail = client.post(
-                f"/api/unlike",
-                json={"cafe_id": self.cafe_id})
+            login_for_test(client, self.user_id)
+            city_registry.get_cities()
 
-            self.assertEqual(resp_fail.json, {"error": "Not logged in"})
+            with count_queries() as queries:
+                resp = client.get("/api/cafes", query_string={
+                    "fields": "name", "include": "city"})
 
+        statements = list(queries.statements)
 
+        self.assertEqual(
+            [city["code"] for city in resp.json["included"]["cities"]],
+            ["oak", "sf"])
+        self.assertNotIn("city_code", resp.json["cafes"][0])
+        # just the cafes (cities come from the warm registry)
+        self.assertEqual(
+            len([s for s in statements if "FROM cafes" in s]), 1)
+        self.assertFalse([s for s in statements if "FROM cities" in s])
 
+    def test_detail(self):
+        with app.test_client() as client:
             login_for_test(client, self.user_id)
-            user = User.query.get_or_404(self.user_id)
-            cafe = Cafe.query.get_or_404(self.cafe_id)
 
-            user.liked_cafes.append(cafe)
+            resp = client.get(
+                f"/api/cafes/{self.cafe_ids[2]}",
+                query_string={"fields": "name,address", "include": "city"})
+            self.assertEqual(resp.json, {
+                "cafe": {"id": self.cafe_ids[2], "name": "Cafe 2",
+                         "address": "500 Sansome St"},
+                "included": {"cities": [
+                    {"code": "oak", "name": "Oakland", "state": "CA"}]},
+            })
+
+            resp = client.get("/api/cafes/0")
+            self.assertEqual(resp.status_code, 404)
+            self.assertEqual(resp.json["error"], "Not found")
+
+    def test_not_logged_in(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes")
+            self.assertEqual(resp.status_code, 401)
 
-            resp_successs = client.post(
-                f"/api/unlike",
-                json={"cafe_id": self.cafe_id})
+    def test_gzip(self):
+        app.config['API_GZIP_MIN_BYTES'] = 1
 
+        try:
+            with app.test_client() as client:
+                login_for_test(client, self.user_id)
 
+                resp = client.get(
+                    "/api/cafes", headers={"Accept-Encoding": "gzip"})
+                self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+                self.assertIn("Accept-Encoding", resp.headers["Vary"])
 
-            self.assertEqual(resp_successs.json, {"unliked": self.cafe_id})
+                payload = json.loads(gzip.decompress(resp.data))
+                self.assertEqual(len(payload["cafes"]), 3)
+
+                resp = client.get("/api/cafes")
+                self.assertNotIn("Content-Encoding", resp.headers)
+
+                resp = client.get("/api/cafes", headers={
+                    "Accept-Encoding": "gzip;q=0, identity"})
+                self.assertNotIn("Content-Encoding", resp.headers)
+                self.assertEqual(len(resp.json["cafes"]), 3)
+        finally:
+            app.config['API_GZIP_MIN_BYTES'] = 1024
+
+
+#######################################
+# users
+
+
+class UserModelTestCase(TestCase):
+    """Tests for the user model."""
+
+    def setUp(self):
+        """Before each test, add sample users."""
+
+        User.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+
+        db.session.commit()
+
+        self.user = user
+
+    def tearDown(self):
+        """After each test, remove all users."""
+
+        User.query.delete()
+        db.session.commit()
+
+    def test_authenticate(self):
+        rez = User.authenticate("test", "secret")
+        self.assertEqual(rez, self.user)
+
+    def test_authenticate_fail(self):
+        rez = User.authenticate("no-such-user", "secret")
+        self.assertFalse(rez)
+
+        rez = User.authenticate("test", "password")
+        self.assertFalse(rez)
+
+    def test_full_name(self):
+        self.assertEqual(self.user.get_full_name(), "Testy MacTest")
+
+    def test_register(self):
+        u = User.register(**TEST_USER_DATA)
+        # test that password gets bcrypt-hashed (all start w/$2b$)
+        self.assertEqual(u.password[:4], "$2b$")
+        self.assertEqual(passwords.get_rounds(u.password), 4)
+        db.session.rollback()
+
+    def test_authenticate_rehashes_old_cost(self):
+        self.user.password = passwords.hash_password("secret", rounds=5)
+        db.session.commit()
+
+        rez = User.authenticate("test", "secret")
+        self.assertEqual(rez, self.user)
+        self.assertEqual(passwords.get_rounds(self.user.password), 4)
+        self.assertTrue(passwords.check_password(self.user.password, "secret"))
+        db.session.commit()
+
+    def test_authenticate_keeps_current_hash(self):
+        old_hash = self.user.password
+
+        User.authenticate("test", "secret")
+        self.assertEqual(self.user.password, old_hash)
+
+    def test_check_password_bad_hash(self):
+        self.assertFalse(passwords.check_password("not-a-hash", "secret"))
+
+    def test_hash_in_process_pool(self):
+        app.config['BCRYPT_POOL_SIZE'] = 1
+
+        try:
+            hashed = passwords.hash_password("secret")
+            self.assertTrue(passwords.check_password(hashed, "secret"))
+            self.assertFalse(passwords.check_password(hashed, "wrong"))
+            self.assertIsNotNone(passwords._pool)
+        finally:
+            app.config['BCRYPT_POOL_SIZE'] = 0
+
+
+class AuthViewsTestCase(TestCase):
+    """Tests for views on logging in/logging out/registration."""
+
+    def setUp(self):
+        """Before each test, add sample users."""
+
+        User.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+
+        db.session.commit()
+
+        self.user_id = user.id
+        login_throttle.backend.clear()
+
+    def tearDown(self):
+        """After each test, remove all users."""
+
+        User.query.delete()
+        db.session.commit()
+
+    def test_signup(self):
+        with app.test_client() as client:
+            resp = client.get("/signup")
+            self.assertIn(b'Sign Up', resp.data)
+
+            resp = client.post(
+                "/signup",
+                data=TEST_USER_DATA_NEW,
+                follow_redirects=True,
+            )
+
+            self.assertIn(b"You are signed up and logged in.", resp.data)
+            self.assertTrue(session.get(CURR_USER_KEY))
+
+    def test_signup_username_taken(self):
+        with app.test_client() as client:
+            resp = client.get("/signup")
+            self.assertIn(b'Sign Up', resp.data)
+
+            # signup with same data as the already-added user
+            resp = client.post(
+                "/signup",
+                data=TEST_USER_DATA,
+                follow_redirects=True,
+            )
+
+            self.assertIn(b"Username already taken", resp.data)
+
+    def test_login(self):
+        with app.test_client() as client:
+            resp = client.get("/login")
+            self.assertIn(b'Welcome Back!', resp.data)
+
+            resp = client.post(
+                "/login",
+                data={"username": "test", "password": "WRONG"},
+                follow_redirects=True,
+            )
+
+            self.assertIn(b"Invalid credentials", resp.data)
+
+            resp = client.post(
+                "/login",
+                data={"username": "test", "password": "secret"},
+                follow_redirects=True,
+            )
+
+            self.assertIn(b"Hello, test", resp.data)
+            self.assertEqual(session.get(CURR_USER_KEY), self.user_id)
+
+    def test_login_skips_user_query_afterwards(self):
+        with app.test_client() as client:
+            client.post(
+                "/login",
+                data={"username": "test", "password": "secret"},
+            )
+            self.assertEqual(
+                session[CURR_USER_SNAPSHOT_KEY]["first_name"], "Testy")
+
+            with count_queries() as queries:
+                resp = client.get("/")
+
+            self.assertEqual(queries.count, 0)
+            self.assertIn(b"Testy MacTest", resp.data)
+
+    def expire_snapshot_check(self, client):
+        """Make the next request re-check the session's user snapshot."""
+
+        with client.session_transaction() as sess:
+            sess[CURR_USER_CHECKED_KEY] -= app.config['USER_SNAPSHOT_TTL']
+
+    def test_snapshot_dropped_when_user_changes(self):
+        with app.test_client() as client:
+            client.post(
+                "/login",
+                data={"username": "test", "password": "secret"},
+            )
+
+            user = db.session.get(User, self.user_id)
+            user.first_name = "Renamed"
+            db.session.commit()
+
+            # the snapshot is trusted until it's due for a check
+            resp = client.get("/")
+            self.assertIn(b"Testy MacTest", resp.data)
+
+            self.expire_snapshot_check(client)
+            resp = client.get("/")
+            self.assertIn(b"Renamed MacTest", resp.data)
+            self.assertEqual(
+                session[CURR_USER_SNAPSHOT_KEY]["first_name"], "Renamed")
+
+    def test_snapshot_dropped_when_user_deleted(self):
+        with app.test_client() as client:
+            client.post(
+                "/login",
+                data={"username": "test", "password": "secret"},
+            )
+
+            User.query.delete()
+            db.session.commit()
+
+            self.expire_snapshot_check(client)
+            resp = client.get("/")
+            self.assertNotIn(b"Testy MacTest", resp.data)
+            self.assertIsNone(session.get(CURR_USER_KEY))
+
+    def test_old_session_without_snapshot(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get("/")
+            self.assertIn(b"Testy MacTest", resp.data)
+            self.assertEqual(
+                session[CURR_USER_SNAPSHOT_KEY]["id"], self.user_id)
+
+    def test_login_throttled_after_failures(self):
+        limit = app.config['LOGIN_MAX_FAILURES_PER_USER']
+
+        with app.test_client() as client:
+            for _ in range(limit):
+                resp = client.post(
+                    "/login", data={"username": "test", "password": "WRONG"})
+                self.assertEqual(resp.status_code, 200)
+
+            with patch("models.check_password") as check:
+                resp = client.post(
+                    "/login", data={"username": "test", "password": "secret"})
+                check.assert_not_called()
+
+            self.assertEqual(resp.status_code, 429)
+            self.assertIn(b"Too many failed logins", resp.data)
+            self.assertGreater(int(resp.headers["Retry-After"]), 0)
+            self.assertIsNone(session.get(CURR_USER_KEY))
+
+    def test_login_success_resets_throttle(self):
+        limit = app.config['LOGIN_MAX_FAILURES_PER_USER']
+
+        with app.test_client() as client:
+            for _ in range(limit - 1):
+                client.post(
+                    "/login", data={"username": "test", "password": "WRONG"})
+
+            client.post(
+                "/login", data={"username": "test", "password": "secret"})
+            self.assertEqual(login_throttle.by_username.count("test"), 0)
+
+    def test_login_missing_user_cached(self):
+        with app.test_client() as client:
+            client.post(
+                "/login", data={"username": "nobody", "password": "secret"})
+            self.assertTrue(login_throttle.is_missing("nobody"))
+
+            with patch("models.User.authenticate") as authenticate:
+                resp = client.post(
+                    "/login", data={"username": "nobody", "password": "guess"})
+                authenticate.assert_not_called()
+
+            self.assertIn(b"Invalid credentials", resp.data)
+
+    def test_signup_clears_missing_user(self):
+        login_throttle.remember_missing(TEST_USER_DATA_NEW["username"])
+
+        with app.test_client() as client:
+            client.post("/signup", data=TEST_USER_DATA_NEW)
+
+        self.assertFalse(
+            login_throttle.is_missing(TEST_USER_DATA_NEW["username"]))
+
+    def test_logout(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.post("/logout", follow_redirects=True)
+
+            self.assertIn(b"successfully logged out", resp.data)
+            self.assertEqual(session.get(CURR_USER_KEY), None)
+
+
+class ThrottleTestCase(TestCase):
+    """Tests for sliding-window counters behind login throttling."""
+
+    def test_sliding_window(self):
+        window = SlidingWindow(MemoryBackend(100), 'test', limit=3, window=60)
+
+        for _ in range(3):
+            window.hit("a", now=1000)
+
+        self.assertEqual(window.count("a", now=1000), 3)
+        self.assertGreater(window.retry_after("a", now=1000), 0)
+        self.assertEqual(window.retry_after("b", now=1000), 0)
+
+        # previous window's hits count less as it slides out
+        self.assertAlmostEqual(window.count("a", now=1050), 1.5)
+        self.assertEqual(window.retry_after("a", now=1050), 0)
+        self.assertEqual(window.count("a", now=1200), 0)
+
+    def test_retry_after_is_enough(self):
+        window = SlidingWindow(MemoryBackend(100), 'test', limit=3, window=60)
+
+        for _ in range(4):
+            window.hit("a", now=1000)
+
+        wait = window.retry_after("a", now=1000)
+        self.assertGreater(window.retry_after("a", now=1000 + wait - 2), 0)
+        self.assertEqual(window.retry_after("a", now=1000 + wait + 1), 0)
+
+    def test_memory_backend_bounded(self):
+        backend = MemoryBackend(max_keys=2)
+
+        backend.set("a", 1, 60)
+        backend.set("b", 1, 60)
+        backend.set("c", 1, 60)
+
+        self.assertIsNone(backend.get("a"))
+        self.assertEqual(backend.get("c"), 1)
+
+
+class NavBarTestCase(TestCase):
+    """Tests navigation bar."""
+
+    def setUp(self):
+        """Before tests, add sample user."""
+
+        User.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+
+        db.session.add_all([user])
+        db.session.commit()
+
+        self.user_id = user.id
+
+    def tearDown(self):
+        """After tests, remove all users."""
+
+        User.query.delete()
+        db.session.commit()
+
+    def test_anon_navbar(self):
+        """Tests that navbar only has the proper buttons logged out users see"""
+        with app.test_client() as client:
+            resp = client.get("/")
+
+            self.assertIn(b"Sign Up", resp.data)
+            self.assertIn(b"Log In", resp.data)
+            self.assertNotIn(b"Log Out", resp.data)
+
+    def test_logged_in_navbar(self):
+        """"Tests that navbar only has the proper buttons logged in users see"""
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get('/')
+            self.assertIn(b"Where Coffee Dreams Come True", resp.data)
+            self.assertIn(b"Log Out", resp.data)
+            self.assertIn(b"Browse Cafes", resp.data)
+            self.assertNotIn(b"Log In", resp.data)
+            self.assertNotIn(b"Sign Up", resp.data)
+            self.assertEqual(session.get(CURR_USER_KEY), self.user_id)
+
+
+class ProfileViewsTestCase(TestCase):
+    """Tests for views on user profiles."""
+
+    def setUp(self):
+        """Before each test, add sample user."""
+
+        User.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+
+        db.session.commit()
+
+        self.user_id = user.id
+
+    def tearDown(self):
+        """After each test, remove all users."""
+
+        User.query.delete()
+        db.session.commit()
+
+    def test_anon_profile(self):
+        with app.test_client() as client:
+            resp = client.get('/profile', follow_redirects=True)
+
+            self.assertIn(b'You are not logged in', resp.data)
+            self.assertNotIn(b'Edit Your Profile', resp.data)
+            self.assertIsNone(session.get(CURR_USER_KEY))
+
+    def test_logged_in_profile(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get('/profile', follow_redirects=True)
+            self.assertIn(b"Edit Your Profile", resp.data)
+            self.assertIn(b'Testy MacTest', resp.data)
+            self.assertNotIn(b'You are not logged in', resp.data)
+            self.assertTrue(session.get(CURR_USER_KEY))
+
+    def test_anon_profile_edit(self):
+        with app.test_client() as client:
+            resp = client.post(
+                'profile/edit',
+                data=TEST_USER_DATA_EDIT,
+                follow_redirects=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b'You are not logged in', resp.data)
+            self.assertNotIn(b'Profile edited', resp.data)
+            self.assertIn(b'Username', resp.data)
+            self.assertIn(b'Password', resp.data)
+
+
+    def test_logged_in_profile_edit(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.post(
+                'profile/edit',
+                data=TEST_USER_DATA_EDIT,
+                follow_redirects=True)
+
+            self.assertNotIn(b'You are not logged in', resp.data)
+            self.assertIn(b'Profile edited', resp.data)
+            self.assertIn(b'new-fn new-ln', resp.data)
+            self.assertIn(b'new-email@test.com', resp.data)
+            self.assertEqual(
+                session[CURR_USER_SNAPSHOT_KEY]["first_name"], "new-fn")
+
+
+#######################################
+# likes
+
+
+class LikeViewsTestCase(TestCase):
+    """Tests for views on cafes."""
+
+    def setUp(self):
+        """Before each test, add sample user, city, cafes, likes"""
+        Like.query.delete()
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+
+
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+        self.user_id = user.id
+
+    def tearDown(self):
+        """After each test, remove all users."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def test_likes_display(self):
+        """Tests like list is displayed in user profile if user has liked cafes"""
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            user = User.query.get_or_404(self.user_id)
+            cafe = Cafe.query.get_or_404(self.cafe_id)
+
+            user.liked_cafes.append(cafe)
+            resp = client.get('/profile')
+
+            self.assertIn(b'Your Liked Cafes', resp.data)
+            self.assertIn(b'Test Cafe', resp.data)
+
+    def test_profile_conditional_get(self):
+        """Tests profile ETag changes when user likes a cafe"""
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            etag = client.get('/profile').headers["ETag"]
+
+            resp = client.get('/profile', headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            client.post("/api/likes/toggle", json={"cafe_id": self.cafe_id})
+
+            resp = client.get('/profile', headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b'Test Cafe', resp.data)
+
+    def test_no_likes_display(self):
+        """Tests correct display if user has no liked cafes"""
+
+        user2 = User(**TEST_USER_DATA_NEW)
+        db.session.add(user2)
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, user2.id)
+
+            resp = client.get('/profile')
+
+            self.assertIn(b"Your Liked Cafes", resp.data)
+            self.assertIn(b"You have no liked cafes", resp.data)
+
+    def test_get_api_like(self):
+        """Tests get request to like api"""
+
+        like = Like(user_id=self.user_id, cafe_id=self.cafe_id)
+        db.session.add(like)
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp_fail = client.get(
+                '/api/likes',
+                query_string={"cafe_id": self.cafe_id})
+
+            self.assertEqual(resp_fail.json, {"error": "Not logged in"})
+
+            login_for_test(client, self.user_id)
+
+            resp_success = client.get(
+                '/api/likes',
+                query_string={"cafe_id": self.cafe_id})
+
+            self.assertEqual(resp_success.json, {"likes": True})
+
+    def test_post_api_like(self):
+        """Tests post request to like API adds cafe to likes"""
+
+        with app.test_client() as client:
+            resp_fail = client.post(
+                f"/api/like",
+                json={"cafe_id": self.cafe_id})
+
+            self.assertEqual(resp_fail.json, {"error": "Not logged in"})
+
+            login_for_test(client, self.user_id)
+
+            resp_success = client.post(
+                f"/api/like",
+                json={"cafe_id": self.cafe_id})
+
+            self.assertEqual(resp_success.json, {"liked": self.cafe_id})
+
+    def test_post_unlike(self):
+        """Tests post request to unlike API removes cafe from likes"""
+
+        with app.test_client() as client:
+            resp_fail = client.post(
+                f"/api/unlike",
+                json={"cafe_id": self.cafe_id})
+
+            self.assertEqual(resp_fail.json, {"error": "Not logged in"})
+
+
+
+            login_for_test(client, self.user_id)
+            user = User.query.get_or_404(self.user_id)
+            cafe = Cafe.query.get_or_404(self.cafe_id)
+
+            user.liked_cafes.append(cafe)
+
+            resp_successs = client.post(
+                f"/api/unlike",
+                json={"cafe_id": self.cafe_id})
+
+
+
+            self.assertEqual(resp_successs.json, {"unliked": self.cafe_id})
+
+    def test_get_api_likes_batch(self):
+        """Tests like status for many cafes in one request"""
+
+        cafe2 = Cafe(**{**CAFE_DATA, "name": "Another Cafe"})
+        db.session.add(cafe2)
+        db.session.add(Like(user_id=self.user_id, cafe_id=self.cafe_id))
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get(
+                '/api/likes',
+                query_string={"cafe_ids": f"{self.cafe_id},{cafe2.id}"})
+
+            self.assertEqual(resp.json, {"likes": {
+                str(self.cafe_id): True,
+                str(cafe2.id): False,
+            }})
+
+            resp = client.get('/api/likes', query_string={"cafe_ids": "1,x"})
+            self.assertEqual(resp.status_code, 400)
+
+    def test_toggle_like(self):
+        """Tests toggling a like on and off"""
+
+        with app.test_client() as client:
+            resp_fail = client.post(
+                "/api/likes/toggle",
+                json={"cafe_id": self.cafe_id})
+
+            self.assertEqual(resp_fail.json, {"error": "Not logged in"})
+
+            login_for_test(client, self.user_id)
+
+            resp = client.post(
+                "/api/likes/toggle",
+                json={"cafe_id": self.cafe_id})
+
+            self.assertEqual(resp.json,
+                             {"cafe_id": self.cafe_id, "liked": True})
+            self.assertIsNotNone(
+                db.session.get(Like, (self.user_id, self.cafe_id)))
+
+            resp = client.post(
+                "/api/likes/toggle",
+                json={"cafe_id": self.cafe_id})
+
+            self.assertEqual(resp.json,
+                             {"cafe_id": self.cafe_id, "liked": False})
+            self.assertEqual(Like.query.count(), 0)
+            self.assertEqual(db.session.get(Cafe, self.cafe_id).like_count, 0)
+
+    def test_invalid_cafe_id(self):
+        """Tests like endpoints reject a missing or non-int cafe_id"""
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            for url in ["/api/likes/toggle", "/api/like", "/api/unlike"]:
+                for body in [{}, {"cafe_id": "1"}, {"cafe_id": True}]:
+                    resp = client.post(url, json=body)
+                    self.assertEqual(resp.status_code, 400)
+                    self.assertEqual(resp.json, {"error": "Invalid cafe_id"})
+
+                resp = client.post(url, data="not json")
+                self.assertEqual(resp.status_code, 400)
+
+        self.assertEqual(Like.query.count(), 0)
+
+    def test_like_count(self):
+        """Tests like_count follows likes and reconcile fixes drift"""
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            client.post("/api/likes/toggle", json={"cafe_id": self.cafe_id})
+
+        cafe = db.session.get(Cafe, self.cafe_id)
+        self.assertEqual(cafe.like_count, 1)
+
+        cafe.like_count = 7
+        db.session.commit()
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["likes", "reconcile"])
+
+        self.assertIn("Fixed like_count on 1 cafe(s).", result.output)
+        self.assertEqual(cafe.like_count, 1)
+
+
+class ExportTestCase(TestCase):
+    """Tests for streaming table exports."""
+
+    def setUp(self):
+        """Before each test, add sample city, cafe, users and a like"""
+
+        Like.query.delete()
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+
+        cafe = Cafe(**CAFE_DATA)
+        user = User.register(**TEST_USER_DATA)
+        admin = User.register(**{**TEST_USER_DATA_NEW, "admin": True})
+        db.session.add_all([cafe, user, admin])
+        db.session.commit()
+
+        Like.add(user.id, cafe.id)
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+        self.user_id = user.id
+        self.admin_id = admin.id
+
+    def tearDown(self):
+        """After each test, remove all data."""
+
+        Like.query.delete()
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_export_users_ndjson(self):
+        lines = "".join(exports.export("users", "ndjson")).splitlines()
+        users = [json.loads(line) for line in lines]
+
+        self.assertEqual(
+            [user["username"] for user in users], ["test", "new-username"])
+        self.assertNotIn("password", users[0])
+
+    def test_export_csv_batches(self):
+        chunks = list(exports.to_csv(
+            ["a", "b"], ((i, i * 2) for i in range(5)), batch_size=2))
+
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual("".join(chunks).splitlines()[:2], ["a,b", "0,0"])
+
+    def test_export_cli(self):
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["export", "likes", "--format", "csv"])
+
+        self.assertEqual(
+            result.output.splitlines(),
+            ["user_id,cafe_id", f"{self.user_id},{self.cafe_id}"])
+
+    def test_export_endpoint(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.get("/admin/export/cafes")
+            self.assertEqual(resp.status_code, 403)
+
+            login_for_test(client, self.admin_id)
+            resp = client.get("/admin/export/cafes")
+            self.assertEqual(resp.mimetype, "application/x-ndjson")
+
+            cafe = json.loads(resp.data)
+            self.assertEqual(cafe["id"], self.cafe_id)
+            self.assertEqual(cafe["like_count"], 1)
+
+            resp = client.get("/admin/export/passwords")
+            self.assertEqual(resp.mimetype, "text/html")
+
+
+class ImportTestCase(TestCase):
+    """Tests for bulk-importing cafes."""
+
+    def setUp(self):
+        """Before each test, add sample city and an existing cafe"""
+
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+
+    def tearDown(self):
+        """After each test, remove all cafes and cities."""
+
+        Cafe.query.delete()
+        MapImage.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def write_file(self, suffix, text):
+        """Return path of a temp file holding text."""
+
+        file = tempfile.NamedTemporaryFile(
+            'w', suffix=suffix, delete=False, encoding='UTF-8')
+        self.addCleanup(os.remove, file.name)
+
+        with file:
+            file.write(text)
+
+        return file.name
+
+    def test_import_csv(self):
+        path = self.write_file(".csv", "\n".join([
+            "name,description,address,city_code,url",
+            "New Cafe,Good coffee,1 Main St,sf,",
+            "Test Cafe,Now with pastries,500 Sansome St,sf,",
+            ",No name,2 Main St,sf,",
+            "Far Cafe,,3 Main St,nyc,",
+            "Bad URL,,4 Main St,sf,not-a-url",
+        ]))
+
+        def fake_save_maps(locations, concurrency):
+            return {key: (8, (37.79, -122.40)) for key, *_ in locations}
+
+        with patch("models.save_maps", side_effect=fake_save_maps):
+            result = app.test_cli_runner().invoke(
+                args=["import", "cafes", path])
+
+        self.assertIn("(1 new, 1 updated)", result.output)
+        self.assertIn("3 row(s) with errors", result.output)
+        self.assertIn("line 4: name:", result.output)
+        self.assertIn("line 5: city_code:", result.output)
+        self.assertIn("line 6: url:", result.output)
+        self.assertIn("Fetched 1 map(s)", result.output)
+
+        existing = db.session.get(Cafe, self.cafe_id)
+        self.assertEqual(existing.description, "Now with pastries")
+        self.assertEqual(existing.version, 2)
+
+        new = Cafe.query.filter_by(name="New Cafe").one()
+        self.assertEqual(new.image_url, Cafe.image_url.default.arg)
+        self.assertEqual(new.latitude, 37.79)
+        self.assertEqual(
+            [cafe.name for cafe in search_cafes("good coffee").cafes],
+            ["New Cafe"])
+
+    def test_import_ndjson(self):
+        path = self.write_file(".ndjson", "\n".join([
+            json.dumps({"name": "One", "address": "1 Main St",
+                        "city_code": "sf"}),
+            "{not json",
+            json.dumps({"name": "Two", "address": "2 Main St",
+                        "city_code": "sf"}),
+            json.dumps({"name": "One", "address": "1 Main St",
+                        "city_code": "sf", "description": "later row"}),
+        ]))
+
+        result = app.test_cli_runner().invoke(
+            args=["import", "cafes", path, "--no-maps", "--batch-size", "2"])
+
+        self.assertIn("(2 new, 1 updated)", result.output)
+        self.assertIn("line 2: Invalid JSON", result.output)
+        self.assertEqual(Cafe.query.count(), 3)
+        self.assertEqual(
+            Cafe.query.filter_by(name="One").one().description, "later row")
+
+    def test_import_bad_concurrency(self):
+        path = self.write_file(".csv", "name,address,city_code\n")
+
+        result = app.test_cli_runner().invoke(
+            args=["import", "cafes", path, "--concurrency", "0"])
+
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn("Invalid value for '--concurrency'", result.output)
+
+
+class DbStatsTestCase(TestCase):
+    """Tests for pool settings and database timing stats."""
+
+    def setUp(self):
+        """Before each test, add sample users."""
+
+        User.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+        admin = User.register(**{**TEST_USER_DATA_NEW, "admin": True})
+        db.session.add_all([user, admin])
+        db.session.commit()
+
+        self.user_id = user.id
+        self.admin_id = admin.id
+        pool_stats.reset()
+
+    def tearDown(self):
+        """After each test, remove all users."""
+
+        User.query.delete()
+        db.session.commit()
+
+    def test_engine_options(self):
+        config = {
+            **app.config,
+            "SQLALCHEMY_DATABASE_URI": "postgresql:///flask_cafe",
+            "DB_POOL_SIZE": 20,
+            "DB_STATEMENT_TIMEOUT_MS": 5000,
+        }
+        options = get_engine_options(config)
+
+        self.assertEqual(options["pool_size"], 20)
+        self.assertEqual(options["poolclass"], InstrumentedQueuePool)
+        self.assertEqual(options["connect_args"],
+                         {"options": "-c statement_timeout=5000"})
+
+        config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        self.assertEqual(get_engine_options(config), {})
+
+    def test_pool_checkout_stats(self):
+        engine = create_engine(
+            "sqlite://", poolclass=InstrumentedQueuePool,
+            pool_size=1, max_overflow=0, pool_timeout=0.05)
+        self.addCleanup(engine.dispose)
+
+        with engine.connect():
+            self.assertEqual(
+                get_pool_status(engine.pool)["saturation"], 1)
+
+            with self.assertRaises(SQLAlchemyTimeoutError):
+                engine.connect()
+
+        stats = pool_stats.as_dict()
+        self.assertEqual(stats["checkouts"], 1)
+        self.assertEqual(stats["checkout_timeouts"], 1)
+
+    def test_request_timing(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            client.get("/profile")
+
+        stats = pool_stats.as_dict()
+        self.assertEqual(stats["requests"], 1)
+        self.assertGreater(stats["avg_queries_per_request"], 0)
+
+    def test_db_stats_page(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.get("/admin/db-stats", follow_redirects=True)
+            self.assertIn(b"Unauthorized", resp.data)
+
+            login_for_test(client, self.admin_id)
+            resp = client.get("/admin/db-stats")
+            self.assertIn(b"Connection Pool", resp.data)
+            self.assertIn(b"avg_checkout_ms", resp.data)
+
+    def test_server_timing(self):
+        app.config['DB_SERVER_TIMING'] = True
+
+        try:
+            with app.test_client() as client:
+                login_for_test(client, self.user_id)
+                resp = client.get("/profile")
+        finally:
+            app.config['DB_SERVER_TIMING'] = False
+
+        timings = resp.headers.getlist("Server-Timing")
+        self.assertTrue(timings[0].startswith("db;dur="))
+        self.assertIn("queries", timings[0])
+        self.assertTrue(timings[1].startswith("db-wait;dur="))
+
+    def test_query_budget_warning(self):
+        app.config['DB_QUERY_BUDGET'] = 1
+
+        try:
+            with app.test_client() as client:
+                login_for_test(client, self.user_id)
+
+                with self.assertLogs(app.logger, "WARNING") as logs:
+                    client.get("/profile")
+        finally:
+            app.config['DB_QUERY_BUDGET'] = 20
+
+        self.assertIn("GET /profile ran", logs.output[0])
+
+    def test_repeated_query_detected(self):
+        with count_queries() as queries:
+            for user_id in [self.user_id, self.admin_id, self.user_id]:
+                db.session.expunge_all()
+                db.session.get(User, user_id)
+
+        [(statement, count)] = queries.repeated(3)
+        self.assertIn("FROM users", statement)
+        self.assertEqual(count, 3)
+
+    def test_pages_have_no_repeated_queries(self):
+        db.session.add(City(**CITY_DATA))
+        cafes = [Cafe(**{**CAFE_DATA, "name": f"Cafe {i}"}) for i in range(6)]
+        db.session.add_all(cafes)
+        db.session.commit()
+
+        for cafe in cafes:
+            Like.add(self.user_id, cafe.id)
+        db.session.commit()
+
+        try:
+            with app.test_client() as client:
+                login_for_test(client, self.user_id)
+
+                for url in ["/cafes", f"/cafes/{cafes[0].id}", "/profile"]:
+                    with count_queries() as queries:
+                        client.get(url)
+
+                    self.assertEqual(queries.repeated(3), [], url)
+                    self.assertLessEqual(queries.count, 8, url)
+        finally:
+            Like.query.delete()
+            Cafe.query.delete()
+            City.query.delete()
+            db.session.commit()
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Tests for sending GET requests' reads to replicas.
+
+    Uses its own app, with a primary and a replica SQLite database that
+    hold different cities, so each query's database can be told apart.
+    """
+
+    def setUp(self):
+        """Make app with a primary, a replica and a broken replica."""
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = (
+            f"sqlite:///{self.tmpdir.name}/primary.db")
+        self.app.config['SQLALCHEMY_BINDS'] = get_replica_binds([
+            f"sqlite:///{self.tmpdir.name}/replica.db",
+            f"sqlite:///{self.tmpdir.name}/missing/replica.db",
+        ])
+        self.app.config['SECRET_KEY'] = "test"
+        self.app.config['CITY_CACHE_TTL'] = 60
+
+        db.init_app(self.app)
+        self.router = ReplicaRouter(db, self.app)
+
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.addCleanup(self.ctx.pop)
+
+        db.create_all(bind_key=None)
+        db.metadata.create_all(db.engines["replica_0"])
+
+        with db.engines["replica_0"].begin() as connection:
+            connection.execute(City.__table__.insert(), dict(
+                code="rep", name="Replica City", state="CA",
+                updated_at=datetime.now(timezone.utc)))
+
+    def get_city_codes(self):
+        return [city.code for city in City.query.order_by(City.code)]
+
+    def test_get_reads_from_replica(self):
+        with self.app.test_request_context("/", method="GET"):
+            self.assertEqual(self.get_city_codes(), ["rep"])
+            db.session.remove()
+
+            # next in turn is the broken replica_1; it's skipped
+            with self.assertLogs(self.app.logger, "WARNING"):
+                self.assertEqual(self.get_city_codes(), ["rep"])
+
+            self.assertFalse(self.router.is_healthy("replica_1"))
+
+    def test_post_reads_from_primary(self):
+        with self.app.test_request_context("/", method="POST"):
+            self.assertEqual(self.get_city_codes(), [])
+
+    def test_read_after_write_uses_primary(self):
+        with self.app.test_request_context("/", method="GET"):
+            self.assertEqual(self.get_city_codes(), ["rep"])
+
+            db.session.add(City(**CITY_DATA))
+            db.session.flush()
+
+            self.assertEqual(self.get_city_codes(), ["sf"])
+            db.session.rollback()
+
+    def test_outside_request_uses_primary(self):
+        self.assertEqual(self.get_city_codes(), [])
+
+    def test_no_healthy_replicas_uses_primary(self):
+        self.router._health = {
+            key: (False, time.monotonic()) for key in self.router.bind_keys}
+
+        with self.app.test_request_context("/", method="GET"):
+            self.assertEqual(self.get_city_codes(), [])
+
+    def test_sticky_after_write(self):
+        @self.app.post("/cities")
+        def add_city():
+            db.session.add(City(**CITY_DATA))
+            db.session.commit()
+            return "added"
+
+        @self.app.get("/cities")
+        def list_cities():
+            return ",".join(self.get_city_codes())
+
+        with self.app.test_client() as client:
+            self.assertEqual(client.get("/cities").text, "rep")
+
+            client.post("/cities")
+            self.assertEqual(client.get("/cities").text, "sf")
+
+            with client.session_transaction() as sess:
+                sess[PRIMARY_UNTIL_KEY] = 0
+
+            self.assertEqual(client.get("/cities").text, "rep")
+
+
+class LikedCafesTestCase(TestCase):
+    """Tests for paging through a user's liked cafes."""
+
+    def setUp(self):
+        """Before each test, add a user who likes 5 cafes."""
+
+        Like.query.delete()
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        cafes = [Cafe(**{**CAFE_DATA, "name": f"Cafe {i}"}) for i in range(5)]
+        user = User.register(**TEST_USER_DATA)
+        db.session.add_all([*cafes, user])
+        db.session.commit()
+
+        for cafe in cafes:
+            Like.add(user.id, cafe.id)
+        db.session.commit()
+
+        self.user_id = user.id
+        app.config['LIKED_CAFES_PER_PAGE'] = 2
+
+    def tearDown(self):
+        """After each test, remove all data."""
+
+        app.config['LIKED_CAFES_PER_PAGE'] = 20
+
+        Like.query.delete()
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_profile_shows_first_page(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.get("/profile")
+
+        html = resp.get_data(as_text=True)
+        self.assertIn("Cafe 1", html)
+        self.assertNotIn("Cafe 2", html)
+        self.assertIn('id="more-liked-cafes"', html)
+
+    def test_likes_api_pages(self):
+        names = []
+        cursor = None
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            while True:
+                resp = client.get("/api/users/me/likes", query_string={
+                    "fields": "name", **({"cursor": cursor} if cursor else {})})
+                names += [cafe["name"] for cafe in resp.json["cafes"]]
+                cursor = resp.json["next_cursor"]
+
+                if not cursor:
+                    break
+
+        self.assertEqual(names, [f"Cafe {i}" for i in range(5)])
+
+    def test_likes_api_not_logged_in(self):
+        with app.test_client() as client:
+            resp = client.get("/api/users/me/likes")
+
+        self.assertEqual(resp.status_code, 401)
+
+
+class MigrationTestCase(TestCase):
+    """Tests for schema migrations."""
+
+    def test_upgrade(self):
+        with db.engine.begin() as connection:
+            connection.execute(text("DROP INDEX ix_likes_cafe_id_user_id"))
+            connection.execute(text("DROP TABLE IF EXISTS schema_migrations"))
+
+        runner = app.test_cli_runner()
+
+        result = runner.invoke(args=["db", "status"])
+        self.assertIn("Pending 0001", result.output)
+
+        result = runner.invoke(args=["db", "upgrade"])
+        self.assertIn("Applied 0001", result.output)
+
+        indexes = inspect(db.engine).get_indexes("likes")
+        self.assertIn(
+            "ix_likes_cafe_id_user_id", [index["name"] for index in indexes])
+
+        result = runner.invoke(args=["db", "upgrade"])
+        self.assertIn("Database is up to date.", result.output)
+
+    def test_dry_run(self):
+        with db.engine.begin() as connection:
+            connection.execute(text("DROP INDEX ix_likes_cafe_id_user_id"))
+            connection.execute(text("DROP TABLE IF EXISTS schema_migrations"))
+
+        runner = app.test_cli_runner()
+
+        result = runner.invoke(args=["db", "upgrade", "--dry-run"])
+        self.assertIn("0001: Index likes by (cafe_id, user_id)", result.output)
+        self.assertIn(
+            "CREATE INDEX IF NOT EXISTS ix_likes_cafe_id_user_id",
+            result.output)
+        self.assertIn("lock: database write lock", result.output)
+        self.assertIn("lock: none (already done)", result.output)
+        self.assertIn("lock: skipped on sqlite", result.output)
+
+        # nothing changed
+        indexes = inspect(db.engine).get_indexes("likes")
+        self.assertNotIn(
+            "ix_likes_cafe_id_user_id", [index["name"] for index in indexes])
+        self.assertEqual(len(migrations.get_pending()),
+                         len(migrations.MIGRATIONS))
+
+        runner.invoke(args=["db", "upgrade"])
+        self.assertEqual(migrations.get_pending(), [])
+
+    def test_backfill_in_batches(self):
+        engine = create_engine("sqlite://")
+
+        with engine.begin() as connection:
+            connection.execute(text(
+                "CREATE TABLE things (id INTEGER PRIMARY KEY, size INTEGER)"))
+            connection.execute(text(
+                "INSERT INTO things (id, size) VALUES "
+                "(1, NULL), (2, 5), (3, NULL), (4, NULL), (5, NULL), "
+                "(6, NULL), (7, NULL), (8, NULL)"))
+
+        backfill = migrations.Backfill(
+            'things', {"size": "id * 10"}, where="size IS NULL",
+            batch_size=3, pause=0)
+        logged = []
+
+        updated = backfill.run(
+            engine, migrations.Options(log=logged.append))
+
+        self.assertEqual(updated, 7)
+        self.assertEqual(len(logged), 3)
+
+        with engine.connect() as connection:
+            sizes = connection.execute(
+                text("SELECT id, size FROM things ORDER BY id")).all()
+
+        self.assertEqual(
+            sizes, [(1, 10), (2, 5), (3, 30), (4, 40), (5, 50), (6, 60),
+                    (7, 70), (8, 80)])
+
+    def test_failed_migration_resumes(self):
+        engine = create_engine("sqlite://")
+
+        with engine.begin() as connection:
+            connection.execute(text("CREATE TABLE things (id INTEGER)"))
+
+        add_column = migrations.AddColumn('things', Column('size', Integer))
+        failing = migrations.Migration('0001', "Sizes", [
+            add_column,
+            migrations.CreateIndex('ix_things_size', 'nope', ['size']),
+        ])
+
+        with self.assertRaises(Exception):
+            migrations.upgrade(engine, [failing])
+
+        self.assertEqual(migrations.get_pending(engine, [failing]), [failing])
+
+        fixed = migrations.Migration('0001', "Sizes", [
+            add_column,
+            migrations.CreateIndex('ix_things_size', 'things', ['size']),
+        ])
+
+        # the column, added last time, isn't added again
+        self.assertEqual(migrations.upgrade(engine, [fixed]), [fixed])
+        self.assertEqual(migrations.get_pending(engine, [fixed]), [])
+
+
+class LoadTestTestCase(TestCase):
+    """Tests for the load-testing harness."""
+
+    def setUp(self):
+        """Before each test, add cafes, a user and an admin."""
+
+        Like.query.delete()
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        db.session.add_all(
+            [Cafe(**{**CAFE_DATA, "name": f"Cafe {i}"}) for i in range(5)])
+        db.session.add(User.register(**TEST_USER_DATA))
+        db.session.add(User.register(**ADMIN_USER_DATA))
+        db.session.commit()
+
+        login_throttle.backend.clear()
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        """After each test, remove all data."""
+
+        self.tmpdir.cleanup()
+
+        Like.query.delete()
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+        db.session.expunge_all()
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+
+        self.assertEqual(loadtest.percentile(values, 0.50), 50)
+        self.assertEqual(loadtest.percentile(values, 0.95), 95)
+        self.assertEqual(loadtest.percentile(values, 0.99), 99)
+        self.assertEqual(loadtest.percentile([7], 0.99), 7)
+        self.assertEqual(loadtest.percentile([], 0.5), 0)
+
+    def test_get_endpoint(self):
+        self.assertEqual(
+            loadtest.get_endpoint(app.url_map, "GET", "/cafes/12?x=1"),
+            "GET /cafes/<int:cafe_id>")
+        self.assertEqual(
+            loadtest.get_endpoint(app.url_map, "GET", "/nope"),
+            "GET /nope")
+
+    def test_run_scenarios(self):
+        output = os.path.join(self.tmpdir.name, "results.json")
+        runner = app.test_cli_runner()
+
+        result = runner.invoke(args=[
+            "loadtest", "run", "-c", "1", "--iterations", "3",
+            "--username", "test", "--password", "secret",
+            "--admin-username", "admin", "--admin-password", "secret",
+            "-s", "browse", "-s", "detail", "-s", "like", "-s", "login",
+            "-s", "admin_edit", "-o", output,
+        ])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        with open(output) as file:
+            results = json.load(file)
+
+        endpoints = results["endpoints"]
+        self.assertEqual(endpoints["*"]["count"], sum(
+            stats["count"] for endpoint, stats in endpoints.items()
+            if endpoint != "*"))
+        self.assertEqual(endpoints["*"]["errors"], 0)
+
+        for stats in endpoints.values():
+            self.assertLessEqual(stats["p50_ms"], stats["p95_ms"])
+            self.assertLessEqual(stats["p95_ms"], stats["p99_ms"])
+
+        # the likes scenario toggles twice, so leaves no likes
+        self.assertEqual(Like.query.count(), 0)
+
+    def test_unknown_scenario(self):
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["loadtest", "run", "-s", "nope"])
+
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("Unknown scenario: nope", result.output)
+
+    def test_record_and_replay(self):
+        path = os.path.join(self.tmpdir.name, "requests.jsonl")
+
+        recording = Flask(__name__)
+        recording.config['REQUEST_LOG_PATH'] = path
+        loadtest.RequestRecorder(recording)
+
+        @recording.route("/login", methods=["POST"])
+        def recorded_login():
+            return "ok"
+
+        @recording.get("/cafes")
+        def recorded_cafes():
+            return "ok"
+
+        with recording.test_client() as client:
+            client.get("/cafes?sort=popular")
+            client.post("/login", data={
+                "username": "test", "password": "secret", "csrf_token": "x"})
+
+        with open(path) as file:
+            records = list(loadtest.read_log(file))
+
+        self.assertEqual(records[0]["path"], "/cafes?sort=popular")
+        self.assertEqual(records[1]["form"], {"username": "test"})
+
+        results = loadtest.replay(
+            lambda: loadtest.AppClient(app), app.url_map, records[:1] * 4,
+            {"username": "test", "password": "secret"}, concurrency=1)
+
+        self.assertEqual(results["endpoints"]["GET /cafes"]["count"], 4)
+        self.assertEqual(
+            results["endpoints"]["GET /cafes"]["statuses"], {"200": 4})
+
+        # the logged login has no password; the harness's own is used
+        results = loadtest.replay(
+            lambda: loadtest.AppClient(app), app.url_map, records,
+            {"username": "test", "password": "secret"}, concurrency=1)
+
+        self.assertEqual(
+            results["endpoints"]["POST /login"]["statuses"], {"302": 1})
+
+    def test_get_form_page(self):
+        self.assertEqual(
+            loadtest.get_form_page(app.url_map, "/cafes/1/edit"),
+            "/cafes/1/edit")
+        self.assertEqual(
+            loadtest.get_form_page(app.url_map, "/cafes/1/delete"),
+            "/cafes/1")
+        self.assertEqual(loadtest.get_form_page(app.url_map, "/logout"), "/")
+
+    def test_compare(self):
+        baseline = {"endpoints": {
+            "GET /cafes": {"p95_ms": 10.0},
+            "GET /": {"p95_ms": 10.0},
+        }}
+        current = {"endpoints": {
+            "GET /cafes": {"p95_ms": 15.0},
+            "GET /": {"p95_ms": 11.0},
+            "GET /new": {"p95_ms": 50.0},
+        }}
+
+        self.assertEqual(
+            loadtest.compare(baseline, current, max_regression=0.2),
+            [("GET /cafes", 10.0, 15.0)])
+
+
+class SyntheticSeedTestCase(TestCase):
+    """Tests for generating synthetic data."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.clear()
+
+    def tearDown(self):
+        self.clear()
+        self.tmpdir.cleanup()
+
+    def clear(self):
+        Like.query.delete()
+        User.query.delete()
+        Cafe.query.delete()
+        MapImage.query.delete()
+        City.query.delete()
+        db.session.commit()
+        db.session.expunge_all()
+
+    def generate(self):
+        with patch("maps.MAPS_DIR", self.tmpdir.name):
+            return synthetic.generate(
+                cities=3, cafes=40, users=6, likes_per_user=4, seed=7,
+                batch_size=15)
+
+    def test_generate(self):
+        counts = self.generate()
+
+        self.assertEqual(
+            counts, {"cities": 3, "cafes": 40, "users": 6, "likes": 24})
+        self.assertEqual(Cafe.query.count(), 40)
+        self.assertEqual(Like.query.count(), 24)
+
+        # like counts match the likes
+        self.assertEqual(
+            db.session.scalar(db.select(db.func.sum(Cafe.like_count))), 24)
+
+        # every cafe shares the one placeholder map
+        image = db.session.get(MapImage, synthetic.PLACEHOLDER_MAP_KEY)
+        self.assertEqual(image.ref_count, 40)
+        self.assertTrue(os.path.exists(os.path.join(
+            self.tmpdir.name, f"{synthetic.PLACEHOLDER_MAP_KEY}.jpg")))
+
+        # searchable, and users can log in
+        self.assertEqual(Cafe.query.filter(Cafe.search_vector.is_(None))
+                         .count(), 0)
+        user = User.query.first()
+        self.assertTrue(User.authenticate(user.username, "secret"))
+
+    def test_generate_invalidates_cities(self):
+        City.get_choices()
+        version = CacheVersion.get("cities")
+
+        self.generate()
+
+        self.assertGreater(CacheVersion.get("cities"), version)
+        self.assertEqual(len(City.get_choices()), 3)
+
+    def test_same_seed_same_data(self):
+        self.generate()
+        first = db.session.execute(
+            db.select(Cafe.name, Cafe.address, Cafe.city_code)
+            .order_by(Cafe.id)).all()
+
+        self.clear()
+        self.generate()
+        second = db.session.execute(
+            db.select(Cafe.name, Cafe.address, Cafe.city_code)
+            .order_by(Cafe.id)).all()
+
+        self.assertEqual(first, second)
+
+    def test_command(self):
+        runner = app.test_cli_runner()
+
+        with patch("maps.MAPS_DIR", self.tmpdir.name):
+            result = runner.invoke(args=[
+                "seed", "synthetic", "--cities", "2", "--cafes", "10",
+                "--users", "3", "--likes-per-user", "2"])
+
+        self.assertIn(
+            "Added 2 cities, 10 cafes, 3 users and 6 likes", result.output)
+
+    def test_command_bounds(self):
+        runner = app.test_cli_runner()
+
+        for args in [["--batch-size", "0"], ["--cafes", "-1"]]:
+            result = runner.invoke(args=["seed", "synthetic", *args])
+
+            self.assertEqual(result.exit_code, 2)
+            self.assertIn("Invalid value", result.output)
+
+        self.assertEqual(City.query.count(), 0)
+
+
+class AsgiTestCase(TestCase):
+    """Tests for the ASGI entry point's async like API."""
+
+    def setUp(self):
+        """Before each test, make a database file with a cafe and user."""
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.url = f"sqlite:///{self.tmpdir.name}/asgi.db"
+        self.engine = create_engine(self.url)
+        db.metadata.create_all(self.engine)
+
+        with self.engine.begin() as connection:
+            connection.execute(db.insert(City), CITY_DATA)
+            self.cafe_id = connection.scalar(
+                db.insert(Cafe).values(**CAFE_DATA).returning(Cafe.id))
+            self.user_id = connection.scalar(
+                db.insert(User).values(
+                    **{**TEST_USER_DATA, "password": "x"}, admin=False,
+                    image_url="").returning(User.id))
+
+        self.asgi = asgi.CafeAsgi(app, database_url=self.url)
+        self.cookie = app.session_interface.get_signing_serializer(
+            app).dumps({CURR_USER_KEY: self.user_id})
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def call(self, method, path, payload=None, query="", logged_in=True):
+        """Make request to the ASGI app; return (status, body bytes)."""
+
+        headers = [(b"content-type", b"application/json")]
+        if logged_in:
+            headers.append((b"cookie", f"session={self.cookie}".encode()))
+
+        body = json.dumps(payload).encode() if payload is not None else b""
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "root_path": "",
+            "query_string": query.encode(),
+            "headers": headers,
+            "client": ("127.0.0.1", 5000),
+            "server": ("localhost", 80),
+        }
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": body,
+                    "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        async def run():
+            try:
+                await self.asgi(scope, receive, send)
+            finally:
+                if self.asgi.engine is not None:
+                    await self.asgi.engine.dispose()
+
+        asyncio.run(run())
+
+        status = messages[0]["status"]
+        body = b"".join(message.get("body", b"") for message in messages[1:])
+        return status, body
+
+    def get_like_count(self):
+        with self.engine.connect() as connection:
+            return connection.scalar(
+                db.select(Cafe.like_count).where(Cafe.id == self.cafe_id))
+
+    def test_get_async_url(self):
+        self.assertEqual(
+            str(asgi.get_async_url("postgresql:///flask_cafe")),
+            "postgresql+asyncpg:///flask_cafe")
+        self.assertEqual(
+            str(asgi.get_async_url("sqlite:///cafe.db")),
+            "sqlite+aiosqlite:///cafe.db")
+
+    def test_toggle_like(self):
+        status, body = self.call(
+            "POST", "/api/likes/toggle", {"cafe_id": self.cafe_id})
+        self.assertEqual(status, 200)
+        self.assertEqual(
+            json.loads(body), {"cafe_id": self.cafe_id, "liked": True})
+        self.assertEqual(self.get_like_count(), 1)
+
+        status, body = self.call(
+            "GET", "/api/likes", query=f"cafe_ids={self.cafe_id},999")
+        self.assertEqual(json.loads(body),
+                         {"likes": {str(self.cafe_id): True, "999": False}})
+
+        status, body = self.call(
+            "POST", "/api/likes/toggle", {"cafe_id": self.cafe_id})
+        self.assertEqual(json.loads(body)["liked"], False)
+        self.assertEqual(self.get_like_count(), 0)
+
+    def test_like_and_unlike(self):
+        status, body = self.call(
+            "POST", "/api/like", {"cafe_id": self.cafe_id})
+        self.assertEqual(json.loads(body), {"liked": self.cafe_id})
+
+        status, body = self.call(
+            "GET", "/api/likes", query=f"cafe_id={self.cafe_id}")
+        self.assertEqual(json.loads(body), {"likes": True})
+
+        status, body = self.call(
+            "POST", "/api/unlike", {"cafe_id": self.cafe_id})
+        self.assertEqual(json.loads(body), {"unliked": self.cafe_id})
+
+        status, body = self.call(
+            "POST", "/api/unlike", {"cafe_id": self.cafe_id})
+        self.assertEqual(status, 404)
+
+        status, body = self.call("POST", "/api/like", {"cafe_id": 999})
+        self.assertEqual(status, 404)
+
+    def test_invalid_cafe_id(self):
+        for payload in [{}, {"cafe_id": "1"}, {"cafe_id": True}]:
+            status, body = self.call("POST", "/api/likes/toggle", payload)
+
+            self.assertEqual(status, 400)
+            self.assertEqual(json.loads(body), {"error": "Invalid cafe_id"})
+
+        self.assertEqual(self.get_like_count(), 0)
+
+    def test_not_logged_in(self):
+        status, body = self.call(
+            "POST", "/api/likes/toggle", {"cafe_id": self.cafe_id},
+            logged_in=False)
+
+        self.assertEqual(json.loads(body), {"error": "Not logged in"})
+        self.assertEqual(self.get_like_count(), 0)
+
+    def test_deleted_user(self):
+        with self.engine.begin() as connection:
+            connection.execute(db.delete(User))
+
+        for path in ["/api/likes/toggle", "/api/like"]:
+            status, body = self.call("POST", path, {"cafe_id": self.cafe_id})
+            self.assertEqual(json.loads(body), {"error": "Not logged in"})
+
+        self.assertEqual(self.get_like_count(), 0)
+
+    def test_other_requests_go_to_flask(self):
+        status, body = self.call("GET", "/login", logged_in=False)
+
+        self.assertEqual(status, 200)
+        self.assertIn(b"Log In", body)
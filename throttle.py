@@ -0,0 +1,249 @@
+"""Login throttling for Flask Cafe.
+
+Failed logins are counted per username and per client IP in sliding
+windows; once either is over its limit, further attempts are turned away
+before any database query or password check. Usernames that don't exist
+are remembered for a short while, so repeated guesses at them don't hit
+the database either.
+
+Counters live in a backend picked by LOGIN_THROTTLE_BACKEND:
+
+- "memory": per-process, bounded to LOGIN_THROTTLE_MAX_KEYS keys
+- "redis": shared by all workers, at LOGIN_THROTTLE_REDIS_URL (needs the
+  redis package, and Redis 7 or later for EXPIRE ... NX)
+
+With the memory backend, each worker has its own list of missing
+usernames too: signing up clears the name only in the worker that handled
+it, so other workers may still answer "invalid credentials" for it for
+up to LOGIN_MISSING_USER_TTL seconds. Use the redis backend (or a short
+TTL) if that matters.
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryBackend:
+    """In-process key/value store with expiring keys."""
+
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key, now):
+        item = self._items.get(key)
+
+        if item is not None and item[1] <= now:
+            del self._items[key]
+            return None
+
+        return item
+
+    def _set(self, key, value, expires_at):
+        self._items[key] = (value, expires_at)
+        self._items.move_to_end(key)
+
+        # drop the least recently set keys from the front, without scanning
+        # the rest: the store fills up during credential stuffing, which is
+        # just when each failed login has to stay cheap (expired keys
+        # elsewhere are dropped when next read)
+        while len(self._items) > self.max_keys:
+            self._items.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            item = self._get(key, time.time())
+            return item[0] if item else None
+
+    def set(self, key, value, expire):
+        with self._lock:
+            now = time.time()
+            self._set(key, value, now + expire)
+
+    def incr(self, key, expire):
+        """Add 1 to key (0 if missing) and return it; expire only new keys."""
+
+        with self._lock:
+            now = time.time()
+            item = self._get(key, now)
+
+            value, expires_at = item or (0, now + expire)
+            self._set(key, value + 1, expires_at)
+
+            return value + 1
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class RedisBackend:
+    """Key/value store in Redis, shared by every worker."""
+
+    def __init__(self, url, prefix='flaskcafe:throttle:'):
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.redis.get(self.prefix + key)
+        return int(value) if value is not None else None
+
+    def set(self, key, value, expire):
+        self.redis.set(self.prefix + key, value, ex=math.ceil(expire))
+
+    def incr(self, key, expire):
+        pipe = self.redis.pipeline()
+        pipe.incr(self.prefix + key)
+        pipe.expire(self.prefix + key, math.ceil(expire), nx=True)
+        return pipe.execute()[0]
+
+    def delete(self, *keys):
+        if keys:
+            self.redis.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        keys = list(self.redis.scan_iter(self.prefix + '*'))
+        if keys:
+            self.redis.delete(*keys)
+
+
+def make_backend(config):
+    """Return the throttle backend configured in app config."""
+
+    kind = config.get('LOGIN_THROTTLE_BACKEND', 'memory')
+
+    if kind == 'memory':
+        return MemoryBackend(config.get('LOGIN_THROTTLE_MAX_KEYS', 100_000))
+
+    if kind == 'redis':
+        return RedisBackend(config['LOGIN_THROTTLE_REDIS_URL'])
+
+    raise ValueError(f"Unknown LOGIN_THROTTLE_BACKEND: {kind}")
+
+
+class SlidingWindow:
+    """Counts events per subject over the last `window` seconds.
+
+    Uses the usual two-bucket approximation: the count is this fixed
+    window's events plus the previous window's, weighted by how much of
+    it still overlaps the sliding window. That's two integer keys per
+    subject, rather than a timestamp per event.
+    """
+
+    def __init__(self, backend, name, limit, window):
+        self.backend = backend
+        self.name = name
+        self.limit = limit
+        self.window = window
+
+    def _buckets(self, subject, now):
+        bucket, elapsed = divmod(now, self.window)
+        return (f"{self.name}:{subject}:{int(bucket)}",
+                f"{self.name}:{subject}:{int(bucket) - 1}",
+                elapsed / self.window)
+
+    def count(self, subject, now=None):
+        """Return (approximate) number of events in the last window."""
+
+        current, previous, elapsed = self._buckets(subject, now or time.time())
+
+        return ((self.backend.get(current) or 0)
+                + (self.backend.get(previous) or 0) * (1 - elapsed))
+
+    def hit(self, subject, now=None):
+        """Record an event for subject."""
+
+        current, _, _ = self._buckets(subject, now or time.time())
+        self.backend.incr(current, self.window * 2)
+
+    def retry_after(self, subject, now=None):
+        """Return seconds until subject is under its limit again (0 if it is).
+
+        An estimate: assumes no more events until then.
+        """
+
+        now = now or time.time()
+        current, previous, elapsed = self._buckets(subject, now)
+        current = self.backend.get(current) or 0
+        previous = self.backend.get(previous) or 0
+
+        if current + previous * (1 - elapsed) < self.limit:
+            return 0
+
+        if current >= self.limit:
+            # still over once current becomes the previous window; wait
+            # for enough of it to slide out too
+            overlap = self.limit / current
+            wait = (1 - elapsed) * self.window + (1 - overlap) * self.window
+        else:
+            overlap = (self.limit - current) / previous
+            wait = (1 - overlap - elapsed) * self.window
+
+        return max(math.ceil(wait), 1)
+
+    def reset(self, subject, now=None):
+        """Forget subject's events."""
+
+        current, previous, _ = self._buckets(subject, now or time.time())
+        self.backend.delete(current, previous)
+
+
+class LoginThrottle:
+    """Flask extension limiting failed logins per username and per IP."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        window = config.get('LOGIN_THROTTLE_WINDOW', 300)
+
+        self.backend = make_backend(config)
+        self.by_username = SlidingWindow(
+            self.backend, 'user', config.get('LOGIN_MAX_FAILURES_PER_USER', 5),
+            window)
+        self.by_ip = SlidingWindow(
+            self.backend, 'ip', config.get('LOGIN_MAX_FAILURES_PER_IP', 50),
+            window)
+        self.missing_ttl = config.get('LOGIN_MISSING_USER_TTL', 60)
+
+        app.extensions['login_throttle'] = self
+
+    def retry_after(self, username, ip):
+        """Return seconds to wait before trying this login, or 0."""
+
+        return max(self.by_username.retry_after(username),
+                   self.by_ip.retry_after(ip))
+
+    def record_failure(self, username, ip):
+        self.by_username.hit(username)
+        self.by_ip.hit(ip)
+
+    def record_success(self, username):
+        self.by_username.reset(username)
+
+    def is_missing(self, username):
+        """Return True if username was recently found not to exist."""
+
+        return self.backend.get(f"missing:{username}") is not None
+
+    def remember_missing(self, username):
+        self.backend.set(f"missing:{username}", 1, self.missing_ttl)
+
+    def forget_missing(self, username):
+        """Call when username is created, so it can log in right away
+        (in every worker with the redis backend; just this one with the
+        memory backend)."""
+
+        self.backend.delete(f"missing:{username}")